@@ -0,0 +1,147 @@
+"""
+Local JWT verification for services that trust this auth service.
+
+Downstream Django/DRF services verify access tokens against the cached
+JWKS published at ``/.well-known/jwks.json`` instead of calling us. This is
+a standalone module with no imports from the service, copy or vendor it
+into the consuming project::
+
+    # settings.py
+    AUTH_SERVICE = {
+        "JWKS_URL": "https://auth.example.com/.well-known/jwks.json",
+        "ISSUER": "https://auth.example.com",   # optional
+    }
+    REST_FRAMEWORK = {
+        "DEFAULT_AUTHENTICATION_CLASSES": ("auth_client.JWKSAuthentication",),
+    }
+
+    # views.py
+    class ReportView(APIView):
+        permission_classes = [HasRole]
+        allowed_roles = ["Admin", "Manager"]
+
+Only PyJWT (with cryptography) and DRF are required.
+"""
+import jwt
+from rest_framework import HTTP_HEADER_ENCODING, authentication, exceptions
+from rest_framework.permissions import BasePermission
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class TokenVerifier:
+    """Verify tokens against a JWKS URL; keys are cached and refetched on an unknown kid."""
+
+    def __init__(self, jwks_url, issuer=None, audience=None, leeway=0, cache_lifespan=300,
+                 algorithms=("RS256", "EdDSA")):
+        self.issuer = issuer
+        self.audience = audience
+        self.leeway = leeway
+        self.algorithms = set(algorithms)
+        self.jwks_client = jwt.PyJWKClient(jwks_url, cache_jwk_set=True, lifespan=cache_lifespan)
+
+    def verify(self, token, token_type="access"):
+        try:
+            signing_key = self.jwks_client.get_signing_key_from_jwt(token)
+            if signing_key.algorithm_name not in self.algorithms:
+                raise InvalidToken("Token signed with an unexpected algorithm")
+            claims = jwt.decode(
+                token,
+                signing_key.key,
+                algorithms=[signing_key.algorithm_name],
+                audience=self.audience,
+                issuer=self.issuer,
+                leeway=self.leeway,
+                options={"verify_aud": self.audience is not None, "require": ["exp"]},
+            )
+        except (jwt.PyJWKClientError, jwt.InvalidTokenError) as e:
+            raise InvalidToken(str(e)) from e
+
+        if token_type and claims.get("token_type") != token_type:
+            raise InvalidToken("Wrong token type")
+        return claims
+
+
+class TokenPrincipal:
+    """Authenticated user built from token claims, no database row behind it."""
+
+    __slots__ = ("id", "role", "is_active", "claims")
+
+    is_anonymous = False
+
+    def __init__(self, claims):
+        self.id = claims.get("user_id")
+        self.role = claims.get("role")
+        # tokens minted before the claim existed only went to active users
+        self.is_active = claims.get("is_active", True) is not False
+        self.claims = claims
+
+    @property
+    def is_authenticated(self):
+        return self.is_active
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __str__(self):
+        return f"TokenPrincipal {self.id}"
+
+
+_verifier = None
+
+
+def get_verifier():
+    global _verifier
+    if _verifier is None:
+        from django.conf import settings
+
+        config = settings.AUTH_SERVICE
+        _verifier = TokenVerifier(
+            config["JWKS_URL"],
+            issuer=config.get("ISSUER"),
+            audience=config.get("AUDIENCE"),
+            leeway=config.get("LEEWAY", 0),
+            cache_lifespan=config.get("JWKS_CACHE_SECONDS", 300),
+        )
+    return _verifier
+
+
+# DRF authentication class for "Authorization: Bearer <access token>"
+class JWKSAuthentication(authentication.BaseAuthentication):
+    keyword = b"Bearer"
+
+    def authenticate(self, request):
+        header = authentication.get_authorization_header(request).split()
+        if not header or header[0] != self.keyword:
+            return None
+        if len(header) != 2:
+            raise exceptions.AuthenticationFailed("Invalid Authorization header.")
+
+        try:
+            claims = get_verifier().verify(header[1].decode(HTTP_HEADER_ENCODING))
+        except (InvalidToken, UnicodeError) as e:
+            raise exceptions.AuthenticationFailed(f"Invalid token: {e}")
+
+        principal = TokenPrincipal(claims)
+        if not principal.is_active:
+            raise exceptions.AuthenticationFailed("User is inactive.")
+        return principal, claims
+
+    def authenticate_header(self, request):
+        return 'Bearer realm="api"'
+
+
+# Role check on the "role" claim, same contract as users.permission.RolePermission
+class HasRole(BasePermission):
+    allowed_roles = []
+
+    def has_permission(self, request, view):
+        user = request.user
+        if not user or not user.is_authenticated or not getattr(user, "is_active", True):
+            return False
+
+        roles = getattr(view, "allowed_roles", self.allowed_roles)
+        return bool(roles) and getattr(user, "role", None) in roles
@@ -12,5 +12,12 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'auth_service.settings')
+# Route the hot endpoints to users/async_views.py (settings.ASYNC_VIEWS)
+os.environ.setdefault('ASYNC_VIEWS', 'true')
 
 application = get_asgi_application()
+
+# ASGI servers import this module in every worker process
+from users import startup  # noqa: E402
+
+startup.start_background()
@@ -1,8 +1,13 @@
 import os
 from celery import Celery
+from celery.signals import worker_init
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'auth_service.settings')
+# Celery runs Django's system checks when a worker boots; the URL check alone
+# imports every view, which a worker-role process never serves
+if os.environ.get('SERVICE_ROLE') == 'worker':
+    os.environ.setdefault('CELERY_SKIP_CHECKS', 'true')
 
 app = Celery('auth_service')
 
@@ -10,3 +15,12 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Load task modules from all registered Django apps.
 app.autodiscover_tasks()
+
+
+# Import every task in the parent and freeze its heap before the prefork
+# pool forks the children, so they share those pages (users/startup.py)
+@worker_init.connect
+def preload(**kwargs):
+    from users import startup
+
+    startup.preload("worker")
@@ -1,6 +1,7 @@
 from pathlib import Path
 import os
 import environ
+from django.core.exceptions import ImproperlyConfigured
 from datetime import timedelta
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -58,10 +59,16 @@ REST_FRAMEWORK = {
 
     # JWT
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.authentication.CachedJWTAuthentication',
     ),
 
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+
+    # Proxies in front of the service that append to X-Forwarded-For. The
+    # throttles key on the client address: with 0 that is REMOTE_ADDR and a
+    # client-supplied X-Forwarded-For is ignored, behind a load balancer set
+    # it to the number of trusted hops.
+    'NUM_PROXIES': env.int('NUM_PROXIES', default=0),
 }
 
 # OpenApi ui
@@ -73,8 +80,22 @@ SPECTACULAR_SETTINGS = {
     # OTHER SETTINGS
 }
 
+# Precomputed OpenAPI schema (users/schema.py)
+# api/schema/ serves FILE, the gzipped JSON document written by
+# `python manage.py openapi_schema` at build time, from memory with an ETag
+# and gzip (brotli when the module is installed) encoding. Without the file
+# each process generates the schema once. `manage.py check --deploy` and
+# `openapi_schema --check` flag a FILE that no longer matches the code.
+OPENAPI_SCHEMA = {
+    "FILE": env('OPENAPI_SCHEMA_FILE', default=str(BASE_DIR / 'openapi.json.gz')),
+    "MAX_AGE": env.int('OPENAPI_SCHEMA_MAX_AGE', default=300),
+}
+
 
 MIDDLEWARE = [
+    "users.metrics.RequestMetricsMiddleware",         # Request latency histograms
+    "users.routers.ReplicaRoutingMiddleware",         # Read replica routing state
+    "users.queries.QueryBudgetMiddleware",            # Per-request SQL query budget
     "corsheaders.middleware.CorsMiddleware",         # CORS Middleware
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -87,6 +108,64 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'auth_service.urls'
 
+# Service roles (users/startup.py)
+# SERVICE_ROLE picks what a process loads. "all" is everything, for
+# development and for running migrate and collectstatic. "api" serves the
+# JSON API only: no admin, sessions, messages or static files, JSON rendering
+# only, and none of the middleware a JWT-authenticated API does not use.
+# "worker" is for Celery: only the apps its tasks touch and no middleware.
+# API_DOCS serves the OpenAPI schema and UIs, by default only for "all".
+SERVICE_ROLE = env('SERVICE_ROLE', default='all')
+if SERVICE_ROLE not in ('all', 'api', 'worker'):
+    raise ImproperlyConfigured(f"SERVICE_ROLE must be all, api or worker, not {SERVICE_ROLE!r}")
+API_DOCS = env.bool('API_DOCS', default=SERVICE_ROLE == 'all')
+
+if SERVICE_ROLE != 'all':
+    INSTALLED_APPS = [app for app in INSTALLED_APPS if app not in (
+        'django.contrib.admin', 'django.contrib.sessions', 'django.contrib.messages', 'django.contrib.staticfiles',
+    )]
+    MIDDLEWARE = [middleware for middleware in MIDDLEWARE if middleware not in (
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.middleware.csrf.CsrfViewMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware',
+        'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    )]
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'] = ('rest_framework.renderers.JSONRenderer',)
+if SERVICE_ROLE == 'worker':
+    INSTALLED_APPS.remove('corsheaders')
+    MIDDLEWARE = []
+if not API_DOCS:
+    INSTALLED_APPS.remove('drf_spectacular')
+    del REST_FRAMEWORK['DEFAULT_SCHEMA_CLASS']
+
+# Prometheus metrics (users/metrics.py, served at /metrics)
+# With MULTIPROC_DIR every process writes its totals there every
+# FLUSH_INTERVAL seconds so one scrape covers all gunicorn/Celery workers on
+# the host. TOKEN is required as "Authorization: Bearer <token>"; without one
+# /metrics answers 401 unless DEBUG is on.
+METRICS = {
+    "MULTIPROC_DIR": env('METRICS_MULTIPROC_DIR', default=None),
+    "FLUSH_INTERVAL": env.float('METRICS_FLUSH_INTERVAL', default=5.0),
+    "TOKEN": env('METRICS_TOKEN', default=None),
+}
+
+# Serve login, token refresh, email verification and forgot-password with the
+# native async views in users/async_views.py. asgi.py turns this on; under
+# WSGI every request has its own thread anyway and the DRF views are used.
+ASYNC_VIEWS = env.bool('ASYNC_VIEWS', default=False)
+
+# SQL query budgets per URL name (users/queries.py, budgets in users/urls.py)
+# HEADER adds X-Query-Count/-Time/-Duplicates to every response. Recording
+# every query costs a wrapper call per statement, so it is off by default
+# outside DEBUG. STRICT turns an over-budget request into an error instead of
+# a log line (test runs).
+QUERY_BUDGET = {
+    "ENABLED": env.bool('QUERY_BUDGET_ENABLED', default=DEBUG),
+    "HEADER": env.bool('QUERY_BUDGET_HEADER', default=DEBUG),
+    "STRICT": env.bool('QUERY_BUDGET_STRICT', default=False),
+}
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -108,17 +187,61 @@ WSGI_APPLICATION = 'auth_service.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Connection pooling (psycopg 3 + psycopg_pool, one pool per process, web
+# and Celery workers alike). MIN_SIZE connections stay open and up to
+# MAX_SIZE are opened under load; a request waits at most TIMEOUT seconds
+# for a free one. Connections are replaced after MAX_LIFETIME seconds and
+# closed after MAX_IDLE seconds unused. With DB_POOL=false connections are
+# instead kept open for DB_CONN_MAX_AGE seconds per thread. Either way a
+# connection is health-checked before it is reused.
+DB_POOL = {
+    "ENABLED": env.bool('DB_POOL', default=True),
+    "MIN_SIZE": env.int('DB_POOL_MIN_SIZE', default=2),
+    "MAX_SIZE": env.int('DB_POOL_MAX_SIZE', default=10),
+    "TIMEOUT": env.float('DB_POOL_TIMEOUT', default=10.0),
+    "MAX_LIFETIME": env.float('DB_POOL_MAX_LIFETIME', default=1800.0),
+    "MAX_IDLE": env.float('DB_POOL_MAX_IDLE', default=300.0),
+}
+
 DATABASES = {
     'default': {
-       'ENGINE': 'django.db.backends.postgresql',
+        # django.db.backends.postgresql plus connection metrics (users/postgresql/)
+        'ENGINE': 'users.postgresql',
         'NAME': env('POSTGRES_DB', default=''),
         'USER': env('POSTGRES_USER', default=''),
         'PASSWORD': env('POSTGRES_PASSWORD', default=''),
         'HOST': env('POSTGRES_HOST', default='postgres'),
         'PORT': env.int('POSTGRES_PORT', default=5432),
+        # the pool does its own recycling, Django rejects both together
+        'CONN_MAX_AGE': 0 if DB_POOL["ENABLED"] else env.int('DB_CONN_MAX_AGE', default=600),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'pool': {
+                'min_size': DB_POOL["MIN_SIZE"],
+                'max_size': DB_POOL["MAX_SIZE"],
+                'timeout': DB_POOL["TIMEOUT"],
+                'max_lifetime': DB_POOL["MAX_LIFETIME"],
+                'max_idle': DB_POOL["MAX_IDLE"],
+            },
+        } if DB_POOL["ENABLED"] else {},
     }
 }
 
+# Read replicas (users/routers.py)
+# Each host in POSTGRES_REPLICA_HOSTS is added as replica_1, replica_2, ...
+# with the primary's credentials. Reads made while handling a request go to
+# a replica unless the request has already written or its user wrote in the
+# last STICKY_SECONDS; Celery tasks and commands always use the primary.
+for _number, _host in enumerate(env.list('POSTGRES_REPLICA_HOSTS', default=[]), 1):
+    DATABASES[f'replica_{_number}'] = {**DATABASES['default'], 'HOST': _host, 'TEST': {'MIRROR': 'default'}}
+
+READ_REPLICAS = {
+    "ALIASES": [alias for alias in DATABASES if alias.startswith('replica_')],
+    "STICKY_SECONDS": env.int('REPLICA_STICKY_SECONDS', default=5),
+}
+
+DATABASE_ROUTERS = ['users.routers.ReplicaRouter']
+
 
 REDIS_URL = env.str("REDIS_URL", default="redis://redis:6379/0")
 CACHES = {
@@ -131,6 +254,141 @@ CACHES = {
     }
 }
 
+# Two-tier user cache used by CachedJWTAuthentication (users/cache.py)
+# LOCAL_TTL bounds how long a process can serve a user after a missed
+# invalidation broadcast, TIMEOUT is the Redis entry lifetime (seconds).
+USER_CACHE = {
+    "LOCAL_MAXSIZE": env.int('USER_CACHE_LOCAL_MAXSIZE', default=10000),
+    "LOCAL_TTL": env.int('USER_CACHE_LOCAL_TTL', default=30),
+    "TIMEOUT": env.int('USER_CACHE_TIMEOUT', default=300),
+}
+
+# Refresh-token blacklist Bloom filter (users/blacklist.py)
+# Size the filter for the number of unexpired blacklisted tokens; a fuller
+# filter only costs extra cache lookups. REBUILD_INTERVAL is in seconds,
+# SYNC_INTERVAL (seconds) bounds how long a lost broadcast goes unnoticed.
+TOKEN_BLACKLIST = {
+    "CAPACITY": env.int('TOKEN_BLACKLIST_CAPACITY', default=1_000_000),
+    "ERROR_RATE": env.float('TOKEN_BLACKLIST_ERROR_RATE', default=0.001),
+    "REBUILD_INTERVAL": env.int('TOKEN_BLACKLIST_REBUILD_INTERVAL', default=3600),
+    "SYNC_INTERVAL": env.float('TOKEN_BLACKLIST_SYNC_INTERVAL', default=1.0),
+}
+
+# Batch token introspection (api/v1/auth/introspect/)
+# API_KEYS are sent by the gateway in X-Introspection-Key; with no keys
+# configured the endpoint rejects every request. CACHE_SECONDS bounds how
+# long a result is reused when an invalidation broadcast is lost.
+INTROSPECTION = {
+    "API_KEYS": env.list('INTROSPECTION_API_KEYS', default=[]),
+    "MAX_TOKENS": env.int('INTROSPECTION_MAX_TOKENS', default=100),
+    "CACHE_MAXSIZE": env.int('INTROSPECTION_CACHE_MAXSIZE', default=100000),
+    "CACHE_SECONDS": env.float('INTROSPECTION_CACHE_SECONDS', default=5.0),
+}
+
+# Bulk user import (manage.py import_users, api/v1/auth/users/import/)
+# HASH_WORKERS is the size of the hashing process pool, 0 = CPU count.
+BULK_IMPORT = {
+    "BATCH_SIZE": env.int('BULK_IMPORT_BATCH_SIZE', default=1000),
+    "HASH_WORKERS": env.int('BULK_IMPORT_HASH_WORKERS', default=0),
+}
+
+# Role policy (users/policy.py)
+# HIERARCHY lists the roles each role inherits: Admin passes every check
+# that Manager or HR passes. PERMISSIONS maps the names views list in
+# required_permissions to the roles granted them. FILE is an optional JSON
+# file with HIERARCHY and/or PERMISSIONS that replaces these and is re-read
+# when it changes, checked every RELOAD_INTERVAL seconds.
+ROLE_POLICY = {
+    "HIERARCHY": {
+        "Admin": ["Manager", "HR"],
+        "Manager": ["Technician"],
+    },
+    "PERMISSIONS": {
+        "users.import": ["Admin"],
+    },
+    "FILE": env('ROLE_POLICY_FILE', default=''),
+    "RELOAD_INTERVAL": env.int('ROLE_POLICY_RELOAD_INTERVAL', default=30),
+}
+
+# Email OTP storage (users/otp.py)
+# RedisOTPBackend keeps codes in CACHES["default"]'s Redis with a TTL;
+# DatabaseOTPBackend uses the EmailOTP table. AUDIT also records Redis
+# codes in EmailOTP (as digests); the purge then keeps those rows for
+# AUDIT_RETENTION_DAYS instead of deleting them once used or expired.
+OTP = {
+    "BACKEND": env('OTP_BACKEND', default='users.otp.RedisOTPBackend'),
+    "MAX_ATTEMPTS": env.int('OTP_MAX_ATTEMPTS', default=5),
+    "AUDIT": env.bool('OTP_AUDIT', default=False),
+    "AUDIT_RETENTION_DAYS": env.int('OTP_AUDIT_RETENTION_DAYS', default=90),
+}
+
+
+# Token-bucket throttling of the unauthenticated endpoints (users/throttling.py)
+# Rates are "<count>/<s|min|hour|day>" and are kept per client IP, per email
+# and per IP+email pair; an empty rate disables that bucket. With FAIL_OPEN
+# requests are allowed when Redis cannot be reached.
+THROTTLING = {
+    "RATES": {
+        "login": {
+            "ip": env('THROTTLE_LOGIN_IP', default='60/min'),
+            "email": env('THROTTLE_LOGIN_EMAIL', default='20/hour'),
+            "ip_email": env('THROTTLE_LOGIN_IP_EMAIL', default='5/min'),
+        },
+        "forgot_password": {
+            "ip": env('THROTTLE_FORGOT_PASSWORD_IP', default='10/min'),
+            "email": env('THROTTLE_FORGOT_PASSWORD_EMAIL', default='5/hour'),
+        },
+        "reset_password": {
+            "ip": env('THROTTLE_RESET_PASSWORD_IP', default='10/min'),
+        },
+        "verify_email": {
+            "ip": env('THROTTLE_VERIFY_EMAIL_IP', default='30/min'),
+            "email": env('THROTTLE_VERIFY_EMAIL_EMAIL', default='10/min'),
+        },
+    },
+    "FAIL_OPEN": env.bool('THROTTLE_FAIL_OPEN', default=True),
+}
+
+
+# Password hashing executor (users/hashing.py)
+# MAX_WORKERS defaults to the number of CPUs, MAX_QUEUE bounds jobs waiting
+# for a worker and QUEUE_TIMEOUT (seconds) is how long a request waits for a
+# queue slot before getting a 503.
+PASSWORD_HASHING = {
+    "MAX_WORKERS": env.int('PASSWORD_HASHING_MAX_WORKERS', default=0) or os.cpu_count() or 1,
+    "MAX_QUEUE": env.int('PASSWORD_HASHING_MAX_QUEUE', default=64),
+    "QUEUE_TIMEOUT": env.float('PASSWORD_HASHING_QUEUE_TIMEOUT', default=2.0),
+}
+
+# Password hashers (users/hashers.py)
+# PASSWORD_HASHER picks the hasher for new hashes; the others stay listed so
+# existing hashes still verify and get upgraded on login. Run
+# `python manage.py calibrate_hasher` to get parameters for this hardware,
+# 0 keeps Django's default.
+PASSWORD_HASHER = env('PASSWORD_HASHER', default='pbkdf2')
+
+PASSWORD_HASHER_PARAMS = {
+    "PBKDF2_ITERATIONS": env.int('PBKDF2_ITERATIONS', default=0),
+    "ARGON2_TIME_COST": env.int('ARGON2_TIME_COST', default=0),
+    "ARGON2_MEMORY_COST": env.int('ARGON2_MEMORY_COST', default=0),
+    "ARGON2_PARALLELISM": env.int('ARGON2_PARALLELISM', default=0),
+    "SCRYPT_WORK_FACTOR": env.int('SCRYPT_WORK_FACTOR', default=0),
+    "SCRYPT_BLOCK_SIZE": env.int('SCRYPT_BLOCK_SIZE', default=0),
+    "SCRYPT_PARALLELISM": env.int('SCRYPT_PARALLELISM', default=0),
+}
+
+_PASSWORD_HASHERS = {
+    "pbkdf2": "users.hashers.PBKDF2PasswordHasher",
+    "argon2": "users.hashers.Argon2PasswordHasher",
+    "scrypt": "users.hashers.ScryptPasswordHasher",
+}
+
+PASSWORD_HASHERS = [_PASSWORD_HASHERS[PASSWORD_HASHER]] + [
+    hasher for name, hasher in _PASSWORD_HASHERS.items() if name != PASSWORD_HASHER
+] + [
+    "django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher",
+    "django.contrib.auth.hashers.BCryptSHA256PasswordHasher",
+]
 
 
 # Password validation
@@ -169,11 +427,32 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=env.int('ACCESS_TOKEN_LIFETIME', default=5)),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=env.int('REFRESH_TOKEN_LIFETIME', default=1)),
-    'ROTATE_REFRESH_TOKENS': env.bool('ROTATE_REFRESH_TOKENS', default=False),
-    'BLACKLIST_AFTER_ROTATION': env.bool('BLACKLIST_AFTER_ROTATION', default=False),
+    'ROTATE_REFRESH_TOKENS': env.bool('ROTATE_REFRESH_TOKENS', default=True),
+    'BLACKLIST_AFTER_ROTATION': env.bool('BLACKLIST_AFTER_ROTATION', default=True),
     "AUTH_HEADER_TYPES": (env('AUTH_HEADER_TYPES', default='Bearer'),),
+    "AUTH_TOKEN_CLASSES": ("users.tokens.AccessToken",),
+    "ISSUER": env('JWT_ISSUER', default=None),
+}
+
+# Refresh-token families (users/families.py)
+# Refresh tokens issued at login start a family kept in Redis (process
+# memory without django-redis). Rotating one is a single compare-and-swap,
+# with no database writes; presenting an already rotated token revokes the
+# whole family, and logout revokes it with one DEL. BLACKLIST_AFTER_ROTATION
+# only applies to tokens issued before families were enabled.
+REFRESH_TOKEN_FAMILIES = {
+    "ENABLED": env.bool('REFRESH_TOKEN_FAMILIES', default=True),
 }
 
+# Asymmetric JWT signing (users/keys.py)
+# A directory of "<kid>.pem" RSA / Ed25519 private keys, created with
+# `python manage.py rotate_jwt_keys`. When set, tokens are signed RS256/EdDSA
+# with the active key and published at /.well-known/jwks.json; when empty
+# the symmetric SIMPLE_JWT settings above are used.
+JWT_KEYS_DIR = env('JWT_KEYS_DIR', default='')
+JWT_ACTIVE_KID = env('JWT_ACTIVE_KID', default='')
+JWKS_CACHE_SECONDS = env.int('JWKS_CACHE_SECONDS', default=300)
+
 
 # CORS Configuration
 CORS_ALLOWED_ORIGINS = env.list('CORS_ALLOWED_ORIGINS', default=['http://127.0.0.1:3000'])
@@ -198,3 +477,76 @@ CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = "Asia/Kolkata"
+# autodiscovery looks for users/tasks.py, the tasks live in users/task.py
+CELERY_IMPORTS = ("users.task",)
+
+# Batched mail delivery (users/mail.py)
+# Messages are flushed when BATCH_SIZE are waiting or every FLUSH_INTERVAL
+# seconds; FLUSH_INTERVAL = 0 sends on every enqueue (development). A batch
+# held by a worker that died is requeued LEASE_SECONDS after it was taken,
+# keep it well above the time one batch takes to send.
+MAIL_BATCH = {
+    "BATCH_SIZE": env.int('MAIL_BATCH_SIZE', default=100),
+    "FLUSH_INTERVAL": env.float('MAIL_FLUSH_INTERVAL', default=2.0),
+    "MAX_ATTEMPTS": env.int('MAIL_MAX_ATTEMPTS', default=5),
+    "LEASE_SECONDS": env.int('MAIL_LEASE_SECONDS', default=300),
+}
+
+# Write-behind for non-critical timestamps (users/writebehind.py)
+# Updates of FIELDS are buffered (Redis when CACHES["default"] is
+# django-redis, else process memory) and written with one bulk UPDATE per
+# BATCH_SIZE rows by the beat task every FLUSH_INTERVAL seconds, as soon as
+# a full batch is waiting, and at process exit. A value is at most about
+# FLUSH_INTERVAL seconds behind while beat runs. With ENABLED off every
+# update is written immediately.
+WRITE_BEHIND = {
+    "ENABLED": env.bool('WRITE_BEHIND', default=True),
+    "FIELDS": ["users.CustomUser.last_login"],
+    "BATCH_SIZE": env.int('WRITE_BEHIND_BATCH_SIZE', default=1000),
+    "FLUSH_INTERVAL": env.float('WRITE_BEHIND_FLUSH_INTERVAL', default=10.0),
+}
+
+# Transactional outbox for Celery (users/outbox.py)
+# Tasks queued inside a transaction are stored with it and published once it
+# commits, BATCH_SIZE per broker connection, by a background thread of the
+# process (BACKGROUND) or else inline in the commit hook. Beat publishes
+# anything left over every INTERVAL seconds. A message published twice is
+# run once if the second delivery arrives within DEDUPE_SECONDS (keep it
+# above the broker's visibility timeout).
+OUTBOX = {
+    "BATCH_SIZE": env.int('OUTBOX_BATCH_SIZE', default=100),
+    "BACKGROUND": env.bool('OUTBOX_BACKGROUND', default=True),
+    "INTERVAL": env.float('OUTBOX_INTERVAL', default=5.0),
+    "DEDUPE_SECONDS": env.int('OUTBOX_DEDUPE_SECONDS', default=24 * 3600),
+}
+
+# Purge of expired OTPs, reset tokens and outstanding JWTs (users/purge.py)
+# Rows are deleted CHUNK_SIZE at a time; after each chunk the purge sleeps
+# SLEEP_RATIO times the chunk's duration. A run gives up after MAX_SECONDS
+# and the next one picks up where it stopped.
+PURGE = {
+    "CHUNK_SIZE": env.int('PURGE_CHUNK_SIZE', default=1000),
+    "SLEEP_RATIO": env.float('PURGE_SLEEP_RATIO', default=1.0),
+    "MAX_SECONDS": env.float('PURGE_MAX_SECONDS', default=300.0),
+    "INTERVAL": env.float('PURGE_INTERVAL', default=3600.0),
+}
+
+CELERY_BEAT_SCHEDULE = {
+    "flush-mail-queue": {
+        "task": "users.task.flush_mail_queue",
+        "schedule": MAIL_BATCH["FLUSH_INTERVAL"] or 60.0,
+    },
+    "purge-expired-rows": {
+        "task": "users.task.purge_expired_rows",
+        "schedule": PURGE["INTERVAL"],
+    },
+    "flush-write-behind": {
+        "task": "users.task.flush_write_behind",
+        "schedule": WRITE_BEHIND["FLUSH_INTERVAL"],
+    },
+    "dispatch-outbox": {
+        "task": "users.task.dispatch_outbox",
+        "schedule": OUTBOX["INTERVAL"],
+    },
+}
+
@@ -1,17 +1,34 @@
-from django.contrib import admin
+from django.apps import apps
+from django.conf import settings
 from django.urls import path, include
-from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView, SpectacularRedocView
+
+from users.views import JWKSView, MetricsView
 
 urlpatterns = [
-    path('admin/', admin.site.urls),
+    # Public keys for local JWT verification
+    path('.well-known/jwks.json', JWKSView.as_view(), name='jwks'),
+
+    # Prometheus scrape endpoint
+    path('metrics', MetricsView.as_view(), name='metrics'),
 
     # API Version 1
     path('api/v1/', include(('users.urls', 'api'), namespace='v1')),
+]
 
+# Left out of the lean service roles, not even imported there
+if apps.is_installed('django.contrib.admin'):
+    from django.contrib import admin
 
-    # Swagger Documentation
-    path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
-    # Swagger UI:
-    path('api/schema/swagger-ui/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
-    path('api/schema/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
-]
+    urlpatterns.append(path('admin/', admin.site.urls))
+
+if settings.API_DOCS:
+    from drf_spectacular.views import SpectacularSwaggerView, SpectacularRedocView
+    from users.views import OpenAPISchemaView
+
+    urlpatterns += [
+        # Swagger Documentation, precomputed (users/schema.py)
+        path('api/schema/', OpenAPISchemaView.as_view(), name='schema'),
+        # Swagger UI:
+        path('api/schema/swagger-ui/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
+        path('api/schema/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
+    ]
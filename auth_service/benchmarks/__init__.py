@@ -0,0 +1,12 @@
+import os
+
+
+def setup():
+    """Configure Django for a benchmark run and create the schema."""
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+
+    import django
+    from django.core.management import call_command
+
+    django.setup()
+    call_command("migrate", run_syncdb=True, verbosity=0)
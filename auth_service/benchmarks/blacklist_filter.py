@@ -0,0 +1,67 @@
+"""
+Blacklist Bloom filter rebuild time and check cost.
+
+    python -m benchmarks.blacklist_filter --tokens 1000000
+
+Seeds --tokens blacklisted refresh tokens, then prints one JSON line with
+the rebuild time and the per-check latency for non-blacklisted JTIs.
+"""
+import argparse
+import json
+import time
+import uuid
+from datetime import timedelta
+
+from benchmarks import setup
+
+
+def seed(count):
+    from django.utils import timezone
+    from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+    expires_at = timezone.now() + timedelta(days=1)
+    missing = count - BlacklistedToken.objects.count()
+    while missing > 0:
+        size = min(missing, 20000)
+        outstanding = OutstandingToken.objects.bulk_create([
+            OutstandingToken(jti=uuid.uuid4().hex, token="", expires_at=expires_at) for _ in range(size)
+        ])
+        BlacklistedToken.objects.bulk_create([BlacklistedToken(token=token) for token in outstanding])
+        missing -= size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=100000)
+    parser.add_argument("--checks", type=int, default=10000)
+    args = parser.parse_args()
+
+    setup()
+
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from users.blacklist import token_blacklist
+
+    seed(args.tokens)
+
+    start = time.perf_counter()
+    token_blacklist.rebuild()
+    rebuild_seconds = time.perf_counter() - start
+
+    jtis = [uuid.uuid4().hex for _ in range(args.checks)]
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        for jti in jtis:
+            token_blacklist.is_blacklisted(jti)
+        check_seconds = time.perf_counter() - start
+
+    print(json.dumps({
+        "blacklisted_tokens": args.tokens,
+        "rebuild_seconds": round(rebuild_seconds, 3),
+        "check_us": round(check_seconds / args.checks * 1e6, 2),
+        "db_queries": len(queries.captured_queries),
+    }))
+
+
+if __name__ == "__main__":
+    main()
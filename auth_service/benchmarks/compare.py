@@ -0,0 +1,88 @@
+"""
+Compare two benchmarks.load reports.
+
+    python -m benchmarks.compare baseline.json run.json --threshold 10
+
+Prints one row per scenario and concurrency level and exits with status 1
+when the second run is worse than the first by more than --threshold
+percent in throughput or p95 latency, or runs more queries per request.
+"""
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as fh:
+        report = json.load(fh)
+    return report["meta"], {(row["scenario"], row["concurrency"]): row for row in report["results"]}
+
+
+def change(old, new):
+    if not old:
+        return 0.0
+    return (new - old) / old * 100
+
+
+def compare(baseline, candidate, threshold):
+    """Return (rows, regressions) for the scenarios present in both reports."""
+    rows = []
+    regressions = []
+    for key in sorted(baseline.keys() & candidate.keys()):
+        old, new = baseline[key], candidate[key]
+        throughput = change(old["throughput_rps"], new["throughput_rps"])
+        p95 = change(old["p95_ms"], new["p95_ms"])
+        queries = new["queries_per_request"] - old["queries_per_request"]
+
+        problems = []
+        if throughput < -threshold:
+            problems.append(f"throughput {throughput:+.1f}%")
+        if p95 > threshold:
+            problems.append(f"p95 {p95:+.1f}%")
+        if queries > 0:
+            problems.append(f"queries {queries:+.2f}")
+        if new["errors"] > old["errors"]:
+            problems.append(f"errors {old['errors']} -> {new['errors']}")
+        if problems:
+            regressions.append((key, problems))
+
+        rows.append((key, old, new, throughput, p95, queries, problems))
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Allowed slowdown in percent.")
+    args = parser.parse_args()
+
+    old_meta, baseline = load(args.baseline)
+    new_meta, candidate = load(args.candidate)
+    for field in ("database", "cpus", "password_hasher"):
+        if old_meta.get(field) != new_meta.get(field):
+            print(f"warning: {field} differs ({old_meta.get(field)} vs {new_meta.get(field)})")
+
+    rows, regressions = compare(baseline, candidate, args.threshold)
+    print(f"{'scenario':<18}{'conc':>5}{'rps':>18}{'p95 ms':>22}{'queries':>14}")
+    for (scenario, concurrency), old, new, throughput, p95, queries, problems in rows:
+        print(
+            f"{scenario:<18}{concurrency:>5}"
+            f"{old['throughput_rps']:>9.1f} {throughput:+7.1f}%"
+            f"{old['p95_ms']:>12.2f} {p95:+8.1f}%"
+            f"{new['queries_per_request']:>8.2f} {queries:+5.2f}"
+            + ("  REGRESSION" if problems else "")
+        )
+
+    for key in sorted(baseline.keys() ^ candidate.keys()):
+        print(f"only in one run: {key[0]} at concurrency {key[1]}")
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold}%:")
+        for (scenario, concurrency), problems in regressions:
+            print(f"  {scenario} @ {concurrency}: {', '.join(problems)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+Load test for the auth endpoints, driven in-process through the Django test
+client against SQLite (or Postgres with BENCH_DB=postgres), a local-memory
+cache and eager Celery.
+
+    python -m benchmarks.load --users 2000 --requests 200 --concurrency 1 8 32 --output run.json
+    python -m benchmarks.compare baseline.json run.json
+
+Users are seeded with one precomputed password hash. Every scenario's
+requests are prepared (tokens minted, OTPs issued) before the clock starts,
+so only the request itself is timed. Eager Celery means queued tasks run
+inside the request and count towards its latency and queries. Set
+PBKDF2_ITERATIONS to time the endpoints without the production hash cost.
+
+With --asgi the same workload goes through the ASGI handler (AsyncClient,
+ASYNC_VIEWS on) from one event loop, with --concurrency requests in flight,
+so a WSGI and an ASGI report can be diffed with benchmarks.compare.
+
+Against Postgres, connect_ms_per_request is the time spent opening (or,
+with DB_POOL, checking out) connections; compare DB_POOL=false
+DB_CONN_MAX_AGE=0 with the default pool to see the reconnect cost.
+
+WRITE_BEHIND=true buffers last_login instead of updating it on every
+login; the buffer is flushed after each scenario and the flush reported as
+write_behind_flush_ms and write_behind_rows.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from benchmarks import setup
+
+
+PASSWORD = "Bench-password-1"
+SCENARIOS = [
+    "register", "verify-email", "login", "refresh", "logout",
+    "change-password", "forgot-password", "reset-password",
+]
+
+
+def seed(User, prefix, count, password_hash, is_active):
+    """Bulk insert ``count`` users named <prefix>-<n>@bench.local, return them."""
+    emails = [f"{prefix}-{n}@bench.local" for n in range(count)]
+    User.objects.bulk_create(
+        [
+            User(email=email, first_name="Bench", last_name=str(n), password=password_hash, is_active=is_active)
+            for n, email in enumerate(emails)
+        ],
+        batch_size=5000,
+        ignore_conflicts=True,
+    )
+    # bulk_create(ignore_conflicts=True) does not return primary keys
+    users = {user.email: user for user in User.objects.filter(email__in=emails)}
+    return [users[email] for email in emails]
+
+
+# Request builders: each returns (method, url name, body, extra headers)
+class Workload:
+    def __init__(self, users, inactive_users, run_id):
+        self.users = users
+        self.inactive_users = inactive_users
+        self.run_id = run_id
+
+    def bearer(self, refresh):
+        return {"HTTP_AUTHORIZATION": f"Bearer {refresh.access_token}"}
+
+    def build(self, scenario, count):
+        from users import otp
+        from users.models import PasswordResetToken
+        from users.tokens import RefreshToken
+
+        requests = []
+        for n in range(count):
+            user = self.users[n]
+            if scenario == "register":
+                requests.append(("post", "register", {
+                    "email": f"bench-new-{self.run_id}-{n}@bench.local",
+                    "first_name": "Bench", "last_name": "New", "password": PASSWORD,
+                }, {}))
+            elif scenario == "verify-email":
+                inactive = self.inactive_users[n]
+                code = otp.issue(inactive)
+                requests.append(("get", "verify-email", {"email": inactive.email, "code": code}, {}))
+            elif scenario == "login":
+                requests.append(("post", "login", {"email": user.email, "password": PASSWORD}, {}))
+            elif scenario == "refresh":
+                requests.append(("post", "token-refresh", {"refresh": str(RefreshToken.for_user(user))}, {}))
+            elif scenario == "logout":
+                refresh = RefreshToken.for_user(user)
+                requests.append(("post", "logout", {"refresh": str(refresh)}, self.bearer(refresh)))
+            elif scenario == "change-password":
+                requests.append(("post", "change-password", {
+                    "old_password": PASSWORD, "new_password": PASSWORD, "confirm_new_password": PASSWORD,
+                }, self.bearer(RefreshToken.for_user(user))))
+            elif scenario == "forgot-password":
+                requests.append(("post", "forgot-password", {"email": user.email}, {}))
+            elif scenario == "reset-password":
+                raw_token, _ = PasswordResetToken.generate(user)
+                requests.append(("post", "reset-password", {
+                    "token": raw_token, "password": PASSWORD, "confirm_password": PASSWORD,
+                }, {}))
+        return requests
+
+
+def percentile(sorted_samples, fraction):
+    index = max(int(round(fraction * len(sorted_samples))) - 1, 0)
+    return sorted_samples[index]
+
+
+def drive(requests, concurrency):
+    """Send ``requests`` from ``concurrency`` threads, return per-request samples and wall time."""
+    from django.test import Client
+    from django.urls import reverse
+    from users.queries import QueryRecorder
+
+    local = threading.local()
+
+    def send(request):
+        method, name, body, headers = request
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = Client()
+
+        with QueryRecorder(deferred=True) as recorder:
+            start = time.perf_counter()
+            response = client.generic(
+                method.upper(), reverse(f"v1:{name}"), json.dumps(body),
+                content_type="application/json", **headers,
+            )
+            elapsed = time.perf_counter() - start
+        return elapsed, recorder.count, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(send, requests))
+    return samples, time.perf_counter() - start
+
+
+def drive_asgi(requests, concurrency):
+    """Like drive(), but ``concurrency`` requests in flight on one event loop."""
+    from asgiref.sync import sync_to_async
+    from django.test import AsyncClient
+    from django.urls import reverse
+    from users.queries import QueryRecorder
+
+    async def run():
+        client = AsyncClient()
+        limit = asyncio.Semaphore(concurrency)
+
+        async def send(request):
+            method, name, body, headers = request
+            async with limit:
+                # queries of overlapping requests cannot be told apart, count them per request anyway
+                recorder = QueryRecorder(deferred=True)
+                await sync_to_async(recorder.__enter__)()
+                start = time.perf_counter()
+                response = await client.generic(
+                    method.upper(), reverse(f"v1:{name}"), json.dumps(body),
+                    content_type="application/json", **headers,
+                )
+                elapsed = time.perf_counter() - start
+                await sync_to_async(recorder.__exit__)(None, None, None)
+            return elapsed, recorder.count, response.status_code
+
+        return await asyncio.gather(*(send(request) for request in requests))
+
+    start = time.perf_counter()
+    samples = asyncio.run(run())
+    return samples, time.perf_counter() - start
+
+
+def summarize(scenario, concurrency, samples, wall):
+    latencies = sorted(elapsed * 1000 for elapsed, _, _ in samples)
+    queries = [count for _, count, _ in samples]
+    errors = sum(1 for _, _, status in samples if status >= 400)
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": errors,
+        "throughput_rps": round(len(samples) / wall, 2),
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "queries_per_request": round(statistics.fmean(queries), 2),
+        "max_queries": max(queries),
+    }
+
+
+def connect_ms(snapshot, requests):
+    """Connection acquire time per request from users.metrics, None when not recorded (SQLite)."""
+    timings = [
+        timing for name, timing in snapshot["timings"].items()
+        if name.startswith("db_connection_acquire_seconds")
+    ]
+    if not timings:
+        return None
+    return round(sum(timing["sum"] for timing in timings) * 1000 / requests, 3)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="Seeded users, raised to --requests if lower.")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per scenario and concurrency level.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--output", help="Also write the full report, with run metadata, to this file.")
+    parser.add_argument("--asgi", action="store_true", help="Serve through the ASGI handler and the async views.")
+    args = parser.parse_args()
+
+    if args.asgi:
+        os.environ["ASYNC_VIEWS"] = "true"
+    # queries are reported per request, not held to the budgets
+    os.environ.setdefault("QUERY_BUDGET_STRICT", "false")
+    setup()
+    logging.getLogger("users.queries").setLevel(logging.ERROR)
+
+    from django.conf import settings
+    from django.contrib.auth import get_user_model
+    from django.db import connection
+    from users import hashing, metrics, writebehind
+
+    User = get_user_model()
+    count = max(args.users, args.requests)
+    password_hash = hashing.make_password(PASSWORD)
+    started = time.perf_counter()
+    users = seed(User, "bench-user", count, password_hash, is_active=True)
+    inactive_users = []
+    if "verify-email" in args.scenarios:
+        User.objects.filter(email__startswith="bench-inactive-").update(is_active=False)
+        inactive_users = seed(User, "bench-inactive", args.requests, password_hash, is_active=False)
+    seed_seconds = time.perf_counter() - started
+
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
+    results = []
+    for concurrency in args.concurrency:
+        for scenario in args.scenarios:
+            if scenario == "verify-email":
+                User.objects.filter(pk__in=[user.pk for user in inactive_users]).update(is_active=False)
+            workload = Workload(users, inactive_users, f"{run_id}-{concurrency}")
+            requests = workload.build(scenario, args.requests)
+            metrics.reset()
+            samples, wall = (drive_asgi if args.asgi else drive)(requests, concurrency)
+            result = summarize(scenario, concurrency, samples, wall)
+            result["connect_ms_per_request"] = connect_ms(metrics.snapshot(), len(samples))
+            if settings.WRITE_BEHIND["ENABLED"]:
+                started = time.perf_counter()
+                result["write_behind_rows"] = writebehind.flush()
+                result["write_behind_flush_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            results.append(result)
+            print(json.dumps(result), flush=True)
+
+    report = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "git_revision": git_revision(),
+            "database": connection.vendor,
+            "server": "asgi" if args.asgi else "wsgi",
+            "db_pool": connection.settings_dict["OPTIONS"].get("pool"),
+            "conn_max_age": connection.settings_dict["CONN_MAX_AGE"],
+            "write_behind": settings.WRITE_BEHIND["ENABLED"],
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "password_hasher": settings.PASSWORD_HASHERS[0],
+            "users": count,
+            "seed_seconds": round(seed_seconds, 3),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Cost of a role permission check: the old list scan against the compiled
+bitmask policy.
+
+    python -m benchmarks.policy --iterations 1000000
+
+Prints one JSON line per check with nanoseconds per call.
+"""
+import argparse
+import json
+import timeit
+
+from benchmarks import setup
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    setup()
+
+    from rest_framework.permissions import BasePermission
+    from users.authentication import TokenPrincipal
+    from users.permission import HasPermissions, IsManager
+    from users.policy import get_policy
+
+    # RolePermission before the policy engine, with Admin listed explicitly
+    class ListScanIsManager(BasePermission):
+        allowed_roles = ["Admin", "Manager"]
+
+        def has_permission(self, request, view):
+            user = request.user
+            if not user or not user.is_authenticated:
+                return False
+            roles = getattr(view, "allowed_roles", self.allowed_roles)
+            if not roles:
+                return False
+            return user.role in roles
+
+    class Request:
+        user = TokenPrincipal("1", "Admin", True, None)
+
+    class View:
+        pass
+
+    class ImportView:
+        required_permissions = ("users.import",)
+
+    request = Request()
+    allowed_roles = ["Admin", "Manager"]
+    policy = get_policy()
+    manager_mask = policy.mask(("Manager",))
+    checks = {
+        "list_scan": lambda: request.user.role in allowed_roles,
+        "bitmask": lambda: policy.allows_any(request.user.role, manager_mask),
+        "ListScanIsManager.has_permission": lambda: ListScanIsManager().has_permission(request, View),
+        "IsManager.has_permission": lambda: IsManager().has_permission(request, View),
+        "HasPermissions.has_permission": lambda: HasPermissions().has_permission(request, ImportView),
+    }
+
+    for name, check in checks.items():
+        assert check()
+        seconds = min(timeit.repeat(check, number=args.iterations, repeat=5))
+        print(json.dumps({"check": name, "ns_per_call": round(seconds / args.iterations * 1e9, 1)}), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Password-reset lookup latency against a growing number of outstanding tokens.
+
+    python -m benchmarks.reset_token --sizes 10 1000 100000 1000000
+
+Prints one JSON line per size; latency should stay flat as the table grows.
+"""
+import argparse
+import json
+import secrets
+import statistics
+import time
+
+from benchmarks import setup
+
+
+def seed(PasswordResetToken, user, count):
+    existing = PasswordResetToken.objects.count()
+    batch = []
+    for _ in range(max(count - existing, 0)):
+        batch.append(PasswordResetToken(
+            user=user,
+            selector=secrets.token_hex(8),
+            token_hash=PasswordResetToken.hash_verifier(secrets.token_urlsafe(32)),
+        ))
+        if len(batch) >= 10000:
+            PasswordResetToken.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        PasswordResetToken.objects.bulk_create(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100000])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    setup()
+
+    from django.contrib.auth import get_user_model
+    from users.models import PasswordResetToken
+
+    User = get_user_model()
+    user, _ = User.objects.get_or_create(email="bench-reset@example.com")
+    # a separate user so generate() does not mark the seeded tokens used
+    target, _ = User.objects.get_or_create(email="bench-reset-target@example.com")
+    PasswordResetToken.objects.all().delete()
+
+    for size in sorted(args.sizes):
+        seed(PasswordResetToken, user, size)
+        raw_token, token_obj = PasswordResetToken.generate(target)
+
+        samples = []
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            matched = PasswordResetToken.lookup(raw_token)
+            samples.append((time.perf_counter() - start) * 1000)
+            assert matched is not None and matched.pk == token_obj.pk
+
+        samples.sort()
+        print(json.dumps({
+            "outstanding_tokens": PasswordResetToken.objects.filter(used=False).count(),
+            "iterations": args.iterations,
+            "p50_ms": round(statistics.median(samples), 4),
+            "p99_ms": round(samples[int(len(samples) * 0.99) - 1], 4),
+        }))
+
+
+if __name__ == "__main__":
+    main()
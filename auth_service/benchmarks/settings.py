@@ -0,0 +1,48 @@
+# Settings for benchmarks and local test runs.
+# Uses SQLite (or the regular Postgres settings with BENCH_DB=postgres),
+# a local-memory cache and eager Celery so no broker/redis is needed.
+from auth_service.settings import *  # noqa: F401,F403
+from auth_service.settings import BASE_DIR, env
+
+
+if env("BENCH_DB", default="sqlite") == "sqlite":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": env("BENCH_SQLITE_NAME", default=str(BASE_DIR / "bench.sqlite3")),
+            # concurrent load runs wait for the write lock instead of failing
+            "OPTIONS": {"timeout": 30},
+        },
+        # a second database for the replica router tests, not routed to here
+        "replica": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": env("BENCH_SQLITE_REPLICA_NAME", default=str(BASE_DIR / "bench-replica.sqlite3")),
+        },
+    }
+    READ_REPLICAS = {**READ_REPLICAS, "ALIASES": []}  # noqa: F405
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
+EMAIL_BACKEND = "django.core.mail.backends.locmem.EmailBackend"
+
+CELERY_TASK_ALWAYS_EAGER = True
+CELERY_TASK_EAGER_PROPAGATES = True
+
+# No beat and no redis here
+MAIL_BATCH = {**MAIL_BATCH, "FLUSH_INTERVAL": 0}  # noqa: F405
+# Written through unless a load run asks for it: nothing flushes a test's buffer
+WRITE_BEHIND = {**WRITE_BEHIND, "ENABLED": env.bool("WRITE_BEHIND", default=False)}  # noqa: F405
+# Eager tasks run in the commit hook, where a test can see them
+OUTBOX = {**OUTBOX, "BACKGROUND": False}  # noqa: F405
+OTP = {**OTP, "BACKEND": "users.otp.DatabaseOTPBackend"}  # noqa: F405
+# Load runs come from a single client address, through the test client
+ALLOWED_HOSTS = [*ALLOWED_HOSTS, "testserver"]  # noqa: F405
+THROTTLING = {**THROTTLING, "RATES": {}}  # noqa: F405
+# Every request of a test run is held to its query budget; load runs only count
+QUERY_BUDGET = {  # noqa: F405
+    **QUERY_BUDGET, "ENABLED": True, "STRICT": env.bool("QUERY_BUDGET_STRICT", default=True),  # noqa: F405
+}
@@ -0,0 +1,34 @@
+# gunicorn settings, read from the working directory (gunicorn auth_service.wsgi)
+# The app is imported once in the master and its heap frozen before the
+# workers are forked, see users/startup.py. The collector stays off in the
+# master so nothing touches those pages before the freeze; workers turn it
+# back on.
+import gc
+import os
+
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "4"))
+preload_app = True
+
+gc.disable()
+
+
+def when_ready(server):
+    from users import startup
+
+    startup.preload()
+
+
+def post_fork(server, worker):
+    from users import startup
+
+    gc.enable()
+    startup.start_background()
+
+
+def child_exit(server, worker):
+    from users import metrics
+
+    # fold the worker's metrics file into the archive before its pid is reused
+    metrics.mark_process_dead(worker.pid)
@@ -15,7 +15,7 @@ class EmailOTPInline(admin.TabularInline):
 class PasswordResetTokenInline(admin.TabularInline):
     model = PasswordResetToken
     extra = 0
-    readonly_fields = ("token_hash", "created_at", "used")
+    readonly_fields = ("selector", "token_hash", "created_at", "used")
 
 
 # Register your custom user model with the admin site
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class UsersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'users'
+
+    def ready(self):
+        from . import checks, policy, signals  # noqa: F401
+
+        # Fail at startup, not on the first request, when the policy is invalid
+        policy.load()
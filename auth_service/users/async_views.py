@@ -0,0 +1,196 @@
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.http import JsonResponse
+from django.utils import timezone
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions, serializers, status
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.request import Request
+from rest_framework.settings import api_settings as drf_settings
+from rest_framework_simplejwt.exceptions import TokenError
+
+from users import hashing, metrics, otp, routers, writebehind
+from users.serializers import ForgotPasswordSerializer, LoginSerializer, TokenRefreshSerializer, VerifyOTPSerializer
+from users.task import flush_write_behind, send_password_reset_email
+from users.throttling import ForgotPasswordThrottle, LoginThrottle, VerifyEmailThrottle
+from users.tokens import RefreshToken
+from users.views import use_otp_budget
+
+
+User = get_user_model()
+
+
+# Async counterparts of the hot unauthenticated views, routed instead of the
+# DRF views when settings.ASYNC_VIEWS is on (the default under asgi.py).
+# They accept the same input and return the same bodies and status codes;
+# DB access uses the async ORM, hashing runs on the hashing executor and
+# anything still sync-only, Redis included, is pushed through sync_to_async.
+# Calls that only touch Redis use thread_sensitive=False, so they run on the
+# default executor instead of queueing behind the ORM's single thread.
+class AsyncAPIView(View):
+    serializer_class = None
+    throttle_classes = ()
+    parser_classes = (JSONParser, FormParser, MultiPartParser)
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Token auth, not cookies, like DRF's APIView
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            return await super().dispatch(request, *args, **kwargs)
+        except exceptions.APIException as exc:
+            return self.handle_exception(exc)
+
+    def check_throttles(self, drf_request):
+        for throttle_class in self.throttle_classes:
+            throttle = throttle_class()
+            if not throttle.allow_request(drf_request, self):
+                raise exceptions.Throttled(throttle.wait())
+
+    async def initial(self, request):
+        """Wrap the request for DRF parsers and run throttles, before any DB or hash work."""
+        drf_request = Request(request, parsers=[parser() for parser in self.parser_classes])
+        if self.throttle_classes:
+            # the token buckets are a Redis script
+            await sync_to_async(self.check_throttles, thread_sensitive=False)(drf_request)
+        return drf_request
+
+    async def validate_fields(self, request):
+        # Field validation only, the view does the database-backed part itself
+        drf_request = await self.initial(request)
+        return self.serializer_class().to_internal_value(drf_request.data)
+
+    @staticmethod
+    def invalid(message):
+        return serializers.ValidationError({drf_settings.NON_FIELD_ERRORS_KEY: [message]})
+
+    def handle_exception(self, exc):
+        detail = exc.detail
+        data = detail if isinstance(detail, (dict, list)) else {"detail": detail}
+        response = JsonResponse(data, status=exc.status_code, safe=False)
+        if getattr(exc, "wait", None):
+            response["Retry-After"] = str(exc.wait)
+        return response
+
+
+# Login View to obtain JWT tokens
+class AsyncUserLoginView(AsyncAPIView):
+    serializer_class = LoginSerializer
+    throttle_classes = [LoginThrottle]
+
+    async def post(self, request, *args, **kwargs):
+        attrs = await self.validate_fields(request)
+        password = attrs["password"]
+
+        routers.set_lookup(User, attrs["email"])
+        try:
+            user = await User.objects.aget(email=attrs["email"])
+        except User.DoesNotExist:
+            metrics.incr("login_total", result="unknown_user")
+            raise self.invalid("Invalid email or password.")
+
+        if not await hashing.acheck_password(password, user.password):
+            metrics.incr("login_total", result="bad_password")
+            raise self.invalid("Invalid email or password.")
+
+        if not user.is_active:
+            metrics.incr("login_total", result="inactive")
+            raise self.invalid("User account is not active.")
+
+        metrics.incr("login_total", result="success")
+        hashing.schedule_rehash(user, password)
+
+        refresh = await RefreshToken.afor_user(user)
+
+        if await writebehind.arecord(user, "last_login", timezone.now()):
+            await sync_to_async(flush_write_behind.delay)()
+
+        return JsonResponse(
+            {
+                "refresh": str(refresh),
+                "access": str(refresh.access_token),
+                "email": user.email,
+                "detail": "Login Successful."
+            },
+            status=status.HTTP_200_OK
+        )
+
+
+# Token Refresh View
+# Same work as TokenRefreshSerializer.token_data(), which it runs in a thread:
+# rotation and the blacklist check are blocking Redis (or, for tokens
+# without a family, database) calls.
+class AsyncTokenRefreshView(AsyncAPIView):
+    serializer_class = TokenRefreshSerializer
+
+    async def post(self, request, *args, **kwargs):
+        attrs = await self.validate_fields(request)
+
+        try:
+            data = await sync_to_async(TokenRefreshSerializer.token_data)(attrs["refresh"])
+        except TokenError:
+            return JsonResponse(
+                {"detail": "Invalid or expired refresh token."},
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        return JsonResponse(data, status=status.HTTP_200_OK)
+
+
+# API view for email verification
+class AsyncVerifyEmailView(AsyncAPIView):
+    serializer_class = VerifyOTPSerializer
+    throttle_classes = [VerifyEmailThrottle]
+
+    async def get(self, request, *args, **kwargs):
+        use_otp_budget()
+        attrs = await self.validate_fields(request)
+
+        routers.set_lookup(User, attrs["email"])
+        try:
+            user = await User.objects.aget(email=attrs["email"])
+        except User.DoesNotExist:
+            raise serializers.ValidationError({"email": ["User with this email does not exist."]})
+        routers.set_user(user.pk)
+
+        # verify and consume the OTP in one step
+        result = await sync_to_async(otp.verify)(user, attrs["code"])
+
+        if result == otp.EXPIRED:
+            raise serializers.ValidationError({"code": ["OTP code has expired."]})
+        if result == otp.LOCKED:
+            raise serializers.ValidationError({"code": ["Too many failed attempts, request a new OTP code."]})
+        if result != otp.VALID:
+            raise serializers.ValidationError({"code": ["Invalid OTP code."]})
+
+        user.is_active = True
+        await user.asave(update_fields=["is_active", "updated_at"])
+
+        return JsonResponse(
+            {"detail": "Your Email verified successfully."},
+            status=status.HTTP_200_OK
+        )
+
+
+# Forgot Password
+class AsyncForgotPasswordView(AsyncAPIView):
+    serializer_class = ForgotPasswordSerializer
+    throttle_classes = [ForgotPasswordThrottle]
+
+    async def post(self, request, *args, **kwargs):
+        attrs = await self.validate_fields(request)
+
+        routers.set_lookup(User, attrs["email"])
+        user = await User.objects.filter(email=attrs["email"]).afirst()
+        if user is None:
+            raise serializers.ValidationError({"email": ["No User Associated with this Email."]})
+
+        # publishing to the broker (or running eagerly) is blocking I/O
+        await sync_to_async(send_password_reset_email.delay)(user.id)
+
+        return JsonResponse(
+            {"message": "Password reset link sent to your email."},
+            status=status.HTTP_200_OK
+        )
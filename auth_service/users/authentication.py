@@ -0,0 +1,82 @@
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from . import routers
+from .cache import user_cache
+
+
+# JWTAuthentication that resolves the user through the two-tier user cache
+# instead of a CustomUser SELECT on every request
+class CachedJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_("Token contained no recognizable user identification")) from e
+
+        routers.set_user(user_id)
+        user = user_cache.get(user_id)
+        if user is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+        return user
+
+
+# request.user for StatelessJWTAuthentication: the access token's claims,
+# nothing loaded. Enough for RolePermission and anything else that only
+# needs the id, role or active flag; get_user() loads the full row.
+class TokenPrincipal:
+    __slots__ = ("id", "role", "is_active", "version")
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, id, role, is_active, version):
+        self.id = id
+        self.role = role
+        self.is_active = is_active
+        self.version = version
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __str__(self):
+        return f"TokenPrincipal {self.id}"
+
+    def get_user(self):
+        return user_cache.get(self.id)
+
+
+# Authentication for views gated only by role: trusts the role, is_active and
+# ver claims set by RefreshToken.set_user_claims(), so authenticating and the
+# permission check cost no queries or cache lookups. A role change or
+# deactivation shows up when the access token is next refreshed, at most
+# ACCESS_TOKEN_LIFETIME later. Tokens issued without the claims fall back
+# to the cached user.
+class StatelessJWTAuthentication(CachedJWTAuthentication):
+    def get_user(self, validated_token):
+        payload = validated_token.payload
+        if "role" not in payload or "is_active" not in payload:
+            return super().get_user(validated_token)
+
+        try:
+            user_id = payload[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_("Token contained no recognizable user identification")) from e
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not payload["is_active"]:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        routers.set_user(user_id)
+        return TokenPrincipal(user_id, payload["role"], payload["is_active"], payload.get("ver"))
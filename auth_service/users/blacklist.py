@@ -0,0 +1,315 @@
+from hashlib import blake2b
+import logging
+import math
+import os
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+from . import broadcast, metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hash_count = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        # Kirsch-Mitzenmacher double hashing over one blake2b digest
+        digest = blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hash_count)]
+
+    def add(self, item):
+        self.update((item,))
+
+    def update(self, items):
+        # Hot loop of rebuild(), kept flat with locals
+        bits, size, hash_count = self.bits, self.size, self.hash_count
+        from_bytes = int.from_bytes
+        for item in items:
+            digest = blake2b(item.encode(), digest_size=16).digest()
+            position = from_bytes(digest[:8], "little") % size
+            step = (from_bytes(digest[8:], "little") | 1) % size
+            for _ in range(hash_count):
+                bits[position >> 3] |= 1 << (position & 7)
+                position = (position + step) % size
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+# Refresh-token blacklist with a Bloom filter fast path.
+# A JTI that is not in the filter is not blacklisted: no Redis, no DB.
+# Possible hits are confirmed against a per-JTI cache key that lives for the
+# token's remaining lifetime; the token_blacklist tables are only written for
+# audit and read when the cache has no answer.
+# start() runs a thread that builds the filter and rebuilds it every
+# REBUILD_INTERVAL seconds, or as soon as it stops being trusted; serving
+# processes call it once after they are forked (users/startup.py). Until the
+# filter is ready, or in a process that never started it, every check goes
+# to the cache.
+# Broadcasts are best-effort, so add() also increments a generation counter
+# in the cache and every message carries its generation. At most every
+# SYNC_INTERVAL seconds a process compares the counter with the generations
+# it has received; while it is behind, or after the listener reconnected,
+# misses are not trusted and go to the cache as well, and a gap still open
+# after MISSED_AFTER seconds means a message was lost and forces a rebuild.
+class TokenBlacklist:
+    CHANNEL = "token-blacklist"
+    GENERATION_KEY = "auth:blacklist:generation"
+    BLACKLISTED = 1
+    NOT_BLACKLISTED = 0
+    MISSED_AFTER = 5
+
+    def __init__(self, capacity, error_rate, rebuild_interval, sync_interval=1.0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self.sync_interval = sync_interval
+        self._filter = None
+        self._filter_pid = None
+        self._rebuilder_pid = None
+        self._wakeup = threading.Event()
+        self._pending = None
+        # generations up to _generation are in the filter, _received holds later ones
+        self._generation = 0
+        self._received = set()
+        self._trusted = False
+        self._synced_at = None
+        self._behind_since = None
+        self._lock = threading.Lock()
+        broadcast.subscribe(self.CHANNEL, self._on_message)
+
+    @staticmethod
+    def _key(jti):
+        return f"auth:blacklist:{jti}"
+
+    def _receive(self, generation):
+        # under self._lock
+        if generation is None or generation <= self._generation:
+            return
+        self._received.add(generation)
+        while self._generation + 1 in self._received:
+            self._generation += 1
+            self._received.discard(self._generation)
+
+    def _on_message(self, message):
+        if message is None:
+            # Messages may have been lost, the filter is not used until rebuilt
+            self.invalidate()
+            return
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(message["jti"])
+                self._receive(message["generation"])
+            if self._pending is not None:
+                self._pending.append(message)
+
+    def current_generation(self):
+        return cache.get(self.GENERATION_KEY, 0)
+
+    def _next_generation(self):
+        try:
+            return cache.incr(self.GENERATION_KEY)
+        except ValueError:
+            cache.add(self.GENERATION_KEY, 0, timeout=None)
+            return cache.incr(self.GENERATION_KEY)
+
+    # Filter management
+    def rebuild(self):
+        start = time.perf_counter()
+        with self._lock:
+            self._pending = []
+        # read before the table: every later add() arrives as a message or
+        # shows up as a gap
+        generation = self.current_generation()
+
+        bloom = BloomFilter(self.capacity, self.error_rate)
+        jtis = BlacklistedToken.objects.filter(
+            token__expires_at__gt=timezone.now()
+        ).values_list("token__jti", flat=True)
+
+        count = 0
+        chunk = []
+        for jti in jtis.iterator(chunk_size=20000):
+            chunk.append(jti)
+            if len(chunk) >= 20000:
+                bloom.update(chunk)
+                count += len(chunk)
+                chunk = []
+        bloom.update(chunk)
+        count += len(chunk)
+
+        # Tokens blacklisted while we were reading the table
+        with self._lock:
+            bloom.update(message["jti"] for message in self._pending)
+            self._generation = generation
+            self._received = set()
+            for message in self._pending:
+                self._receive(message["generation"])
+            self._pending = None
+            self._filter = bloom
+            self._filter_pid = os.getpid()
+            self._synced_at = None
+            self._behind_since = None
+
+        elapsed = time.perf_counter() - start
+        metrics.observe("blacklist_filter_rebuild_seconds", elapsed)
+        logger.info("Blacklist filter rebuilt with %d tokens in %.2fs", count, elapsed)
+
+    def invalidate(self):
+        """Stop using the filter until the rebuild thread has built a new one."""
+        self._filter_pid = None
+        self._wakeup.set()
+
+    def _rebuild_forever(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                self.rebuild()
+            except Exception:
+                logger.exception("Blacklist filter rebuild failed")
+            finally:
+                close_old_connections()
+            self._wakeup.wait(self.rebuild_interval)
+
+    def start(self):
+        """Build the filter and keep it fresh from a thread of this process (once per process)."""
+        with self._lock:
+            if self._rebuilder_pid == os.getpid():
+                return
+            self._rebuilder_pid = os.getpid()
+            # a fork keeps the parent's event, possibly set
+            self._wakeup = threading.Event()
+        broadcast.ensure_listener()
+        threading.Thread(target=self._rebuild_forever, name="blacklist-rebuild", daemon=True).start()
+
+    def _sync_due(self):
+        return self._synced_at is None or time.monotonic() - self._synced_at >= self.sync_interval
+
+    def sync(self):
+        """Compare the shared generation with the messages received, decides whether misses are trusted."""
+        now = time.monotonic()
+        try:
+            current = self.current_generation()
+        except Exception:
+            logger.exception("Blacklist generation lookup failed")
+            self._trusted = False
+            return
+        with self._lock:
+            self._synced_at = now
+            if current < self._generation:
+                # the counter was lost (cache flushed), start over
+                current = None
+            elif current == self._generation:
+                self._trusted = True
+                self._behind_since = None
+                return
+            self._trusted = False
+            if self._behind_since is None:
+                self._behind_since = now
+            if current is None or now - self._behind_since >= self.MISSED_AFTER:
+                metrics.incr("blacklist_filter_gaps_total")
+                logger.warning("Blacklist broadcasts were missed, rebuilding the filter")
+                self.invalidate()
+
+    def _filter_ready(self, sync=True):
+        broadcast.ensure_listener()
+        pid = os.getpid()
+        # A filter inherited across fork may have missed broadcasts
+        if self._filter_pid != pid:
+            return False
+        if sync and self._sync_due():
+            self.sync()
+        return self._trusted and self._filter_pid == pid
+
+    # Lookups
+    def _check_database(self, jtis):
+        blacklisted = set(
+            BlacklistedToken.objects.filter(token__jti__in=jtis).values_list("token__jti", flat=True)
+        )
+        for jti in jtis:
+            cache.add(self._key(jti), self.BLACKLISTED if jti in blacklisted else self.NOT_BLACKLISTED)
+        return blacklisted
+
+    def blacklisted_many(self, jtis):
+        """Return the subset of ``jtis`` that is blacklisted."""
+        if self._filter_ready():
+            bloom = self._filter
+            candidates = [jti for jti in jtis if jti in bloom]
+        else:
+            candidates = list(jtis)
+
+        metrics.incr("blacklist_filter_skips_total", len(jtis) - len(candidates))
+        if not candidates:
+            return set()
+
+        try:
+            with metrics.timer("cache_operation_seconds", cache="blacklist"):
+                cached = cache.get_many([self._key(jti) for jti in candidates])
+        except Exception:
+            logger.exception("Blacklist cache lookup failed, falling back to the database")
+            cached = {}
+
+        blacklisted = set()
+        unknown = []
+        for jti in candidates:
+            state = cached.get(self._key(jti))
+            if state is None:
+                unknown.append(jti)
+            elif state == self.BLACKLISTED:
+                blacklisted.add(jti)
+
+        if unknown:
+            metrics.incr("blacklist_database_checks_total", len(unknown))
+            blacklisted |= self._check_database(unknown)
+
+        metrics.incr("blacklist_hits_total", len(blacklisted))
+        return blacklisted
+
+    def is_blacklisted(self, jti):
+        return jti in self.blacklisted_many([jti])
+
+    async def ais_blacklisted(self, jti):
+        # A Bloom filter miss needs no I/O, only possible hits and the
+        # periodic generation check leave the event loop
+        if self._filter_pid == os.getpid() and self._sync_due():
+            await sync_to_async(self.sync)()
+        if self._filter_ready(sync=False) and jti not in self._filter:
+            metrics.incr("blacklist_filter_skips_total")
+            return False
+        return await sync_to_async(self.is_blacklisted)(jti)
+
+    def add(self, jti, expires_at):
+        timeout = max(int((expires_at - timezone.now()).total_seconds()), 1)
+        generation = None
+        try:
+            cache.set(self._key(jti), self.BLACKLISTED, timeout=timeout)
+            generation = self._next_generation()
+        except Exception:
+            logger.exception("Blacklist cache write failed for %s", jti)
+        broadcast.publish(self.CHANNEL, {"jti": jti, "generation": generation})
+
+
+_config = getattr(settings, "TOKEN_BLACKLIST", {})
+
+token_blacklist = TokenBlacklist(
+    capacity=_config.get("CAPACITY", 1_000_000),
+    error_rate=_config.get("ERROR_RATE", 0.001),
+    rebuild_interval=_config.get("REBUILD_INTERVAL", 3600),
+    sync_interval=_config.get("SYNC_INTERVAL", 1.0),
+)
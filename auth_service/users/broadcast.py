@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+
+# Cross-node invalidation messages over Redis pub/sub.
+# Handlers run locally as soon as a message is published and, through a
+# daemon listener thread, on every other process sharing CACHES["default"].
+# A handler is called with ``None`` after the listener reconnects, meaning
+# messages may have been missed and local state should be dropped.
+# Without a Redis cache backend (tests, locmem) delivery is process-local.
+logger = logging.getLogger(__name__)
+
+CHANNEL_PREFIX = "auth:broadcast:"
+
+_handlers = defaultdict(list)
+_node_id = None
+_listener_pid = None
+_lock = threading.Lock()
+
+
+def _redis():
+    try:
+        from django_redis import get_redis_connection
+        return get_redis_connection("default")
+    except (ImportError, NotImplementedError):
+        return None
+
+
+def _dispatch(channel, message):
+    for handler in _handlers.get(channel, ()):
+        try:
+            handler(message)
+        except Exception:
+            logger.exception("Broadcast handler failed for %s", channel)
+
+
+def _dispatch_all(message):
+    for channel in list(_handlers):
+        _dispatch(channel, message)
+
+
+def _listen(connection, node_id):
+    first = True
+    while True:
+        try:
+            pubsub = connection.pubsub(ignore_subscribe_messages=True)
+            pubsub.psubscribe(f"{CHANNEL_PREFIX}*")
+            if not first:
+                _dispatch_all(None)
+            first = False
+
+            for raw in pubsub.listen():
+                payload = json.loads(raw["data"])
+                if payload["node"] == node_id:
+                    continue
+                channel = raw["channel"]
+                if isinstance(channel, bytes):
+                    channel = channel.decode()
+                _dispatch(channel[len(CHANNEL_PREFIX):], payload["message"])
+        except Exception:
+            logger.exception("Broadcast listener disconnected, reconnecting")
+            time.sleep(1)
+
+
+def ensure_listener():
+    # Cheap enough for the request path; restarts the thread after fork
+    global _node_id, _listener_pid
+    pid = os.getpid()
+    if _listener_pid == pid:
+        return
+    with _lock:
+        if _listener_pid == pid:
+            return
+        _node_id = uuid.uuid4().hex
+        _listener_pid = pid
+        connection = _redis()
+        if connection is not None:
+            threading.Thread(
+                target=_listen, args=(connection, _node_id), name="auth-broadcast", daemon=True
+            ).start()
+
+
+def subscribe(channel, handler):
+    _handlers[channel].append(handler)
+
+
+def publish(channel, message):
+    ensure_listener()
+    _dispatch(channel, message)
+
+    connection = _redis()
+    if connection is None:
+        return
+    try:
+        connection.publish(
+            f"{CHANNEL_PREFIX}{channel}",
+            json.dumps({"node": _node_id, "message": message}),
+        )
+    except Exception:
+        logger.exception("Broadcast publish failed for %s", channel)
@@ -0,0 +1,245 @@
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+from . import broadcast, metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+# Thread-safe in-process LRU with a per-entry TTL
+class LRUCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Two-tier user cache for authentication.
+# L1 is a per-process LRU, L2 is CACHES["default"] (Redis) keyed by user id
+# and a per-user version. Invalidation bumps the version, so a reader that
+# loaded a stale row before the write can never repopulate L2 with it, and
+# broadcasts the id so every process drops its L1 entry. Anything that
+# changes a user row without save() (QuerySet.update(), bulk_update())
+# must call invalidate() itself, post_save only covers save().
+# L2 copies leave out the password hash: it stays in the database and is
+# loaded from the primary, as a deferred field, by whatever touches it.
+class UserCache:
+    CHANNEL = "user-cache"
+
+    def __init__(self, local_maxsize, local_ttl, timeout):
+        self.local = LRUCache(local_maxsize, local_ttl)
+        self.timeout = timeout
+        broadcast.subscribe(self.CHANNEL, self._on_message)
+
+    @staticmethod
+    def _version_key(user_id):
+        return f"auth:user:{user_id}:version"
+
+    @staticmethod
+    def _user_key(user_id, version):
+        return f"auth:user:{user_id}:{version}"
+
+    def _on_message(self, user_ids):
+        if user_ids is None:
+            self.local.clear()
+            return
+        for user_id in user_ids if isinstance(user_ids, list) else [user_ids]:
+            self.local.delete(str(user_id))
+
+    @staticmethod
+    def _shared(user):
+        # token_version hashes the password, keep it so refresh needs no query
+        shared = copy.copy(user)
+        shared._token_version = user.token_version
+        del shared.__dict__["password"]
+        return shared
+
+    def _version(self, user_id):
+        key = self._version_key(user_id)
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, time.time_ns(), timeout=None)
+            version = cache.get(key)
+        return version
+
+    def _load(self, user_id):
+        # From the primary: a replica behind the version bump would put the
+        # old row in L2 under the new version
+        User = get_user_model()
+        try:
+            return User.objects.using(DEFAULT_DB_ALIAS).get(pk=user_id)
+        except User.DoesNotExist:
+            return None
+
+    def get(self, user_id):
+        """Return a private copy of the user with ``user_id`` or None."""
+        broadcast.ensure_listener()
+        user_id = str(user_id)
+
+        user = self.local.get(user_id)
+        if user is not None:
+            metrics.incr("user_cache_local_hits_total")
+            return copy.copy(user)
+
+        try:
+            with metrics.timer("cache_operation_seconds", cache="user"):
+                version = self._version(user_id)
+                user = cache.get(self._user_key(user_id, version))
+        except Exception:
+            logger.exception("User cache lookup failed, falling back to the database")
+            metrics.incr("user_cache_misses_total")
+            return self._load(user_id)
+
+        if user is not None:
+            metrics.incr("user_cache_redis_hits_total")
+        else:
+            metrics.incr("user_cache_misses_total")
+            user = self._load(user_id)
+            if user is None:
+                return None
+            try:
+                cache.set(self._user_key(user_id, version), self._shared(user), timeout=self.timeout)
+            except Exception:
+                logger.exception("User cache store failed")
+
+        self.local.set(user_id, user)
+        return copy.copy(user)
+
+    async def aget(self, user_id):
+        """get() for async views: L1 hits stay on the event loop."""
+        user = self.local.get(str(user_id))
+        if user is not None:
+            metrics.incr("user_cache_local_hits_total")
+            return copy.copy(user)
+        return await sync_to_async(self.get)(user_id)
+
+    def get_many(self, user_ids):
+        """Return {user_id: user copy} for the ids that exist, one round trip per tier."""
+        broadcast.ensure_listener()
+        found = {}
+        missing = []
+        for user_id in {str(user_id) for user_id in user_ids}:
+            user = self.local.get(user_id)
+            if user is not None:
+                found[user_id] = user
+            else:
+                missing.append(user_id)
+        metrics.incr("user_cache_local_hits_total", len(found))
+        if not missing:
+            return {user_id: copy.copy(user) for user_id, user in found.items()}
+
+        try:
+            with metrics.timer("cache_operation_seconds", cache="user"):
+                versions = cache.get_many([self._version_key(user_id) for user_id in missing])
+                keys = {
+                    user_id: self._user_key(user_id, versions.get(self._version_key(user_id)))
+                    for user_id in missing
+                    if versions.get(self._version_key(user_id)) is not None
+                }
+                cached = cache.get_many(list(keys.values()))
+        except Exception:
+            logger.exception("User cache lookup failed, falling back to the database")
+            keys, cached = {}, {}
+
+        to_load = []
+        for user_id in missing:
+            user = cached.get(keys.get(user_id))
+            if user is None:
+                to_load.append(user_id)
+            else:
+                found[user_id] = user
+                self.local.set(user_id, user)
+        metrics.incr("user_cache_redis_hits_total", len(missing) - len(to_load))
+        metrics.incr("user_cache_misses_total", len(to_load))
+
+        if to_load:
+            to_store = {}
+            for user in get_user_model().objects.using(DEFAULT_DB_ALIAS).filter(pk__in=to_load):
+                user_id = str(user.pk)
+                found[user_id] = user
+                self.local.set(user_id, user)
+                if user_id in keys:
+                    to_store[keys[user_id]] = self._shared(user)
+            try:
+                cache.set_many(to_store, timeout=self.timeout)
+            except Exception:
+                logger.exception("User cache store failed")
+
+        return {user_id: copy.copy(user) for user_id, user in found.items()}
+
+    def invalidate(self, user_id):
+        try:
+            cache.set(self._version_key(user_id), time.time_ns(), timeout=None)
+        except Exception:
+            logger.exception("User cache invalidation failed for user %s", user_id)
+        broadcast.publish(self.CHANNEL, str(user_id))
+
+    def invalidate_many(self, user_ids):
+        user_ids = [str(user_id) for user_id in user_ids]
+        if not user_ids:
+            return
+        try:
+            cache.set_many({self._version_key(user_id): time.time_ns() for user_id in user_ids}, timeout=None)
+        except Exception:
+            logger.exception("User cache invalidation failed for %d users", len(user_ids))
+        broadcast.publish(self.CHANNEL, user_ids)
+
+    def stats(self):
+        counters = metrics.snapshot()["counters"]
+        return {
+            "local_size": len(self.local),
+            "local_hits": counters.get("user_cache_local_hits_total", 0),
+            "redis_hits": counters.get("user_cache_redis_hits_total", 0),
+            "misses": counters.get("user_cache_misses_total", 0),
+        }
+
+
+_config = getattr(settings, "USER_CACHE", {})
+
+user_cache = UserCache(
+    local_maxsize=_config.get("LOCAL_MAXSIZE", 10000),
+    local_ttl=_config.get("LOCAL_TTL", 30),
+    timeout=_config.get("TIMEOUT", 300),
+)
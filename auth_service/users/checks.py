@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.contrib.auth.hashers import get_hashers
+from django.core.checks import Error, Warning, register
+
+from . import schema
+
+
+# Runs with `manage.py check --deploy` only: generating the schema to compare
+# takes longer than a startup should
+@register("openapi", deploy=True)
+def check_openapi_schema(app_configs, **kwargs):
+    if not settings.API_DOCS or not schema.is_stale():
+        return []
+    return [Warning(
+        f"The OpenAPI schema at {settings.OPENAPI_SCHEMA['FILE']} is missing or does not match the code.",
+        hint="Run `python manage.py openapi_schema` as part of the build.",
+        id="users.W001",
+    )]
+
+
+@register("metrics", deploy=True)
+def check_metrics_token(app_configs, **kwargs):
+    if settings.DEBUG or settings.METRICS["TOKEN"]:
+        return []
+    return [Warning(
+        "METRICS_TOKEN is not set, /metrics answers every scrape with 401.",
+        hint="Set METRICS_TOKEN and send it as \"Authorization: Bearer <token>\" from the scraper.",
+        id="users.W002",
+    )]
+
+
+# argon2 and bcrypt hashers import their library on first use: without it the
+# first login (or the first hash, for PASSWORD_HASHER) fails with a ValueError
+@register("password_hashers")
+def check_password_hasher_libraries(app_configs, **kwargs):
+    errors = []
+    for hasher in get_hashers():
+        if not getattr(hasher, "library", None):
+            continue
+        try:
+            hasher._load_library()
+        except ValueError as exc:
+            errors.append(Error(
+                f"{type(hasher).__module__}.{type(hasher).__name__} is in PASSWORD_HASHERS but {exc}",
+                hint="Install the packages from requirements.txt, or pick another PASSWORD_HASHER.",
+                id="users.E001",
+            ))
+    return errors
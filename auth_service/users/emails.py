@@ -0,0 +1,29 @@
+from django.conf import settings
+
+from . import otp
+from .models import EmailOTP, PasswordResetToken
+
+
+# Transactional emails, rendered by users/mail.py right before a batch is sent.
+# The mail queue only holds the kind and the user id: the OTP code or reset
+# token is created here, so no secret sits in Redis, and a message sent again
+# after a failure carries a fresh one that replaces the previous.
+def otp_email(user):
+    code = otp.issue(user)
+    return (
+        "Your Email Verification OTP",
+        f"Your OTP for email verification is: {code}\n\nit will expire in {EmailOTP.EXPIRY_MINUTES} minutes.",
+    )
+
+
+def password_reset_email(user):
+    raw_token, _ = PasswordResetToken.generate(user)
+    reset_url = f"{settings.FRONTEND_URL}/reset-password/{raw_token}"
+    return "Reset Your Password", f"Click The link below to rest password:\n\n{reset_url}"
+
+
+# kind -> function(user) returning (subject, body)
+KINDS = {
+    "otp": otp_email,
+    "password_reset": password_reset_email,
+}
@@ -0,0 +1,172 @@
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from . import broadcast, metrics
+
+
+CURRENT = "current"
+ROTATED = "rotated"
+REUSED = "reused"
+REVOKED = "revoked"
+
+# Published with the family id whenever a family rotates or is revoked
+CHANNEL = "token-family"
+
+
+def new_family():
+    return uuid.uuid4().hex
+
+
+def _key(family):
+    return f"auth:family:{family}"
+
+
+# Refresh-token families in Redis.
+# Every login starts a family: one hash holding the current generation, its
+# JTI, the user and the expiry, expiring with the newest refresh token. A
+# refresh token carries its family ("fam") and generation ("gen") claims.
+# Rotating is a single compare-and-swap script that only succeeds for the
+# current generation; presenting any other token of the family means one was
+# copied, so the family is deleted and every token in it stops working.
+# Logout deletes the hash.
+class RedisFamilyStore:
+    CHECK = """
+    local current = redis.call('HMGET', KEYS[1], 'gen', 'jti')
+    if not current[1] then
+        return 'revoked'
+    end
+    if current[1] ~= ARGV[1] or current[2] ~= ARGV[2] then
+        redis.call('DEL', KEYS[1])
+        return 'reused'
+    end
+    return 'current'
+    """
+
+    ROTATE = """
+    local current = redis.call('HMGET', KEYS[1], 'gen', 'jti')
+    if not current[1] then
+        return 'revoked'
+    end
+    if current[1] ~= ARGV[1] or current[2] ~= ARGV[2] then
+        redis.call('DEL', KEYS[1])
+        return 'reused'
+    end
+    redis.call('HSET', KEYS[1], 'gen', tostring(tonumber(ARGV[1]) + 1), 'jti', ARGV[3], 'exp', ARGV[4])
+    redis.call('EXPIREAT', KEYS[1], ARGV[4])
+    return 'rotated'
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._check = connection.register_script(self.CHECK)
+        self._rotate = connection.register_script(self.ROTATE)
+
+    def create(self, family, jti, user_id, exp):
+        pipe = self.connection.pipeline()
+        pipe.hset(_key(family), mapping={"gen": "0", "jti": jti, "user": str(user_id), "exp": str(exp)})
+        pipe.expireat(_key(family), exp)
+        pipe.execute()
+
+    def check(self, family, generation, jti):
+        return self._check(keys=[_key(family)], args=[str(generation), jti]).decode()
+
+    def rotate(self, family, generation, jti, new_jti, exp):
+        return self._rotate(keys=[_key(family)], args=[str(generation), jti, new_jti, str(exp)]).decode()
+
+    def revoke(self, family):
+        self.connection.delete(_key(family))
+
+    def current_many(self, families):
+        """{family: (generation, jti)} for those of ``families`` that were not revoked."""
+        pipe = self.connection.pipeline(transaction=False)
+        for family in families:
+            pipe.hmget(_key(family), "gen", "jti")
+        current = {}
+        for family, (generation, jti) in zip(families, pipe.execute()):
+            if generation is not None:
+                current[family] = (int(generation), jti.decode())
+        return current
+
+
+# Same semantics in process memory, used when CACHES["default"] is not Redis
+class LocalFamilyStore:
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def _get(self, family):
+        entry = self.families.get(family)
+        if entry is not None and entry["exp"] <= time.time():
+            del self.families[family]
+            return None
+        return entry
+
+    def create(self, family, jti, user_id, exp):
+        with self.lock:
+            self.families[family] = {"gen": 0, "jti": jti, "user": str(user_id), "exp": exp}
+
+    def _compare(self, family, generation, jti):
+        entry = self._get(family)
+        if entry is None:
+            return REVOKED, None
+        if entry["gen"] != generation or entry["jti"] != jti:
+            del self.families[family]
+            return REUSED, None
+        return CURRENT, entry
+
+    def check(self, family, generation, jti):
+        with self.lock:
+            return self._compare(family, generation, jti)[0]
+
+    def rotate(self, family, generation, jti, new_jti, exp):
+        with self.lock:
+            status, entry = self._compare(family, generation, jti)
+            if status != CURRENT:
+                return status
+            entry.update(gen=generation + 1, jti=new_jti, exp=exp)
+            return ROTATED
+
+    def revoke(self, family):
+        with self.lock:
+            self.families.pop(family, None)
+
+    def current_many(self, families):
+        with self.lock:
+            entries = {family: self._get(family) for family in families}
+        return {family: (entry["gen"], entry["jti"]) for family, entry in entries.items() if entry is not None}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                try:
+                    from django_redis import get_redis_connection
+                    _store = RedisFamilyStore(get_redis_connection("default"))
+                except (ImportError, NotImplementedError):
+                    _store = LocalFamilyStore()
+    return _store
+
+
+def enabled():
+    return settings.REFRESH_TOKEN_FAMILIES["ENABLED"]
+
+
+def changed(family):
+    """Tell every process that tokens of ``family`` may no longer be current."""
+    broadcast.publish(CHANNEL, family)
+
+
+def record(status):
+    if status == REUSED:
+        metrics.incr("refresh_token_reuse_total")
+    metrics.incr("refresh_token_family_checks_total", result=status)
+    return status
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+# Password hashers with work factors taken from settings.PASSWORD_HASHER_PARAMS
+# (see `manage.py calibrate_hasher`). A value of 0/None keeps Django's default.
+# The algorithm names are unchanged, so existing hashes keep verifying and are
+# upgraded on the next successful login when the parameters change.
+def _param(name, default):
+    return getattr(settings, "PASSWORD_HASHER_PARAMS", {}).get(name) or default
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    iterations = _param("PBKDF2_ITERATIONS", hashers.PBKDF2PasswordHasher.iterations)
+
+
+class Argon2PasswordHasher(hashers.Argon2PasswordHasher):
+    time_cost = _param("ARGON2_TIME_COST", hashers.Argon2PasswordHasher.time_cost)
+    memory_cost = _param("ARGON2_MEMORY_COST", hashers.Argon2PasswordHasher.memory_cost)
+    parallelism = _param("ARGON2_PARALLELISM", hashers.Argon2PasswordHasher.parallelism)
+
+
+class ScryptPasswordHasher(hashers.ScryptPasswordHasher):
+    work_factor = _param("SCRYPT_WORK_FACTOR", hashers.ScryptPasswordHasher.work_factor)
+    block_size = _param("SCRYPT_BLOCK_SIZE", hashers.ScryptPasswordHasher.block_size)
+    parallelism = _param("SCRYPT_PARALLELISM", hashers.ScryptPasswordHasher.parallelism)
+    # hashlib.scrypt needs ~128 * n * r bytes, OpenSSL's default cap is 32 MiB
+    maxmem = 256 * work_factor * block_size
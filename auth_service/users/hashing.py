@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import hashers, get_user_model
+from django.db import close_old_connections
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from . import metrics
+from .cache import user_cache
+
+
+logger = logging.getLogger(__name__)
+
+# Raised when the hashing queue stays full for longer than QUEUE_TIMEOUT
+class HashingUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Server is busy, please try again shortly."
+    default_code = "hashing_unavailable"
+
+
+# Shared executor for password hashing.
+# hashlib releases the GIL while hashing, so a small pool lets one process
+# use several cores for PBKDF2 while other threads keep serving requests.
+# The semaphore bounds running + queued jobs so a login storm sheds load
+# instead of piling up behind the pool. Async callers waiting for a slot park
+# on a future in _waiters and every released slot wakes the oldest one.
+class HashingExecutor:
+    def __init__(self, max_workers, max_queue, queue_timeout):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hash")
+        self._waiters = deque()
+        self._waiters_lock = threading.Lock()
+
+    def _release(self):
+        self._slots.release()
+        self._notify()
+
+    def _notify(self):
+        # Wake the oldest arun waiting for a slot, on its own event loop
+        with self._waiters_lock:
+            while self._waiters:
+                loop, waiter = self._waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._wake, waiter)
+                    return
+                except RuntimeError:
+                    # its loop is closed
+                    continue
+
+    def _wake(self, waiter):
+        if waiter.done():
+            # the waiter gave up in the meantime, the slot is for the next one
+            self._notify()
+        else:
+            waiter.set_result(None)
+
+    def _forget(self, loop, waiter):
+        # Drop a waiter that stops waiting. If a release already woke it,
+        # pass that wakeup on so the slot does not sit idle.
+        with self._waiters_lock:
+            try:
+                self._waiters.remove((loop, waiter))
+                return
+            except ValueError:
+                pass
+        waiter.cancel()
+        if not waiter.cancelled():
+            self._notify()
+
+    def _run(self, enqueued_at, fn, args):
+        started = time.perf_counter()
+        metrics.observe("password_hash_queue_wait_seconds", started - enqueued_at)
+        try:
+            return fn(*args)
+        finally:
+            metrics.observe("password_hash_seconds", time.perf_counter() - started)
+            self._release()
+
+    def _release_if_cancelled(self, future):
+        # A future cancelled while still queued (arun's caller went away)
+        # never reaches _run, which is what normally releases the slot
+        if future.cancelled():
+            self._release()
+
+    def _submit(self, fn, args):
+        try:
+            future = self._executor.submit(self._run, time.perf_counter(), fn, args)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(self._release_if_cancelled)
+        return future
+
+    def _rejected(self):
+        metrics.incr("password_hash_rejected_total")
+        return HashingUnavailable()
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise self._rejected()
+        return self._submit(fn, args)
+
+    def try_submit(self, fn, *args):
+        # For background jobs: returns None instead of waiting for a slot
+        if not self._slots.acquire(blocking=False):
+            metrics.incr("password_hash_rejected_total")
+            return None
+        return self._submit(fn, args)
+
+    def run(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    async def arun(self, fn, *args):
+        # Never block the event loop waiting for a slot
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.queue_timeout
+        while not self._slots.acquire(blocking=False):
+            waiter = loop.create_future()
+            with self._waiters_lock:
+                self._waiters.append((loop, waiter))
+            # a slot released before the waiter was queued woke nobody
+            if self._slots.acquire(blocking=False):
+                self._forget(loop, waiter)
+                break
+            try:
+                await asyncio.wait_for(waiter, deadline - loop.time())
+            except asyncio.TimeoutError:
+                self._forget(loop, waiter)
+                raise self._rejected() from None
+            except BaseException:
+                self._forget(loop, waiter)
+                raise
+        return await asyncio.wrap_future(self._submit(fn, args))
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    # Re-created after fork: worker threads do not survive into the child
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                config = getattr(settings, "PASSWORD_HASHING", {})
+                _executor = HashingExecutor(
+                    max_workers=config.get("MAX_WORKERS") or os.cpu_count() or 1,
+                    max_queue=config.get("MAX_QUEUE", 64),
+                    queue_timeout=config.get("QUEUE_TIMEOUT", 2.0),
+                )
+                _executor_pid = os.getpid()
+    return _executor
+
+
+# Sync helpers
+def make_password(password):
+    return get_executor().run(hashers.make_password, password)
+
+
+def check_password(password, encoded):
+    return get_executor().run(hashers.check_password, password, encoded)
+
+
+def set_password(user, raw_password):
+    # Same as AbstractBaseUser.set_password, hashed on the shared executor
+    user.password = make_password(raw_password)
+    user._password = raw_password
+
+
+# Rehash on login
+def needs_rehash(encoded):
+    try:
+        hasher = hashers.identify_hasher(encoded)
+    except ValueError:
+        return False
+    preferred = hashers.get_hasher("default")
+    return hasher.algorithm != preferred.algorithm or preferred.must_update(encoded)
+
+
+def _rehash(user_id, raw_password, old_encoded):
+    try:
+        # Only replace the hash we verified, never a concurrently changed one
+        updated = get_user_model().objects.filter(pk=user_id, password=old_encoded).update(
+            password=hashers.make_password(raw_password)
+        )
+        if updated:
+            # update() sends no post_save
+            user_cache.invalidate(user_id)
+            metrics.incr("password_rehash_total")
+    except Exception:
+        logger.exception("Password rehash failed for user %s", user_id)
+    finally:
+        close_old_connections()
+
+
+def schedule_rehash(user, raw_password):
+    """Upgrade ``user``'s stored hash in the background if the hasher settings changed.
+
+    Call only after the password was verified. Skipped when the pool is
+    saturated; the next successful login tries again.
+    """
+    if needs_rehash(user.password):
+        get_executor().try_submit(_rehash, user.pk, raw_password, user.password)
+
+
+# Initializer for hashing process pools (users/importer.py).
+# Lives here because spawned workers import it before Django is set up.
+def init_hash_process(settings_module):
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings_module)
+    import django
+    django.setup()
+
+
+# Async helpers
+async def amake_password(password):
+    return await get_executor().arun(hashers.make_password, password)
+
+
+async def acheck_password(password, encoded):
+    return await get_executor().arun(hashers.check_password, password, encoded)
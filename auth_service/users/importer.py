@@ -0,0 +1,221 @@
+import csv
+import io
+import json
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
+from rest_framework.exceptions import ValidationError
+
+from . import hashing, metrics
+from .serializers import BulkUserRowSerializer
+
+
+User = get_user_model()
+
+
+# A row the reader could not parse, reported instead of ending the import
+class InvalidRow:
+    __slots__ = ("error",)
+
+    def __init__(self, error):
+        self.error = error
+
+
+# Bytes that are not UTF-8, as text_stream() decodes them
+_UNDECODABLE = re.compile("[\udc80-\udcff]")
+NOT_UTF8 = "Row is not valid UTF-8."
+
+
+# Input readers, both stream row by row
+def read_csv(stream):
+    reader = csv.DictReader(stream)
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as exc:
+            yield InvalidRow(f"Invalid CSV: {exc}")
+            continue
+        if any(_UNDECODABLE.search(value) for value in row.values() if isinstance(value, str)):
+            yield InvalidRow(NOT_UTF8)
+        else:
+            yield row
+
+
+def read_jsonl(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        if _UNDECODABLE.search(line):
+            yield InvalidRow(NOT_UTF8)
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as exc:
+            yield InvalidRow(f"Invalid JSON: {exc}")
+
+
+READERS = {"csv": read_csv, "jsonl": read_jsonl}
+
+
+def detect_format(name):
+    return "jsonl" if name and name.lower().endswith((".jsonl", ".ndjson", ".json")) else "csv"
+
+
+def open_text(path):
+    return open(path, encoding="utf-8-sig", errors="surrogateescape", newline="")
+
+
+def text_stream(binary):
+    # undecodable bytes become lone surrogates, the readers reject their row
+    return io.TextIOWrapper(binary, encoding="utf-8-sig", errors="surrogateescape", newline="")
+
+
+# Bulk user import.
+# Rows are validated and inserted in batches: one SELECT per batch for
+# existing emails, passwords hashed in a process pool (PBKDF2 is CPU bound)
+# and one bulk_create per batch. Rows may carry a plain "password", an
+# already hashed Django "password_hash", or neither (unusable password, the
+# user sets one through forgot-password). run() yields a report entry for
+# every rejected row and a final summary.
+class UserImporter:
+    def __init__(self, batch_size=1000, workers=None, activate=False):
+        self.batch_size = batch_size
+        self.workers = workers or os.cpu_count() or 1
+        self.activate = activate
+        self._pool = None
+
+    def __enter__(self):
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=hashing.init_hash_process,
+            initargs=(os.environ.get("DJANGO_SETTINGS_MODULE", "auth_service.settings"),),
+        )
+        return self
+
+    def __exit__(self, *exc_info):
+        self._pool.shutdown()
+        self._pool = None
+
+    def _hash(self, passwords):
+        if not passwords:
+            return []
+        chunksize = max(len(passwords) // (self.workers * 4), 1)
+        return list(self._pool.map(make_password, passwords, chunksize=chunksize))
+
+    def _validate(self, numbered_rows):
+        valid, errors = [], []
+        seen = set()
+        # One serializer for every row, binding fields per row dominates otherwise
+        serializer = BulkUserRowSerializer()
+        for row_number, row in numbered_rows:
+            if isinstance(row, InvalidRow):
+                errors.append({"row": row_number, "email": None, "errors": {"non_field_errors": [row.error]}})
+                continue
+            try:
+                data = serializer.run_validation(row)
+            except ValidationError as exc:
+                email = row.get("email") if isinstance(row, dict) else None
+                errors.append({"row": row_number, "email": email, "errors": exc.detail})
+                continue
+            if data["email"] in seen:
+                errors.append({"row": row_number, "email": data["email"], "errors": {"email": ["Duplicate email in input."]}})
+                continue
+            seen.add(data["email"])
+            valid.append((row_number, data))
+
+        existing = set(User.objects.filter(email__in=seen).values_list("email", flat=True))
+        if existing:
+            errors += [
+                {"row": row_number, "email": data["email"], "errors": {"email": ["A user with this email already exists."]}}
+                for row_number, data in valid if data["email"] in existing
+            ]
+            valid = [(row_number, data) for row_number, data in valid if data["email"] not in existing]
+        return valid, errors
+
+    def _build(self, valid):
+        to_hash = [data["password"] for _, data in valid if data.get("password")]
+        hashed = iter(self._hash(to_hash))
+
+        users = []
+        for _, data in valid:
+            if data.get("password"):
+                password = next(hashed)
+            elif data.get("password_hash"):
+                password = data["password_hash"]
+            else:
+                password = make_password(None)
+            users.append(User(
+                email=data["email"],
+                first_name=data.get("first_name", ""),
+                last_name=data.get("last_name", ""),
+                role=data.get("role", "Customer"),
+                password=password,
+                is_active=self.activate,
+            ))
+        return users
+
+    def _insert(self, valid, users):
+        try:
+            with transaction.atomic():
+                User.objects.bulk_create(users, batch_size=self.batch_size)
+            return []
+        except IntegrityError:
+            pass
+
+        # Lost a race with a concurrent insert. Insert row by row so a row
+        # that conflicts now, possibly with yet another insert, only fails itself
+        errors = []
+        for (row_number, data), user in zip(valid, users):
+            try:
+                with transaction.atomic():
+                    User.objects.bulk_create([user])
+            except IntegrityError:
+                errors.append(
+                    {"row": row_number, "email": data["email"], "errors": {"email": ["A user with this email already exists."]}}
+                )
+        return errors
+
+    def run(self, rows):
+        if self._pool is None:
+            with self:
+                yield from self.run(rows)
+            return
+
+        start = time.perf_counter()
+        created = failed = 0
+        numbered = enumerate(rows, start=1)
+
+        while True:
+            chunk = list(islice(numbered, self.batch_size))
+            if not chunk:
+                break
+
+            valid, errors = self._validate(chunk)
+            if valid:
+                errors += self._insert(valid, self._build(valid))
+
+            failed += len(errors)
+            created += len(chunk) - len(errors)
+            yield from sorted(errors, key=lambda error: error["row"])
+
+        elapsed = time.perf_counter() - start
+        metrics.incr("users_imported_total", created)
+        yield {
+            "summary": {
+                "created": created,
+                "failed": failed,
+                "seconds": round(elapsed, 3),
+                "users_per_second": round(created / elapsed, 1) if elapsed else 0,
+            }
+        }
@@ -0,0 +1,196 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from rest_framework_simplejwt.exceptions import TokenBackendError
+from rest_framework_simplejwt.settings import api_settings
+
+from . import broadcast, families, metrics
+from .blacklist import TokenBlacklist, token_blacklist
+from .cache import UserCache, user_cache
+from .keys import token_backend
+from .tokens import RefreshToken
+
+
+# In-process cache of introspection results.
+# Entries live for at most CACHE_SECONDS (never past the token's expiry) and
+# are dropped early when the token's JTI is blacklisted, its refresh-token
+# family rotates or is revoked, or its user changes anywhere in the fleet
+# (same broadcast channels as the blacklist, the family store and the user
+# cache). Every invalidation bumps a version; a result computed before the
+# last bump may predate that invalidation and is not stored.
+class IntrospectionCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = 0
+        self._entries = OrderedDict()
+        self._by_user = defaultdict(set)
+        self._by_jti = {}
+        self._by_family = defaultdict(set)
+        self._lock = threading.Lock()
+        broadcast.subscribe(UserCache.CHANNEL, self._on_user_message)
+        broadcast.subscribe(TokenBlacklist.CHANNEL, self._on_blacklist_message)
+        broadcast.subscribe(families.CHANNEL, self._on_family_message)
+
+    @staticmethod
+    def _unindex(index, value, key):
+        keys = index.get(value)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[value]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        _, _, user_id, jti, family = entry
+        self._unindex(self._by_user, user_id, key)
+        self._by_jti.pop(jti, None)
+        if family is not None:
+            self._unindex(self._by_family, family, key)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, result, expires_at, user_id, jti, family=None, version=None):
+        """Store ``result``; ``version`` is self.version from before its state was fetched."""
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._remove(key)
+            expires_at = min(expires_at, time.time() + self.ttl)
+            self._entries[key] = (result, expires_at, user_id, jti, family)
+            self._by_user[user_id].add(key)
+            self._by_jti[jti] = key
+            if family is not None:
+                self._by_family[family].add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+            self._by_user.clear()
+            self._by_jti.clear()
+            self._by_family.clear()
+
+    def _on_user_message(self, user_ids):
+        if user_ids is None:
+            self.clear()
+            return
+        with self._lock:
+            self.version += 1
+            for user_id in user_ids if isinstance(user_ids, list) else [user_ids]:
+                for key in list(self._by_user.get(str(user_id), ())):
+                    self._remove(key)
+
+    def _on_blacklist_message(self, message):
+        if message is None:
+            self.clear()
+            return
+        with self._lock:
+            self.version += 1
+            key = self._by_jti.get(message["jti"])
+            if key is not None:
+                self._remove(key)
+
+    def _on_family_message(self, family):
+        if family is None:
+            self.clear()
+            return
+        with self._lock:
+            self.version += 1
+            for key in list(self._by_family.get(family, ())):
+                self._remove(key)
+
+
+_config = getattr(settings, "INTROSPECTION", {})
+
+_results = IntrospectionCache(
+    maxsize=_config.get("CACHE_MAXSIZE", 100000),
+    ttl=_config.get("CACHE_SECONDS", 5.0),
+)
+
+
+def _cache_key(token):
+    return hashlib.sha256(token.encode()).digest()
+
+
+def introspect(tokens):
+    """Return one result dict per token, in order.
+
+    Signature and expiry are checked locally; blacklist, refresh-token family
+    and user state are fetched with one multi-get each for all tokens not
+    already cached. A refresh token from a family is active only while it is
+    the family's current generation, an access token while its family exists.
+    """
+    results = [None] * len(tokens)
+    decoded = []
+
+    for index, token in enumerate(tokens):
+        cached = _results.get(_cache_key(token))
+        if cached is not None:
+            metrics.incr("introspection_cache_hits_total")
+            results[index] = cached
+            continue
+
+        try:
+            payload = token_backend.decode(token)
+        except TokenBackendError:
+            results[index] = {"active": False}
+            continue
+
+        if api_settings.JTI_CLAIM not in payload or api_settings.USER_ID_CLAIM not in payload:
+            results[index] = {"active": False}
+            continue
+        decoded.append((index, token, payload))
+
+    if not decoded:
+        return results
+
+    metrics.incr("introspection_cache_misses_total", len(decoded))
+    # read before any state is fetched, see IntrospectionCache.set()
+    version = _results.version
+    blacklisted = token_blacklist.blacklisted_many([payload[api_settings.JTI_CLAIM] for _, _, payload in decoded])
+    users = user_cache.get_many([payload[api_settings.USER_ID_CLAIM] for _, _, payload in decoded])
+    token_families = {payload["fam"] for _, _, payload in decoded if "fam" in payload}
+    current = families.get_store().current_many(list(token_families)) if token_families else {}
+
+    for index, token, payload in decoded:
+        jti = payload[api_settings.JTI_CLAIM]
+        user_id = str(payload[api_settings.USER_ID_CLAIM])
+        user = users.get(user_id)
+        family = payload.get("fam")
+        is_blacklisted = jti in blacklisted
+        if family is not None:
+            generation = current.get(family)
+            if payload.get(api_settings.TOKEN_TYPE_CLAIM) == RefreshToken.token_type:
+                is_blacklisted = is_blacklisted or generation != (payload.get("gen"), jti)
+            else:
+                is_blacklisted = is_blacklisted or generation is None
+
+        result = {
+            "active": not is_blacklisted and user is not None and user.is_active,
+            "token_type": payload.get(api_settings.TOKEN_TYPE_CLAIM),
+            "exp": payload["exp"],
+            "user_id": user_id,
+            "role": user.role if user is not None else payload.get("role"),
+            "blacklisted": is_blacklisted,
+        }
+        results[index] = result
+        _results.set(_cache_key(token), result, payload["exp"], user_id, jti, family, version)
+
+    return results
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from jwt.algorithms import OKPAlgorithm, RSAAlgorithm
+from rest_framework_simplejwt.backends import TokenBackend
+from rest_framework_simplejwt.exceptions import TokenBackendError, TokenBackendExpiredToken
+from rest_framework_simplejwt.settings import api_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class SigningKey:
+    __slots__ = ("kid", "algorithm", "private_key", "public_key")
+
+    def __init__(self, kid, private_key):
+        self.kid = kid
+        self.private_key = private_key
+        self.public_key = private_key.public_key()
+        if isinstance(private_key, rsa.RSAPrivateKey):
+            self.algorithm = "RS256"
+        elif isinstance(private_key, ed25519.Ed25519PrivateKey):
+            self.algorithm = "EdDSA"
+        else:
+            raise ValueError(f"Unsupported JWT signing key type for kid {kid!r}")
+
+    def to_jwk(self):
+        if self.algorithm == "RS256":
+            jwk = RSAAlgorithm.to_jwk(self.public_key, as_dict=True)
+        else:
+            jwk = OKPAlgorithm.to_jwk(self.public_key, as_dict=True)
+        jwk.update({"kid": self.kid, "alg": self.algorithm, "use": "sig"})
+        return jwk
+
+
+# Signing keys loaded from JWT_KEYS_DIR, one "<kid>.pem" private key per file.
+# The active key (JWT_ACTIVE_KID, or the last kid in sort order) signs new
+# tokens; every key in the directory stays valid for verification, so keys
+# can be rotated with `manage.py rotate_jwt_keys` without logging anyone out.
+class KeyRing:
+    RELOAD_INTERVAL = 30
+
+    def __init__(self, directory, active_kid=""):
+        self.directory = Path(directory)
+        self.active_kid = active_kid
+        self.keys = {}
+        self.active = None
+        self.jwks_json = b'{"keys": []}'
+        self.jwks_etag = ""
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        keys = {}
+        for path in sorted(self.directory.glob("*.pem")):
+            keys[path.stem] = SigningKey(path.stem, load_pem_private_key(path.read_bytes(), password=None))
+
+        if not keys:
+            raise ValueError(f"No JWT signing keys found in {self.directory}")
+
+        active_kid = self.active_kid or list(keys)[-1]
+        if active_kid not in keys:
+            raise ValueError(f"JWT_ACTIVE_KID {active_kid!r} not found in {self.directory}")
+
+        self.keys = keys
+        self.active = keys[active_kid]
+        self.jwks_json = json.dumps({"keys": [key.to_jwk() for key in keys.values()]}).encode()
+        self.jwks_etag = f'"{hashlib.sha256(self.jwks_json).hexdigest()[:32]}"'
+        self._loaded_at = time.monotonic()
+
+    def reload_if_stale(self):
+        # At most one reload per interval, picks up keys rotated in on disk
+        if time.monotonic() - self._loaded_at <= self.RELOAD_INTERVAL:
+            return
+        with self._lock:
+            if time.monotonic() - self._loaded_at <= self.RELOAD_INTERVAL:
+                return
+            try:
+                self.load()
+            except Exception:
+                logger.exception("Reloading JWT signing keys failed")
+                self._loaded_at = time.monotonic()
+
+    def get(self, kid):
+        key = self.keys.get(kid)
+        if key is None:
+            self.reload_if_stale()
+            key = self.keys.get(kid)
+        return key
+
+
+# simplejwt TokenBackend that signs with the key ring and tags tokens with
+# the key id. Without JWT_KEYS_DIR it behaves exactly like the stock backend
+# (SIMPLE_JWT ALGORITHM/SIGNING_KEY).
+class KeyRingTokenBackend(TokenBackend):
+    def __init__(self, *args, keyring=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.keyring = keyring
+
+    def encode(self, payload):
+        if self.keyring is None:
+            return super().encode(payload)
+
+        jwt_payload = payload.copy()
+        if self.audience is not None:
+            jwt_payload["aud"] = self.audience
+        if self.issuer is not None:
+            jwt_payload["iss"] = self.issuer
+
+        key = self.keyring.active
+        return jwt.encode(
+            jwt_payload,
+            key.private_key,
+            algorithm=key.algorithm,
+            headers={"kid": key.kid},
+            json_encoder=self.json_encoder,
+        )
+
+    def decode(self, token, verify=True):
+        if self.keyring is None:
+            return super().decode(token, verify=verify)
+
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+        except jwt.InvalidTokenError as e:
+            raise TokenBackendError(_("Token is invalid")) from e
+
+        key = self.keyring.get(kid)
+        if key is None:
+            raise TokenBackendError(_("Token is invalid"))
+
+        try:
+            return jwt.decode(
+                token,
+                key.public_key,
+                algorithms=[key.algorithm],
+                audience=self.audience,
+                issuer=self.issuer,
+                leeway=self.get_leeway(),
+                options={
+                    "verify_aud": self.audience is not None,
+                    "verify_signature": verify,
+                },
+            )
+        except jwt.ExpiredSignatureError as e:
+            raise TokenBackendExpiredToken(_("Token is expired")) from e
+        except jwt.InvalidTokenError as e:
+            raise TokenBackendError(_("Token is invalid")) from e
+
+
+keyring = KeyRing(settings.JWT_KEYS_DIR, settings.JWT_ACTIVE_KID) if settings.JWT_KEYS_DIR else None
+
+token_backend = KeyRingTokenBackend(
+    api_settings.ALGORITHM,
+    api_settings.SIGNING_KEY,
+    api_settings.VERIFYING_KEY,
+    api_settings.AUDIENCE,
+    api_settings.ISSUER,
+    api_settings.JWK_URL,
+    api_settings.LEEWAY,
+    api_settings.JSON_ENCODER,
+    keyring=keyring,
+)
@@ -0,0 +1,264 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.mail import EmailMessage, get_connection
+
+from . import emails, metrics
+
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = "auth:mail:queue"
+PROCESSING_PREFIX = "auth:mail:processing:"
+LEASE_PREFIX = "auth:mail:lease:"
+
+
+def _new_worker_id():
+    return f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+
+
+# Identifies this process's processing list, never shared with a later
+# process that reuses the pid
+_worker_id = _new_worker_id()
+
+
+# Outgoing mail queue.
+# Celery tasks enqueue a message kind and a user id; flush() drains them in
+# batches over one SMTP connection and renders each message (users/emails.py)
+# just before sending it, so codes and reset links never sit in the queue. Redis-backed when CACHES["default"] is
+# django-redis, otherwise a process-local deque (tests, eager Celery).
+# pop() moves a batch onto this process's processing list (LMOVE) and takes
+# a lease on it; ack() requeues the failures and drops the list once the
+# batch was sent. A batch whose process died before ack() is put back by
+# recover() once its lease expired, so delivery is at-least-once: a message
+# sent just before the crash is sent again.
+class RedisMailQueue:
+    POP = """
+    local items = {}
+    for i = 1, tonumber(ARGV[1]) do
+        local item = redis.call('LMOVE', KEYS[1], KEYS[2], 'RIGHT', 'LEFT')
+        if not item then
+            break
+        end
+        items[#items + 1] = item
+    end
+    if #items > 0 then
+        redis.call('SET', KEYS[3], '1', 'EX', ARGV[2])
+    end
+    return items
+    """
+
+    # newest first onto the consuming end, so the oldest is popped first again
+    RECOVER = """
+    if redis.call('EXISTS', KEYS[2]) == 1 then
+        return 0
+    end
+    local moved = 0
+    while redis.call('LMOVE', KEYS[1], KEYS[3], 'LEFT', 'RIGHT') do
+        moved = moved + 1
+    end
+    return moved
+    """
+
+    def __init__(self, connection, worker_id=None, lease_seconds=300):
+        self.connection = connection
+        self.worker_id = worker_id or _worker_id
+        self.lease_seconds = lease_seconds
+        self._pop = connection.register_script(self.POP)
+        self._recover = connection.register_script(self.RECOVER)
+
+    @property
+    def processing_key(self):
+        return PROCESSING_PREFIX + self.worker_id
+
+    def push(self, messages):
+        if messages:
+            self.connection.lpush(QUEUE_KEY, *[json.dumps(message) for message in messages])
+
+    def pop(self, count):
+        items = self._pop(
+            keys=[QUEUE_KEY, self.processing_key, LEASE_PREFIX + self.worker_id],
+            args=[count, self.lease_seconds],
+        )
+        return [json.loads(item) for item in items]
+
+    def ack(self, requeue=()):
+        """The popped batch is done; ``requeue`` goes back on the queue."""
+        pipe = self.connection.pipeline()
+        if requeue:
+            pipe.lpush(QUEUE_KEY, *[json.dumps(message) for message in requeue])
+        pipe.delete(self.processing_key, LEASE_PREFIX + self.worker_id)
+        pipe.execute()
+
+    def recover(self):
+        """Requeue the batches of processes whose lease expired. Returns messages requeued."""
+        recovered = 0
+        for key in self.connection.scan_iter(match=PROCESSING_PREFIX + "*"):
+            worker_id = key.decode()[len(PROCESSING_PREFIX):]
+            if worker_id != self.worker_id:
+                recovered += self._recover(keys=[key, LEASE_PREFIX + worker_id, QUEUE_KEY])
+        return recovered
+
+    def __len__(self):
+        return self.connection.llen(QUEUE_KEY)
+
+
+class LocalMailQueue:
+    def __init__(self):
+        self.items = deque()
+        self.lock = threading.Lock()
+
+    def push(self, messages):
+        with self.lock:
+            self.items.extendleft(messages)
+
+    def pop(self, count):
+        with self.lock:
+            return [self.items.pop() for _ in range(min(count, len(self.items)))]
+
+    def ack(self, requeue=()):
+        self.push(requeue)
+
+    def recover(self):
+        # nothing outlives this process
+        return 0
+
+    def __len__(self):
+        return len(self.items)
+
+
+_local_queue = LocalMailQueue()
+
+
+def get_queue():
+    try:
+        from django_redis import get_redis_connection
+        return RedisMailQueue(get_redis_connection("default"), lease_seconds=settings.MAIL_BATCH["LEASE_SECONDS"])
+    except (ImportError, NotImplementedError):
+        return _local_queue
+
+
+def _after_fork():
+    global _worker_id
+    _worker_id = _new_worker_id()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def enqueue(kind, user_id):
+    """Queue a ``kind`` email (users.emails.KINDS) to a user. Returns True when the queue is due for a flush."""
+    if kind not in emails.KINDS:
+        raise ValueError(f"Unknown email kind {kind!r}")
+    config = settings.MAIL_BATCH
+    queue = get_queue()
+    queue.push([{
+        "kind": kind,
+        "user_id": user_id,
+        "enqueued_at": time.time(),
+        "attempts": 0,
+    }])
+    metrics.incr("mail_enqueued_total")
+    return config["FLUSH_INTERVAL"] == 0 or len(queue) >= config["BATCH_SIZE"]
+
+
+def _render(message, user, connection):
+    subject, body = emails.KINDS[message["kind"]](user)
+    return EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL, [user.email], connection=connection)
+
+
+def _send_batch(batch):
+    """Render and send ``batch`` over one SMTP connection, return (messages sent, messages that failed)."""
+    sent = 0
+    failed = []
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception:
+        logger.exception("SMTP connection failed, requeueing %d messages", len(batch))
+        return 0, list(batch)
+
+    try:
+        users = get_user_model().objects.in_bulk({message["user_id"] for message in batch})
+        for index, message in enumerate(batch):
+            user = users.get(message["user_id"])
+            if user is None:
+                metrics.incr("mail_dropped_total")
+                logger.warning("Dropping %s mail to deleted user %s", message["kind"], message["user_id"])
+                continue
+            try:
+                email = _render(message, user, connection)
+            except Exception:
+                logger.exception("Rendering %s mail to user %s failed", message["kind"], message["user_id"])
+                failed.append(message)
+                continue
+            try:
+                email.send()
+            except Exception:
+                logger.exception("Sending %s mail to user %s failed", message["kind"], message["user_id"])
+                failed.append(message)
+                # The SMTP session may be unusable now, start a fresh one
+                try:
+                    connection.close()
+                    connection.open()
+                except Exception:
+                    logger.exception("SMTP reconnect failed")
+                    failed.extend(batch[index + 1:])
+                    break
+                continue
+            sent += 1
+            metrics.observe("mail_delivery_latency_seconds", time.time() - message["enqueued_at"])
+    finally:
+        connection.close()
+    return sent, failed
+
+
+def flush(max_batches=None):
+    """Drain the queue in BATCH_SIZE groups, one SMTP connection per batch."""
+    config = settings.MAIL_BATCH
+    queue = get_queue()
+    sent = batches = 0
+
+    recovered = queue.recover()
+    if recovered:
+        metrics.incr("mail_recovered_total", recovered)
+        logger.warning("Requeued %d messages left unsent by a dead worker", recovered)
+
+    while max_batches is None or batches < max_batches:
+        batch = queue.pop(config["BATCH_SIZE"])
+        if not batch:
+            break
+        batches += 1
+        metrics.observe("mail_batch_size", len(batch))
+
+        batch_sent, failed = _send_batch(batch)
+        sent += batch_sent
+        metrics.incr("mail_sent_total", batch_sent)
+        if not failed:
+            queue.ack()
+            continue
+
+        requeue = []
+        for message in failed:
+            message["attempts"] += 1
+            if message["attempts"] >= config["MAX_ATTEMPTS"]:
+                metrics.incr("mail_dropped_total")
+                logger.error(
+                    "Dropping %s mail to user %s after %d attempts", message["kind"], message["user_id"], message["attempts"],
+                )
+            else:
+                requeue.append(message)
+        metrics.incr("mail_failed_total", len(failed))
+        queue.ack(requeue)
+        # Do not spin on a failing server, the next scheduled flush retries
+        break
+
+    return sent
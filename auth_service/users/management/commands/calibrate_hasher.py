@@ -0,0 +1,107 @@
+import statistics
+import time
+
+from django.contrib.auth import hashers
+from django.core.management.base import BaseCommand
+
+
+PASSWORD = "calibrate-Hasher-password-1"
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark PBKDF2/Argon2/scrypt on this machine and recommend parameters "
+        "that hit a target latency per hash and a target logins/sec per core."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--target-ms", type=float, default=250.0, help="Target time per hash in milliseconds.")
+        parser.add_argument(
+            "--logins-per-core", type=float, default=0,
+            help="Target logins/sec per core; lowers the target time to 1000 / value ms when stricter.",
+        )
+        parser.add_argument(
+            "--algorithms", nargs="+", default=["pbkdf2", "argon2", "scrypt"],
+            choices=["pbkdf2", "argon2", "scrypt"],
+        )
+        parser.add_argument("--samples", type=int, default=5, help="Hashes timed per measurement.")
+
+    def handle(self, *args, **options):
+        target_ms = options["target_ms"]
+        if options["logins_per_core"]:
+            target_ms = min(target_ms, 1000.0 / options["logins_per_core"])
+        self.samples = options["samples"]
+
+        self.stdout.write(f"Target: {target_ms:.1f} ms per hash ({1000.0 / target_ms:.1f} logins/sec per core)\n")
+
+        for name in options["algorithms"]:
+            calibrate = getattr(self, f"calibrate_{name}")
+            result = calibrate(target_ms)
+            if result is None:
+                continue
+            params, elapsed_ms = result
+            self.stdout.write(self.style.SUCCESS(
+                f"{name}: {elapsed_ms:.1f} ms per hash, {1000.0 / elapsed_ms:.1f} logins/sec per core"
+            ))
+            self.stdout.write(f"  PASSWORD_HASHER={name}")
+            for key, value in params.items():
+                self.stdout.write(f"  {key}={value}")
+            self.stdout.write("")
+
+    def measure(self, hasher):
+        salt = hasher.salt()
+        timings = []
+        for _ in range(self.samples):
+            start = time.perf_counter()
+            hasher.encode(PASSWORD, salt)
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
+
+    # PBKDF2 time is linear in the iteration count
+    def calibrate_pbkdf2(self, target_ms):
+        hasher = hashers.PBKDF2PasswordHasher()
+        hasher.iterations = 100_000
+        elapsed = self.measure(hasher)
+        hasher.iterations = max(int(hasher.iterations * target_ms / elapsed) // 1000 * 1000, 1000)
+        return {"PBKDF2_ITERATIONS": hasher.iterations}, self.measure(hasher)
+
+    # Argon2: keep Django's memory cost and scale the time cost
+    def calibrate_argon2(self, target_ms):
+        hasher = hashers.Argon2PasswordHasher()
+        try:
+            hasher._load_library()
+        except ValueError:
+            self.stdout.write(self.style.WARNING("argon2: skipped, argon2-cffi is not installed\n"))
+            return None
+
+        hasher.time_cost = 1
+        elapsed = self.measure(hasher)
+        hasher.time_cost = max(int(target_ms / elapsed), 1)
+        params = {
+            "ARGON2_TIME_COST": hasher.time_cost,
+            "ARGON2_MEMORY_COST": hasher.memory_cost,
+            "ARGON2_PARALLELISM": hasher.parallelism,
+        }
+        return params, self.measure(hasher)
+
+    # scrypt: largest power-of-two work factor that stays under the target
+    def calibrate_scrypt(self, target_ms):
+        hasher = hashers.ScryptPasswordHasher()
+        best = None
+        work_factor = 2**12
+        while work_factor <= 2**22:
+            hasher.work_factor = work_factor
+            hasher.maxmem = 256 * work_factor * hasher.block_size
+            elapsed = self.measure(hasher)
+            if best is not None and elapsed > target_ms:
+                break
+            best = (work_factor, elapsed)
+            work_factor *= 2
+
+        work_factor, elapsed = best
+        params = {
+            "SCRYPT_WORK_FACTOR": work_factor,
+            "SCRYPT_BLOCK_SIZE": hasher.block_size,
+            "SCRYPT_PARALLELISM": hasher.parallelism,
+        }
+        return params, elapsed
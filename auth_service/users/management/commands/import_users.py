@@ -0,0 +1,42 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand
+
+from users.importer import READERS, UserImporter, detect_format, open_text, text_stream
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk import users from CSV or JSONL (columns: email, first_name, last_name, role, "
+        "password or password_hash). Writes a JSONL report of rejected rows and a summary."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Input file, or - for stdin.")
+        parser.add_argument("--format", choices=list(READERS), help="Defaults to the file extension, else csv.")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--workers", type=int, default=0, help="Hashing processes, defaults to the CPU count.")
+        parser.add_argument("--activate", action="store_true", help="Create users as active (no email verification).")
+        parser.add_argument("--report", help="Write the report here instead of stdout.")
+
+    def handle(self, *args, **options):
+        fmt = options["format"] or detect_format(options["path"])
+        if options["path"] == "-":
+            source = text_stream(sys.stdin.buffer)
+        else:
+            source = open_text(options["path"])
+        report = open(options["report"], "w") if options["report"] else self.stdout
+
+        importer = UserImporter(
+            batch_size=options["batch_size"],
+            workers=options["workers"] or None,
+            activate=options["activate"],
+        )
+        try:
+            for entry in importer.run(READERS[fmt](source)):
+                report.write(json.dumps(entry) + "\n")
+        finally:
+            source.close()
+            if report is not self.stdout:
+                report.close()
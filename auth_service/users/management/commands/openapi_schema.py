@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from users import schema
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate the OpenAPI schema served at api/schema/ and store it gzipped in OPENAPI_SCHEMA['FILE'], "
+        "or with --check fail when the stored schema no longer matches the code."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--file", default=None, help="Defaults to OPENAPI_SCHEMA['FILE'].")
+        parser.add_argument("--check", action="store_true", help="Exit non-zero when the stored schema is stale.")
+
+    def handle(self, *args, **options):
+        path = options["file"] or settings.OPENAPI_SCHEMA["FILE"]
+        if options["check"]:
+            if schema.is_stale(path):
+                raise CommandError(f"{path} is missing or stale, run `manage.py openapi_schema`.")
+            self.stdout.write(self.style.SUCCESS(f"{path} is up to date"))
+            return
+
+        document = schema.write(path)
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {path}: {len(document.body)} bytes, {len(document.gzip)} gzipped, ETag {document.etag(None)}"
+        ))
@@ -0,0 +1,22 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from users.purge import purge_expired
+
+
+class Command(BaseCommand):
+    help = "Delete expired OTPs, reset tokens and outstanding JWTs in bounded chunks (same as the beat task)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=None, help="Rows per DELETE, defaults to PURGE['CHUNK_SIZE'].")
+        parser.add_argument("--sleep-ratio", type=float, default=None, help="Sleep this many times each chunk's duration.")
+        parser.add_argument("--max-seconds", type=float, default=None, help="Stop after this long, 0 for no limit.")
+
+    def handle(self, *args, **options):
+        report = purge_expired(
+            chunk_size=options["chunk_size"],
+            sleep_ratio=options["sleep_ratio"],
+            max_seconds=options["max_seconds"],
+        )
+        self.stdout.write(json.dumps(report))
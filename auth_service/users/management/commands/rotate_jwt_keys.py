@@ -0,0 +1,57 @@
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a new JWT signing key in JWT_KEYS_DIR. The newest key signs new tokens, "
+        "older keys keep verifying until they are pruned."
+    )
+    # The URLconf loads the key ring, which fails before the first key exists
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--algorithm", choices=["RS256", "EdDSA"], default="RS256")
+        parser.add_argument(
+            "--keep", type=int, default=3,
+            help="Keys to keep including the new one. Only prune keys older than the refresh token lifetime.",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.JWT_KEYS_DIR:
+            raise CommandError("JWT_KEYS_DIR is not set.")
+
+        directory = Path(settings.JWT_KEYS_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        if options["algorithm"] == "RS256":
+            private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        else:
+            private_key = ed25519.Ed25519PrivateKey.generate()
+
+        pem = private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
+        )
+
+        # kids sort by creation time, the last one is the active key
+        kid = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+        path = directory / f"{kid}.pem"
+        if path.exists():
+            raise CommandError(f"Key {kid} already exists, try again in a second.")
+
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(pem)
+        self.stdout.write(self.style.SUCCESS(f"Created {options['algorithm']} key {kid}"))
+
+        for old in sorted(directory.glob("*.pem"))[:-options["keep"]] if options["keep"] > 0 else []:
+            old.unlink()
+            self.stdout.write(f"Removed key {old.stem}")
@@ -0,0 +1,71 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from users.startup import ROLES, parse_importtime
+
+
+CHILD = "from users.startup import profile_child; profile_child({role!r}, {memory!r})"
+
+
+class Command(BaseCommand):
+    help = (
+        "Boot each service role in a fresh interpreter and report startup time, RSS, and import "
+        "time and allocated memory per package."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--role", nargs="+", choices=ROLES, default=list(ROLES), dest="roles")
+        parser.add_argument("--top", type=int, default=15, help="Packages listed per role.")
+        parser.add_argument("--repeat", type=int, default=1, help="Boots per role, the fastest is reported.")
+        parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc boot.")
+        parser.add_argument("--json", action="store_true", help="Print one JSON line per role.")
+
+    def boot(self, role, memory):
+        env = {
+            **os.environ,
+            "DJANGO_SETTINGS_MODULE": os.environ.get("DJANGO_SETTINGS_MODULE", settings.SETTINGS_MODULE),
+            "SERVICE_ROLE": role,
+        }
+        args = [sys.executable] + ([] if memory else ["-X", "importtime"])
+        completed = subprocess.run(
+            args + ["-c", CHILD.format(role=role, memory=memory)],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+        )
+        if completed.returncode:
+            raise CommandError(f"Booting the {role} role failed:\n{completed.stderr[-2000:]}")
+        return json.loads(completed.stdout.strip().splitlines()[-1]), completed.stderr.splitlines()
+
+    def handle(self, *args, **options):
+        for role in options["roles"]:
+            result, stderr = min(
+                (self.boot(role, memory=False) for _ in range(options["repeat"])), key=lambda run: run[0]["boot_ms"],
+            )
+            result["import_us"] = parse_importtime(stderr)
+            if not options["no_memory"]:
+                result["allocated_bytes"] = self.boot(role, memory=True)[0]["allocated_bytes"]
+
+            if options["json"]:
+                self.stdout.write(json.dumps(result))
+            else:
+                self.report(result, options["top"])
+
+    def report(self, result, top):
+        allocated = result.get("allocated_bytes", {})
+        self.stdout.write(self.style.SUCCESS(
+            f"{result['role']}: {result['boot_ms']:.0f} ms to boot, {result['rss_bytes'] / 2**20:.1f} MiB RSS, "
+            f"{result['modules']} modules"
+        ))
+        if "copied_bytes" in result:
+            self.stdout.write(
+                f"  a forked worker's first full GC copies {result['copied_bytes'] / 2**20:.1f} MiB, "
+                f"{result['copied_frozen_bytes'] / 2**20:.1f} MiB after gc.freeze()"
+            )
+        self.stdout.write(f"  {'package':<36} {'import ms':>10} {'alloc KiB':>10}")
+        for package, micros in sorted(result["import_us"].items(), key=lambda item: -item[1])[:top]:
+            self.stdout.write(f"  {package:<36} {micros / 1000:>10.1f} {allocated.get(package, 0) / 1024:>10.0f}")
+        self.stdout.write("")
@@ -1,5 +1,7 @@
 from django.contrib.auth.models import BaseUserManager
 
+from . import hashing
+
 class CustomUserManager(BaseUserManager):
     # For User
     def create_user(self, email, password=None, first_name="", last_name="", role="Customer", **extra_fields):
@@ -20,7 +22,7 @@ class CustomUserManager(BaseUserManager):
             **extra_fields,
         )
         
-        user.set_password(password)
+        hashing.set_password(user, password)
         user.save(using=self._db)
         return user
 
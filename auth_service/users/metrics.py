@@ -0,0 +1,396 @@
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+
+# In-process metrics registry.
+# Counters and histograms are aggregated in memory; recording is a dict update
+# under a lock so it is cheap enough for the request path. Labels are passed
+# as keyword arguments and must have a small, fixed set of values.
+#
+# With METRICS["MULTIPROC_DIR"] set, every process (gunicorn workers, Celery
+# workers) writes its totals to <dir>/<pid>-<id>.json every FLUSH_INTERVAL
+# seconds and at exit; the random id keeps a later process that reuses the
+# pid from overwriting the file. /metrics sums all files, so any worker can
+# answer a scrape. The totals of exited processes are folded into
+# <dir>/archive.json, by gunicorn's child_exit hook (mark_process_dead()) or
+# on the next scrape (prune()), so totals never go backwards and files do
+# not pile up. The directory is per host, pids are only checked locally.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Histograms that are not latencies in seconds
+BUCKETS = {
+    "db_queries_per_request": (0, 1, 2, 3, 4, 5, 8, 13, 21, 50, 100),
+    "mail_batch_size": (1, 5, 10, 25, 50, 100, 250, 500, 1000),
+}
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_histograms = {}
+_flusher_pid = None
+_instance = uuid.uuid4().hex[:12]
+
+ARCHIVE = "archive.json"
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())) if labels else ())
+
+
+def incr(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] += value
+    if _flusher_pid != os.getpid():
+        _start_flusher()
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    bounds = BUCKETS.get(name, LATENCY_BUCKETS)
+    index = bisect_left(bounds, value)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            # [per-bucket counts (last one is +Inf), count, sum, max]
+            histogram = _histograms[key] = [[0] * (len(bounds) + 1), 0, 0.0, value]
+        histogram[0][index] += 1
+        histogram[1] += 1
+        histogram[2] += value
+        if value > histogram[3]:
+            histogram[3] = value
+    if _flusher_pid != os.getpid():
+        _start_flusher()
+
+
+@contextmanager
+def timer(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def _format(key):
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+
+def snapshot():
+    """Counters and histogram summaries of this process, keyed by name{labels}."""
+    with _lock:
+        return {
+            "counters": {_format(key): value for key, value in _counters.items()},
+            "timings": {
+                _format(key): {"count": count, "sum": total, "max": peak}
+                for key, (_, count, total, peak) in _histograms.items()
+            },
+        }
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+# Export
+def _dump():
+    with _lock:
+        return {
+            "counters": [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            "histograms": [
+                [name, list(labels), buckets[:], count, total]
+                for (name, labels), (buckets, count, total, _) in _histograms.items()
+            ],
+        }
+
+
+def _multiproc_dir():
+    return getattr(settings, "METRICS", {}).get("MULTIPROC_DIR")
+
+
+def _own_file():
+    return f"{os.getpid()}-{_instance}.json"
+
+
+def _write_json(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump(data, fh)
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def flush():
+    """Write this process's totals to MULTIPROC_DIR (no-op without one)."""
+    directory = _multiproc_dir()
+    if not directory:
+        return
+    _write_json(os.path.join(directory, _own_file()), _dump())
+
+
+def _flush_forever(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+def _start_flusher():
+    global _flusher_pid
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    if not _multiproc_dir():
+        return
+    interval = settings.METRICS["FLUSH_INTERVAL"]
+    threading.Thread(target=_flush_forever, args=(interval,), name="metrics-flush", daemon=True).start()
+    atexit.register(flush)
+
+
+def _after_fork():
+    # A forked worker starts from zero, its parent reports what it recorded
+    global _lock, _flusher_pid, _instance
+    _lock = threading.Lock()
+    _counters.clear()
+    _histograms.clear()
+    _flusher_pid = None
+    _instance = uuid.uuid4().hex[:12]
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _pid_of(filename):
+    # "<pid>-<id>.json", or "<pid>.json" as written before the id was added
+    head = filename[:-len(".json")].split("-", 1)[0]
+    return int(head) if head.isdigit() else None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists, owned by someone else
+        return True
+    return True
+
+
+def _process_files(directory):
+    return [name for name in os.listdir(directory) if name.endswith(".json") and _pid_of(name) is not None]
+
+
+def _merge(dumps):
+    counters = defaultdict(float)
+    histograms = {}
+    for dump in dumps:
+        for name, labels, value in dump["counters"]:
+            counters[(name, tuple(map(tuple, labels)))] += value
+        for name, labels, buckets, count, total in dump["histograms"]:
+            key = (name, tuple(map(tuple, labels)))
+            current = histograms.get(key)
+            if current is None or len(current[0]) != len(buckets):
+                histograms[key] = [list(buckets), count, total]
+            else:
+                current[0] = [a + b for a, b in zip(current[0], buckets)]
+                current[1] += count
+                current[2] += total
+    return counters, histograms
+
+
+@contextmanager
+def _directory_lock(directory):
+    """Held while the archive or the set of files changes, and while a scrape reads them."""
+    try:
+        import fcntl
+    except ImportError:
+        # no flock (Windows): nothing is folded, scrapes sum what is there
+        yield False
+        return
+    with open(os.path.join(directory, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield True
+
+
+def _fold(directory, filenames):
+    """Add ``filenames`` to the archive and delete them, under _directory_lock()."""
+    archive_path = os.path.join(directory, ARCHIVE)
+    archive = _read_json(archive_path) or {"counters": [], "histograms": [], "folded": []}
+    # files folded by a run that died before deleting them
+    folded = set(archive["folded"])
+    dumps = [archive]
+    names = []
+    for filename in filenames:
+        if filename in folded:
+            continue
+        dump = _read_json(os.path.join(directory, filename))
+        if dump is not None:
+            dumps.append(dump)
+            names.append(filename)
+    if names:
+        counters, histograms = _merge(dumps)
+        _write_json(archive_path, {
+            "counters": [[name, list(labels), value] for (name, labels), value in counters.items()],
+            "histograms": [
+                [name, list(labels), buckets, count, total]
+                for (name, labels), (buckets, count, total) in histograms.items()
+            ],
+            "folded": names,
+        })
+    for filename in [*folded, *names]:
+        try:
+            os.remove(os.path.join(directory, filename))
+        except FileNotFoundError:
+            pass
+    return len(names)
+
+
+def _fold_dead(directory):
+    dead = [name for name in _process_files(directory) if not _alive(_pid_of(name))]
+    return _fold(directory, dead) if dead else 0
+
+
+def mark_process_dead(pid, directory=None):
+    """Fold the files of exited process ``pid`` into the archive (gunicorn's child_exit hook)."""
+    directory = directory or _multiproc_dir()
+    if not directory:
+        return 0
+    with _directory_lock(directory) as locked:
+        if not locked:
+            return 0
+        return _fold(directory, [name for name in _process_files(directory) if _pid_of(name) == pid])
+
+
+def prune(directory=None):
+    """Fold the files of every process on this host that is no longer running."""
+    directory = directory or _multiproc_dir()
+    if not directory:
+        return 0
+    with _directory_lock(directory) as locked:
+        return _fold_dead(directory) if locked else 0
+
+
+def _read_directory(directory, locked):
+    if locked:
+        _fold_dead(directory)
+    own = _own_file()
+    archive = _read_json(os.path.join(directory, ARCHIVE))
+    folded = set(archive["folded"]) if archive else set()
+    dumps = [archive] if archive else []
+    for filename in _process_files(directory):
+        if filename == own or filename in folded:
+            continue
+        other = _read_json(os.path.join(directory, filename))
+        if other is not None:
+            dumps.append(other)
+    return dumps
+
+
+def collect():
+    """Merge this process's totals with the archive and every other process's last flush."""
+    dumps = [_dump()]
+    directory = _multiproc_dir()
+    if directory:
+        try:
+            # a fold running between reading the archive and the files would
+            # make totals dip or count a process twice
+            with _directory_lock(directory) as locked:
+                dumps += _read_directory(directory, locked)
+        except OSError:
+            # a read-only directory, sum what is there
+            dumps = [_dump(), *_read_directory(directory, False)]
+    return _merge(dumps)
+
+
+def render():
+    """Prometheus text exposition of collect()."""
+    from prometheus_client.core import CounterMetricFamily, HistogramMetricFamily
+    from prometheus_client.exposition import generate_latest
+
+    counters, histograms = collect()
+
+    class Collector:
+        def collect(self):
+            families = {}
+            for (name, labels), value in sorted(counters.items()):
+                base = name[:-len("_total")] if name.endswith("_total") else name
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = CounterMetricFamily(base, "", labels=[label for label, _ in labels])
+                family.add_metric([value for _, value in labels], value)
+            yield from families.values()
+
+            families = {}
+            for (name, labels), (buckets, count, total) in sorted(histograms.items()):
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = HistogramMetricFamily(name, "", labels=[label for label, _ in labels])
+                bounds = BUCKETS.get(name, LATENCY_BUCKETS)
+                cumulative, running = [], 0
+                for bound, bucket in zip([*map(str, bounds), "+Inf"], buckets):
+                    running += bucket
+                    cumulative.append((bound, running))
+                family.add_metric([value for _, value in labels], cumulative, total)
+            yield from families.values()
+
+    return generate_latest(Collector())
+
+
+# Request latency per URL name, method and status class
+class RequestMetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        return self.record(request, response, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        return self.record(request, response, time.perf_counter() - started)
+
+    def record(self, request, response, elapsed):
+        match = getattr(request, "resolver_match", None)
+        observe(
+            "http_request_duration_seconds", elapsed,
+            view=(match.url_name if match and match.url_name else "unmatched"),
+            method=request.method,
+            status=f"{response.status_code // 100}xx",
+        )
+        return response
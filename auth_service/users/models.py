@@ -1,10 +1,12 @@
 from django.db import models, transaction
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
 from django.utils import timezone
-from django.contrib.auth.hashers import make_password, check_password
 from datetime import timedelta
-import uuid
+import hashlib
+import hmac
+import secrets
 
+from . import routers
 from .manager import CustomUserManager
 
 
@@ -54,12 +56,23 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     @property
     def full_name(self):
         return self.get_full_name()
+
+    @property
+    def token_version(self):
+        # Changes whenever the role, active flag or password does, carried in
+        # access tokens as "ver" so holders can tell their claims are stale
+        if "password" not in self.__dict__ and "_token_version" in self.__dict__:
+            # a user cache copy without the hash (users/cache.py)
+            return self._token_version
+        state = f"{self.role}:{self.is_active}:{self.password}"
+        return hashlib.sha256(state.encode()).hexdigest()[:16]
     
 
 # Email 
 class EmailOTP(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="email_otps")
-    code = models.CharField(max_length=6, db_index=True)
+    # the code itself (DatabaseOTPBackend) or its HMAC-SHA256 hex digest (audit rows of RedisOTPBackend)
+    code = models.CharField(max_length=64, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
     used = models.BooleanField(default=False)
 
@@ -68,6 +81,10 @@ class EmailOTP(models.Model):
     class Meta:
         indexes = [
             models.Index(fields=['user', 'code']),
+            # Only live codes are ever looked up, keep that index small
+            models.Index(
+                fields=['user', 'code'], condition=models.Q(used=False), name='users_emailotp_live_idx',
+            ),
         ]
         ordering = ["-created_at"]
 
@@ -82,18 +99,27 @@ class EmailOTP(models.Model):
         return f"{self.user.email} - {self.code}"   
 
 
-# Password ResetToken 
+# Password ResetToken
+# Raw tokens are "<selector>.<verifier>": the selector is a public, indexed
+# lookup key and only a SHA-256 digest of the verifier is stored, so a reset
+# costs one indexed SELECT and one constant-time compare.
 class PasswordResetToken(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="password_reset_tokens")
-    token_hash = models.CharField(max_length=255, db_index=True)
+    selector = models.CharField(max_length=32, unique=True, null=True, blank=True)
+    token_hash = models.CharField(max_length=255)
     created_at = models.DateTimeField(auto_now_add=True)
     used = models.BooleanField(default=False)
 
     EXPIRY_MINUTES = 10
+    SEPARATOR = "."
 
     class Meta:
         indexes = [
-            models.Index(fields=["user", "used"])
+            models.Index(fields=["user", "used"]),
+            # Covers generate()'s "expire the previous tokens" UPDATE
+            models.Index(
+                fields=["user"], condition=models.Q(used=False), name="users_resettoken_live_idx",
+            ),
         ]
         ordering = ['-created_at']
 
@@ -104,22 +130,73 @@ class PasswordResetToken(models.Model):
         self.used = True
         self.save(update_fields=["used"])
 
+    @staticmethod
+    def hash_verifier(verifier):
+        # The verifier is 256 bits of randomness, a fast digest is enough
+        return hashlib.sha256(verifier.encode()).hexdigest()
+
+    @classmethod
+    def split_token(cls, raw_token):
+        selector, sep, verifier = (raw_token or "").partition(cls.SEPARATOR)
+        if not sep or not selector or not verifier:
+            return None, None
+        return selector, verifier
+
     @classmethod
     def generate(cls, user):
         with transaction.atomic():
             cls.objects.filter(user=user, used=False).update(used=True)
 
-            raw_token = uuid.uuid4().hex
-            hashed = make_password(raw_token)
-            obj = cls.objects.create(user=user, token_hash=hashed)
+            selector = secrets.token_hex(8)
+            verifier = secrets.token_urlsafe(32)
+            # saved from the instance, so the router pins the selector
+            obj = cls(user=user, selector=selector, token_hash=cls.hash_verifier(verifier))
+            obj.save(force_insert=True)
+
+        return f"{selector}{cls.SEPARATOR}{verifier}", obj
+
+    @classmethod
+    def lookup(cls, raw_token):
+        """Return the unused token matching ``raw_token`` or None (expiry is not checked)."""
+        selector, verifier = cls.split_token(raw_token)
+        if selector is None:
+            return None
+
+        # on the primary if the token was generated a moment ago
+        routers.set_lookup(cls, selector)
+        obj = cls.objects.select_related("user").filter(selector=selector, used=False).first()
+        if obj is None or not obj.check_verifier(verifier):
+            return None
+        return obj
+
+    def check_verifier(self, verifier):
+        return hmac.compare_digest(self.token_hash, self.hash_verifier(verifier))
 
-        return raw_token, obj
-    
     def verify(self, raw_token):
         if self.used or self.is_expired():
             return False
-        return check_password(raw_token, self.token_hash)
+        selector, verifier = self.split_token(raw_token)
+        if selector is None or selector != self.selector:
+            return False
+        return self.check_verifier(verifier)
     
     def __str__(self):
         return f"Reset token for {self.user.email}"
-    
\ No newline at end of file
+
+
+# Celery tasks waiting to be published (users/outbox.py)
+# Written in the transaction that makes the task's work visible, published
+# in id order once it commits and deleted in the same transaction as the
+# publish.
+class OutboxMessage(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    task = models.CharField(max_length=255)
+    args = models.JSONField(default=list)
+    kwargs = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self):
+        return f"{self.task} #{self.pk}"
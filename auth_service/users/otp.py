@@ -0,0 +1,158 @@
+import abc
+import hashlib
+import hmac
+import secrets
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .models import EmailOTP
+
+
+# Verification results
+VALID = "valid"
+INVALID = "invalid"
+EXPIRED = "expired"
+LOCKED = "locked"
+
+
+def generate_code():
+    return f"{secrets.randbelow(900000) + 100000}"
+
+
+# Email OTP storage.
+# issue() replaces any outstanding code for the user; verify() checks and
+# consumes it in one step and returns one of the results above.
+class BaseOTPBackend(abc.ABC):
+    expiry_seconds = EmailOTP.EXPIRY_MINUTES * 60
+
+    def __init__(self, max_attempts=5, audit=False):
+        self.max_attempts = max_attempts
+        self.audit = audit
+
+    @abc.abstractmethod
+    def issue(self, user):
+        """Store a new code for ``user`` and return it in clear text."""
+
+    @abc.abstractmethod
+    def verify(self, user, code):
+        """Check and consume ``code``, return VALID, INVALID, EXPIRED or LOCKED."""
+
+
+# The EmailOTP table (previous behaviour, no attempt limit)
+class DatabaseOTPBackend(BaseOTPBackend):
+    def issue(self, user):
+        EmailOTP.objects.filter(user=user, used=False).delete()
+        code = generate_code()
+        # saved from the instance, so the router pins the user
+        EmailOTP(user=user, code=code).save(force_insert=True)
+        return code
+
+    def verify(self, user, code):
+        try:
+            otp = EmailOTP.objects.filter(user=user, code=code, used=False).latest("created_at")
+        except EmailOTP.DoesNotExist:
+            return INVALID
+
+        if otp.is_expired():
+            return EXPIRED
+
+        otp.mark_used()
+        return VALID
+
+
+# Redis hash per user: {code: <hmac>, attempts: <n>} with a native TTL.
+# Verify-and-consume and the failed-attempt counter run in one Lua script,
+# so concurrent guesses cannot race past MAX_ATTEMPTS. An expired code is
+# simply gone, so "expired" and "never issued" both report EXPIRED.
+# With audit=True every issue/consume is also recorded in EmailOTP, under
+# the same HMAC digest rather than the code.
+class RedisOTPBackend(BaseOTPBackend):
+    VERIFY_SCRIPT = """
+    local stored = redis.call('HGET', KEYS[1], 'code')
+    if not stored then
+        return -1
+    end
+    local attempts = tonumber(redis.call('HGET', KEYS[1], 'attempts') or '0')
+    if attempts >= tonumber(ARGV[2]) then
+        return -2
+    end
+    if stored == ARGV[1] then
+        redis.call('DEL', KEYS[1])
+        return 1
+    end
+    redis.call('HINCRBY', KEYS[1], 'attempts', 1)
+    return 0
+    """
+
+    RESULTS = {1: VALID, 0: INVALID, -1: EXPIRED, -2: LOCKED}
+
+    def __init__(self, connection=None, **kwargs):
+        super().__init__(**kwargs)
+        if connection is None:
+            from django_redis import get_redis_connection
+            connection = get_redis_connection("default")
+        self.connection = connection
+        self._verify = connection.register_script(self.VERIFY_SCRIPT)
+
+    @staticmethod
+    def _key(user):
+        return f"auth:otp:{user.pk}"
+
+    @staticmethod
+    def _digest(user, code):
+        # Codes are never stored in clear text
+        message = f"{user.pk}:{code}".encode()
+        return hmac.new(settings.SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()
+
+    def issue(self, user):
+        code = generate_code()
+        digest = self._digest(user, code)
+        key = self._key(user)
+        with metrics.timer("cache_operation_seconds", cache="otp"):
+            pipe = self.connection.pipeline()
+            pipe.delete(key)
+            pipe.hset(key, mapping={"code": digest, "attempts": 0})
+            pipe.expire(key, self.expiry_seconds)
+            pipe.execute()
+
+        if self.audit:
+            EmailOTP.objects.filter(user=user, used=False).update(used=True)
+            EmailOTP(user=user, code=digest).save(force_insert=True)
+        return code
+
+    def verify(self, user, code):
+        digest = self._digest(user, code)
+        with metrics.timer("cache_operation_seconds", cache="otp"):
+            outcome = self._verify(keys=[self._key(user)], args=[digest, self.max_attempts])
+        result = self.RESULTS[int(outcome)]
+
+        if result == VALID and self.audit:
+            EmailOTP.objects.filter(user=user, code=digest, used=False).update(used=True)
+        return result
+
+
+_backend = None
+
+
+def get_otp_backend():
+    global _backend
+    if _backend is None:
+        config = settings.OTP
+        _backend = import_string(config["BACKEND"])(
+            max_attempts=config["MAX_ATTEMPTS"],
+            audit=config["AUDIT"],
+        )
+    return _backend
+
+
+def issue(user):
+    metrics.incr("otp_issued_total")
+    return get_otp_backend().issue(user)
+
+
+def verify(user, code):
+    result = get_otp_backend().verify(user, code)
+    metrics.incr("otp_verify_total", result=result)
+    return result
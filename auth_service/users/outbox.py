@@ -0,0 +1,157 @@
+import functools
+import logging
+import os
+import threading
+from contextlib import nullcontext
+
+from celery import current_app
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from . import metrics, queries
+from .models import OutboxMessage
+
+
+logger = logging.getLogger(__name__)
+
+TASK_ID_PREFIX = "outbox-"
+
+
+# Transactional outbox for Celery.
+# enqueue() stores a task call as a row in the caller's transaction, so the
+# task exists exactly when the rows it reads do, and asks for a dispatch once
+# that transaction commits. dispatch() locks the oldest BATCH_SIZE rows,
+# publishes them in id order over one broker connection and deletes them
+# before the lock is released. With OUTBOX["BACKGROUND"] the post-commit
+# dispatch runs on a thread of this process and the request never waits for
+# the broker; the beat task publishes whatever a dead process left behind.
+# Publishing is at-least-once: a process dying between the publish and the
+# commit, or a broker redelivery, publishes a message again under the same
+# task id, and tasks decorated with @idempotent skip the second run.
+def enqueue(task, *args, **kwargs):
+    """task.delay(*args, **kwargs) once the current transaction commits."""
+    OutboxMessage.objects.create(task=task.name, args=list(args), kwargs=kwargs)
+    transaction.on_commit(_notify)
+
+
+def _producer():
+    # eager tasks run in place, there is no broker to connect to
+    if current_app.conf.task_always_eager:
+        return nullcontext()
+    return current_app.producer_or_acquire()
+
+
+def dispatch(batch_size=None):
+    """Publish and delete pending messages, oldest first. Returns messages published."""
+    batch_size = batch_size or settings.OUTBOX["BATCH_SIZE"]
+    published = 0
+
+    while True:
+        error = None
+        with transaction.atomic():
+            # FOR UPDATE without SKIP LOCKED: a concurrent dispatcher waits for
+            # this batch instead of publishing newer messages ahead of it
+            batch = list(OutboxMessage.objects.select_for_update().order_by("id")[:batch_size])
+            if not batch:
+                break
+            sent = []
+            try:
+                with metrics.timer("outbox_publish_seconds"), _producer() as producer:
+                    options = {"producer": producer} if producer is not None else {}
+                    for message in batch:
+                        current_app.tasks[message.task].apply_async(
+                            message.args, message.kwargs, task_id=f"{TASK_ID_PREFIX}{message.pk}", **options,
+                        )
+                        sent.append(message.pk)
+            except Exception as exc:
+                # keep what was published out of the retry, only the rest is sent again
+                error = exc
+            OutboxMessage.objects.filter(pk__in=sent).delete()
+
+        published += len(sent)
+        metrics.incr("outbox_published_total", len(sent))
+        if error is not None:
+            raise error
+        metrics.observe("outbox_lag_seconds", (timezone.now() - batch[0].created_at).total_seconds())
+        if len(batch) < batch_size:
+            break
+
+    return published
+
+
+def idempotent(func):
+    """
+    Run a bound task once per outbox message: a second delivery of the same
+    outbox task id within OUTBOX["DEDUPE_SECONDS"] is skipped. A run that
+    raises gives its claim back so Celery's retry runs it again.
+    """
+    @functools.wraps(func)
+    def wrapper(task, *args, **kwargs):
+        task_id = task.request.id or ""
+        if not task_id.startswith(TASK_ID_PREFIX):
+            return func(task, *args, **kwargs)
+
+        key = f"auth:outbox:done:{task_id}"
+        if not cache.add(key, 1, timeout=settings.OUTBOX["DEDUPE_SECONDS"]):
+            metrics.incr("outbox_duplicates_total")
+            logger.info("Skipping duplicate delivery of %s", task_id)
+            return None
+        try:
+            return func(task, *args, **kwargs)
+        except BaseException:
+            cache.delete(key)
+            raise
+    return wrapper
+
+
+_wakeup = threading.Event()
+_lock = threading.Lock()
+_dispatcher_pid = None
+
+
+def _dispatch_forever():
+    while True:
+        _wakeup.wait()
+        _wakeup.clear()
+        try:
+            dispatch()
+        except Exception:
+            logger.exception("Outbox dispatch failed, the beat task will retry")
+        finally:
+            close_old_connections()
+
+
+def _start_dispatcher():
+    global _dispatcher_pid
+    with _lock:
+        if _dispatcher_pid == os.getpid():
+            return
+        _dispatcher_pid = os.getpid()
+    threading.Thread(target=_dispatch_forever, name="outbox-dispatch", daemon=True).start()
+
+
+def _notify():
+    if settings.OUTBOX["BACKGROUND"]:
+        _start_dispatcher()
+        _wakeup.set()
+        return
+    try:
+        # the request's commit hook, not the request's queries
+        with queries.deferred():
+            dispatch()
+    except Exception:
+        logger.exception("Outbox dispatch failed, the beat task will retry")
+
+
+def _after_fork():
+    # the dispatcher thread does not survive a fork, a child starts its own
+    global _wakeup, _lock, _dispatcher_pid
+    _wakeup = threading.Event()
+    _lock = threading.Lock()
+    _dispatcher_pid = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
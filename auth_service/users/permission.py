@@ -1,6 +1,13 @@
+import hmac
+
+from django.conf import settings
 from rest_framework.permissions import BasePermission
 
-# Generic RBAC permission
+from .policy import get_policy
+
+# Generic RBAC permission.
+# Passes when the user's role is one of allowed_roles or inherits one of them
+# through ROLE_POLICY["HIERARCHY"] (users/policy.py).
 class RolePermission(BasePermission):
     allowed_roles = []
 
@@ -15,7 +22,28 @@ class RolePermission(BasePermission):
         if not roles:
             return False
         
-        return user.role in roles
+        policy = get_policy()
+        return policy.allows_any(user.role, policy.mask(tuple(roles)))
+
+
+# Named-permission check: the view's required_permissions must all be
+# granted to the user's role by ROLE_POLICY["PERMISSIONS"]
+class HasPermissions(BasePermission):
+    required_permissions = ()
+
+    def has_permission(self, request, view):
+        user = request.user
+
+        if not user or not user.is_authenticated:
+            return False
+
+        required = tuple(getattr(view, "required_permissions", self.required_permissions))
+
+        if not required:
+            return False
+
+        policy = get_policy()
+        return policy.allows_all(user.role, policy.mask(required))
 
 
 # Role-Specific permission
@@ -32,5 +60,15 @@ class IsCustomer(RolePermission):
     allowed_roles = ["Customer"]
 
 class IsHR(RolePermission):
-    allowed_roles = ["HR"]        
+    allowed_roles = ["HR"]
+
+
+# Service-to-service permission for the API gateway (introspection).
+# Clients send one of settings.INTROSPECTION["API_KEYS"] in X-Introspection-Key.
+class HasIntrospectionKey(BasePermission):
+    def has_permission(self, request, view):
+        key = request.headers.get("X-Introspection-Key", "")
+        if not key:
+            return False
+        return any(hmac.compare_digest(key, allowed) for allowed in settings.INTROSPECTION["API_KEYS"])
 
@@ -0,0 +1,165 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+logger = logging.getLogger(__name__)
+
+
+# Role policy compiled to integer bitmasks.
+# Every role in CustomUser.ROLES and every named permission gets one bit. A
+# role's grant mask holds its own bit, the bits of every role it inherits
+# through HIERARCHY (transitively) and the bits of every permission granted
+# to any of those roles, so a check is an AND against two precompiled ints.
+class Policy:
+    __slots__ = ("bits", "grants", "_masks")
+
+    def __init__(self, roles, hierarchy, permissions):
+        roles = list(roles)
+        for name in list(hierarchy) + [r for parents in hierarchy.values() for r in parents]:
+            if name not in roles:
+                raise ValueError(f"Unknown role {name!r} in the role hierarchy")
+        for permission, granted in permissions.items():
+            if permission in roles:
+                raise ValueError(f"Permission {permission!r} has the name of a role")
+            for name in granted:
+                if name not in roles:
+                    raise ValueError(f"Unknown role {name!r} granted {permission!r}")
+
+        self.bits = {name: 1 << index for index, name in enumerate([*roles, *sorted(permissions)])}
+        self.grants = {}
+        self._masks = {}
+
+        for role in roles:
+            inherited = self._closure(role, hierarchy)
+            mask = 0
+            for name in inherited:
+                mask |= self.bits[name]
+            for permission, granted in permissions.items():
+                if inherited.intersection(granted):
+                    mask |= self.bits[permission]
+            self.grants[role] = mask
+
+    @staticmethod
+    def _closure(role, hierarchy):
+        seen = set()
+        path = []
+
+        def visit(name):
+            if name in path:
+                raise ValueError(f"Role hierarchy cycle: {' -> '.join(path[path.index(name):] + [name])}")
+            if name in seen:
+                return
+            path.append(name)
+            for child in hierarchy.get(name, ()):
+                visit(child)
+            path.pop()
+            seen.add(name)
+
+        visit(role)
+        return seen
+
+    def mask(self, names):
+        """OR of the bits of ``names`` (a tuple of roles and/or permissions), memoized."""
+        mask = self._masks.get(names)
+        if mask is None:
+            mask = 0
+            for name in names:
+                try:
+                    mask |= self.bits[name]
+                except KeyError:
+                    raise ValueError(f"Unknown role or permission {name!r}") from None
+            self._masks[names] = mask
+        return mask
+
+    def allows_all(self, role, mask):
+        return self.grants.get(role, 0) & mask == mask
+
+    def allows_any(self, role, mask):
+        return self.grants.get(role, 0) & mask != 0
+
+
+def compile_policy(config=None):
+    from .models import CustomUser
+
+    config = config or settings.ROLE_POLICY
+    hierarchy, permissions = config["HIERARCHY"], config["PERMISSIONS"]
+    if config.get("FILE"):
+        with open(config["FILE"]) as fh:
+            overrides = json.load(fh)
+        hierarchy = overrides.get("HIERARCHY", hierarchy)
+        permissions = overrides.get("PERMISSIONS", permissions)
+    return Policy([role for role, _ in CustomUser.ROLES], hierarchy, permissions)
+
+
+# The process-wide policy. With ROLE_POLICY["FILE"] set the file's mtime is
+# checked at most every RELOAD_INTERVAL seconds and the policy recompiled when
+# it changes; a file that fails to compile is logged and the last good policy
+# stays in force. The reload settings are read once in load(), settings
+# access costs more than the permission check itself.
+_policy = None
+_file = ""
+_interval = 0
+_mtime = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def _file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load():
+    global _policy, _file, _interval, _mtime, _checked_at
+    with _lock:
+        config = settings.ROLE_POLICY
+        _file = config.get("FILE") or ""
+        _interval = config["RELOAD_INTERVAL"]
+        _mtime = _file_mtime(_file) if _file else None
+        _checked_at = time.monotonic()
+        _policy = compile_policy(config)
+    return _policy
+
+
+def _reload_if_stale():
+    global _policy, _mtime, _checked_at
+    if time.monotonic() - _checked_at < _interval:
+        return
+    with _lock:
+        if time.monotonic() - _checked_at < _interval:
+            return
+        _checked_at = time.monotonic()
+        mtime = _file_mtime(_file)
+        if mtime == _mtime:
+            return
+        try:
+            _policy = compile_policy()
+        except (OSError, ValueError, KeyError):
+            logger.exception("Reloading the role policy from %s failed", _file)
+        else:
+            logger.info("Reloaded the role policy from %s", _file)
+        _mtime = mtime
+
+
+def get_policy():
+    if _policy is None:
+        return load()
+    if _file:
+        _reload_if_stale()
+    return _policy
+
+
+@receiver(setting_changed)
+def _reset(setting, **kwargs):
+    global _policy
+    if setting == "ROLE_POLICY":
+        _policy = None
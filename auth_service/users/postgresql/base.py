@@ -0,0 +1,37 @@
+import os
+
+from django.db.backends.postgresql.base import DatabaseWrapper as PostgresDatabaseWrapper
+
+from .. import metrics
+
+
+# Django's PostgreSQL backend with connection metrics.
+# Every new connection (a psycopg_pool checkout with DB_POOL, a full connect
+# with TLS and auth without it) is timed in db_connection_acquire_seconds,
+# so pool waits and reconnect costs show up on /metrics.
+class DatabaseWrapper(PostgresDatabaseWrapper):
+    def get_new_connection(self, conn_params):
+        mode = "pool" if self.pool else "connect"
+        try:
+            with metrics.timer("db_connection_acquire_seconds", alias=self.alias, mode=mode):
+                return super().get_new_connection(conn_params)
+        except Exception:
+            metrics.incr("db_connection_errors_total", alias=self.alias, mode=mode)
+            raise
+
+
+# Pools are per process. A forked child (gunicorn and Celery prefork workers,
+# the import hashing pool) must not check out the parent's connections, so it
+# drops the inherited pools and opens its own on first use. They are kept
+# referenced so that collecting them never closes the parent's sockets.
+_inherited_pools = []
+
+
+def _forget_inherited_pools():
+    pools = PostgresDatabaseWrapper._connection_pools
+    _inherited_pools.extend(pools.values())
+    pools.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_inherited_pools)
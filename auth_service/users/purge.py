@@ -0,0 +1,111 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+from . import metrics
+from .models import EmailOTP, PasswordResetToken
+
+
+logger = logging.getLogger(__name__)
+
+
+# Chunked purge of dead rows.
+# Each chunk finds the next CHUNK_SIZE matching primary keys and deletes the
+# pk range they span in its own transaction, so locks are held for one short
+# DELETE at a time. Between chunks the purge sleeps SLEEP_RATIO times as long
+# as the chunk took, which caps its share of database time and gives replicas
+# room to catch up. A run stops after MAX_SECONDS and resumes on the next beat.
+class Purger:
+    def __init__(self, chunk_size=None, sleep_ratio=None, max_seconds=None):
+        config = settings.PURGE
+        self.chunk_size = chunk_size or config["CHUNK_SIZE"]
+        self.sleep_ratio = config["SLEEP_RATIO"] if sleep_ratio is None else sleep_ratio
+        self.max_seconds = config["MAX_SECONDS"] if max_seconds is None else max_seconds
+        self.deadline = None
+
+    def out_of_time(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def purge(self, queryset, before_delete=None):
+        """Delete every row of ``queryset`` chunk by chunk, return the number deleted."""
+        deleted = 0
+        last_pk = None
+
+        while not self.out_of_time():
+            chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            pks = list(chunk.order_by("pk").values_list("pk", flat=True)[:self.chunk_size])
+            if not pks:
+                break
+
+            started = time.monotonic()
+            bounded = queryset.filter(pk__gte=pks[0], pk__lte=pks[-1])
+            with transaction.atomic():
+                if before_delete is not None:
+                    before_delete(pks[0], pks[-1])
+                count, _ = bounded.delete()
+            elapsed = time.monotonic() - started
+
+            deleted += count
+            last_pk = pks[-1]
+            if len(pks) < self.chunk_size:
+                break
+            if self.sleep_ratio:
+                time.sleep(elapsed * self.sleep_ratio)
+
+        return deleted
+
+    def run(self):
+        now = timezone.now()
+        self.deadline = time.monotonic() + self.max_seconds if self.max_seconds else None
+        report = {}
+
+        if settings.OTP["AUDIT"]:
+            # audit rows are the record of issued codes, kept for the retention window whether used or not
+            otp_rows = EmailOTP.objects.filter(created_at__lt=now - timedelta(days=settings.OTP["AUDIT_RETENTION_DAYS"]))
+        else:
+            otp_rows = EmailOTP.objects.filter(
+                Q(used=True) | Q(created_at__lt=now - timedelta(minutes=EmailOTP.EXPIRY_MINUTES))
+            )
+
+        targets = [
+            ("email_otp", otp_rows, None),
+            (
+                "password_reset_token",
+                PasswordResetToken.objects.filter(
+                    Q(used=True) | Q(created_at__lt=now - timedelta(minutes=PasswordResetToken.EXPIRY_MINUTES))
+                ),
+                None,
+            ),
+            (
+                "outstanding_token",
+                OutstandingToken.objects.filter(expires_at__lt=now),
+                # Blacklist rows go first so the token delete has nothing to cascade
+                lambda low, high: BlacklistedToken.objects.filter(
+                    token_id__gte=low, token_id__lte=high, token__expires_at__lt=now,
+                ).delete(),
+            ),
+        ]
+
+        for name, queryset, before_delete in targets:
+            started = time.monotonic()
+            deleted = self.purge(queryset, before_delete)
+            elapsed = time.monotonic() - started
+
+            report[name] = {"deleted": deleted, "seconds": round(elapsed, 3)}
+            metrics.incr("purge_deleted_total", deleted, table=name)
+            metrics.observe("purge_duration_seconds", elapsed, table=name)
+            logger.info("Purged %d %s rows in %.3fs", deleted, name, elapsed)
+
+        if self.out_of_time():
+            logger.warning("Purge stopped after %ss, the next run continues", self.max_seconds)
+        return report
+
+
+def purge_expired(**kwargs):
+    return Purger(**kwargs).run()
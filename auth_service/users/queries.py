@@ -0,0 +1,234 @@
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from celery.signals import task_postrun, task_prerun
+from django.conf import settings
+from django.db import connections
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Transaction control (atomic() blocks, every TestCase, SQLite's explicit
+# BEGIN) is not part of what a view asks the database for
+TRANSACTION_PREFIXES = ("BEGIN", "SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+# Recorders entered in the current context
+_active = ContextVar("active_query_recorders", default=())
+# Set while running work that production runs outside the request
+_deferred = ContextVar("deferred_queries", default=False)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+@contextmanager
+def deferred():
+    """
+    Leave the block's queries out of the request's budget: work a deployment
+    runs elsewhere and only test settings run inline (eager Celery tasks, the
+    outbox dispatch without OUTBOX["BACKGROUND"]). Recorders created with
+    deferred=True still count them.
+    """
+    token = _deferred.set(True)
+    try:
+        yield
+    finally:
+        _deferred.reset(token)
+
+
+_task_tokens = {}
+
+
+@task_prerun.connect(dispatch_uid="users.queries.task_prerun")
+def _task_started(task_id=None, **kwargs):
+    _task_tokens[task_id] = _deferred.set(True)
+
+
+@task_postrun.connect(dispatch_uid="users.queries.task_postrun")
+def _task_finished(task_id=None, **kwargs):
+    token = _task_tokens.pop(task_id, None)
+    if token is not None:
+        _deferred.reset(token)
+
+
+# Records every SQL statement run on any connection while active.
+# duplicates counts statements that ran more than once with the same
+# parameters, which is almost always a missing select_related or a value
+# fetched twice. Only queries run from the context that entered the recorder
+# are counted, so concurrent ASGI requests sharing the event loop's
+# connection each see their own. Queries run under deferred() are skipped
+# unless the recorder was created with deferred=True.
+class QueryRecorder:
+    def __init__(self, deferred=False):
+        self.deferred = deferred
+        self.queries = []
+        self.time = 0.0
+        # set by use_budget()
+        self.variant = None
+        self._connections = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if (
+            self not in _active.get()
+            or (_deferred.get() and not self.deferred)
+            or sql.lstrip().upper().startswith(TRANSACTION_PREFIXES)
+        ):
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.time += time.perf_counter() - started
+            self.queries.append((sql, repr(params)))
+
+    def __enter__(self):
+        _active.set((*_active.get(), self))
+        # execute_wrapper() pops the last wrapper on exit, which is another
+        # request's when overlapping requests exit out of order
+        self._connections = connections.all()
+        for connection in self._connections:
+            connection.execute_wrappers.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        for connection in self._connections:
+            connection.execute_wrappers.remove(self)
+        _active.set(tuple(recorder for recorder in _active.get() if recorder is not self))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def duplicates(self):
+        return sum(n - 1 for n in Counter(self.queries).values() if n > 1)
+
+    def duplicated_sql(self):
+        return [sql for (sql, _), n in Counter(self.queries).items() if n > 1]
+
+
+@lru_cache(maxsize=1)
+def get_budgets():
+    from .urls import QUERY_BUDGETS
+    return QUERY_BUDGETS
+
+
+def use_budget(variant):
+    """
+    Judge the current request by the "<url name>:<variant>" budget, for views
+    that took a slower path they still have to support.
+    """
+    for recorder in _active.get():
+        recorder.variant = variant
+
+
+def budget_name(url_name, variant):
+    name = f"{url_name}:{variant}"
+    return name if variant is not None and name in get_budgets() else url_name
+
+
+# Counts queries per request and compares them with the URL's budget in
+# users/urls.py, or its "<url name>:<variant>" budget once the view called
+# use_budget(). Over-budget requests are logged, or with QUERY_BUDGET["STRICT"]
+# (test runs) raise QueryBudgetExceeded; with QUERY_BUDGET["HEADER"] (on in
+# DEBUG) the counts are also returned in X-Query-* headers.
+# Streaming responses are measured up to the point the response is returned.
+# Under ASGI the recorder is installed from the request's sync thread, which
+# is where the async ORM runs its queries.
+class QueryBudgetMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        config = settings.QUERY_BUDGET
+        if not config["ENABLED"]:
+            return self.get_response(request)
+
+        with QueryRecorder() as recorder:
+            response = self.get_response(request)
+        return self.process(request, response, recorder, config)
+
+    async def __acall__(self, request):
+        config = settings.QUERY_BUDGET
+        if not config["ENABLED"]:
+            return await self.get_response(request)
+
+        recorder = QueryRecorder()
+        await sync_to_async(recorder.__enter__)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(recorder.__exit__)(None, None, None)
+        return self.process(request, response, recorder, config)
+
+    def process(self, request, response, recorder, config):
+        match = getattr(request, "resolver_match", None)
+        url_name = match.url_name if match else None
+        if url_name:
+            metrics.observe("db_queries_per_request", recorder.count, view=url_name)
+            metrics.observe("db_query_duration_seconds", recorder.time, view=url_name)
+            name = budget_name(url_name, recorder.variant)
+            budget = get_budgets().get(name)
+            if budget is not None and recorder.count > budget:
+                metrics.incr("db_query_budget_exceeded_total", view=url_name)
+                if config["STRICT"]:
+                    statements = "\n".join(f"{i}. {sql}" for i, (sql, _) in enumerate(recorder.queries, 1))
+                    raise QueryBudgetExceeded(f"{name} ran {recorder.count} queries, budget is {budget}:\n{statements}")
+                logger.warning(
+                    "%s ran %d queries (budget %d, %d duplicates)",
+                    name, recorder.count, budget, recorder.duplicates,
+                )
+
+        if config["HEADER"]:
+            response["X-Query-Count"] = str(recorder.count)
+            response["X-Query-Time"] = f"{recorder.time * 1000:.2f}ms"
+            response["X-Query-Duplicates"] = str(recorder.duplicates)
+        return response
+
+
+# TestCase mixin: fails when the block runs more queries than the URL's
+# budget or repeats a query
+class QueryBudgetTestMixin:
+    def assertWithinQueryBudget(self, url_name):
+        return _BudgetAssertion(self, url_name)
+
+
+class _BudgetAssertion(QueryRecorder):
+    def __init__(self, test_case, url_name):
+        super().__init__()
+        self.test_case = test_case
+        self.url_name = url_name
+
+    def __exit__(self, exc_type, *exc_info):
+        super().__exit__(exc_type, *exc_info)
+        if exc_type is not None:
+            return
+
+        name = budget_name(self.url_name, self.variant)
+        budget = get_budgets()[name]
+        if budget is not None:
+            statements = "\n".join(f"{i}. {sql}" for i, (sql, _) in enumerate(self.queries, 1))
+            self.test_case.assertLessEqual(
+                self.count, budget,
+                f"{name} ran {self.count} queries, budget is {budget}:\n{statements}",
+            )
+        self.test_case.assertEqual(
+            self.duplicates, 0,
+            f"{self.url_name} repeated queries:\n" + "\n".join(self.duplicated_sql()),
+        )
@@ -0,0 +1,171 @@
+import logging
+import random
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+
+logger = logging.getLogger(__name__)
+
+
+class RoutingState:
+    __slots__ = ("replica", "pinned", "user_id", "unchecked", "user_pinned")
+
+    def __init__(self):
+        self.replica = None
+        self.pinned = False
+        self.user_id = None
+        # pin keys to look up before the next read
+        self.unchecked = []
+        self.user_pinned = False
+
+
+# Routing state of the request being handled, None outside requests
+_state = ContextVar("replica_routing_state", default=None)
+
+
+# Fields requests without a user look rows up by. Writing such a row pins its
+# value the way a user's writes pin the user, so register -> verify-email,
+# verify-email -> login and forgot-password -> reset-password read what the
+# previous step wrote.
+LOOKUP_FIELDS = {
+    "users.customuser": "email",
+    "users.passwordresettoken": "selector",
+}
+
+
+def _pin_key(user_id):
+    return f"auth:db:primary:{user_id}"
+
+
+def _lookup_key(label, value):
+    return f"auth:db:primary:{label}:{str(value).lower()}"
+
+
+def _lookup_keys(instance):
+    label = instance._meta.label_lower
+    field = LOOKUP_FIELDS.get(label)
+    value = getattr(instance, field, None) if field else None
+    return [_lookup_key(label, value)] if value else []
+
+
+def set_user(user_id):
+    """Tell the router whose request this is, called by the authentication classes."""
+    state = _state.get()
+    if state is not None and state.user_id is None:
+        state.user_id = str(user_id)
+        state.unchecked.append(_pin_key(user_id))
+
+
+def set_lookup(model, value):
+    """Call before reading a ``model`` row by its LOOKUP_FIELDS ``value``."""
+    state = _state.get()
+    if state is not None and not state.pinned:
+        state.unchecked.append(_lookup_key(model._meta.label_lower, value))
+
+
+# Database router for READ_REPLICAS.
+# Reads made while handling a request go to one replica, picked per request.
+# Everything else goes to the primary: writes, reads after the request has
+# written, reads for a user who wrote in the last STICKY_SECONDS or of a row
+# looked up by a LOOKUP_FIELDS value written in that time (pinned in the
+# cache, so it holds across processes), and all reads outside requests
+# (Celery tasks, management commands), which often act on rows written a
+# moment ago.
+class ReplicaRouter:
+    def __init__(self):
+        config = settings.READ_REPLICAS
+        self.replicas = list(config["ALIASES"])
+        self.sticky_seconds = config["STICKY_SECONDS"]
+        self.databases = {DEFAULT_DB_ALIAS, *self.replicas}
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or state.pinned or not self.replicas:
+            return DEFAULT_DB_ALIAS
+
+        # related objects come from where their instance was loaded
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db:
+            return instance._state.db
+
+        if state.unchecked:
+            keys, state.unchecked = state.unchecked, []
+            try:
+                state.pinned = any(cache.get_many(keys).values())
+            except Exception:
+                logger.exception("Replica pin lookup failed, reading from the primary")
+                state.pinned = True
+            if state.pinned:
+                return DEFAULT_DB_ALIAS
+
+        if state.replica is None:
+            state.replica = random.choice(self.replicas)
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        if not self.replicas:
+            return DEFAULT_DB_ALIAS
+
+        state = _state.get()
+        instance = hints.get("instance")
+        keys = _lookup_keys(instance) if instance is not None else []
+        if state is not None:
+            state.pinned = True
+
+        if state is None or not state.user_pinned:
+            user_id = state.user_id if state is not None else None
+            if user_id is None:
+                if isinstance(instance, get_user_model()):
+                    user_id = instance.pk
+                else:
+                    user_id = getattr(instance, "user_id", None)
+            if user_id is not None:
+                keys.append(_pin_key(user_id))
+                if state is not None:
+                    state.user_pinned = True
+
+        if keys:
+            try:
+                cache.set_many(dict.fromkeys(keys, 1), timeout=self.sticky_seconds)
+            except Exception:
+                logger.exception("Pinning %s to the primary failed", ", ".join(keys))
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        if obj1._state.db in self.databases and obj2._state.db in self.databases:
+            return True
+        return None
+
+
+# Gives every request its own routing state; must come before anything that
+# queries the database
+class ReplicaRoutingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = _state.set(RoutingState())
+        try:
+            return self.get_response(request)
+        finally:
+            _state.reset(token)
+
+    async def __acall__(self, request):
+        token = _state.set(RoutingState())
+        try:
+            return await self.get_response(request)
+        finally:
+            _state.reset(token)
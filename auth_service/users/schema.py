@@ -0,0 +1,122 @@
+import gzip
+import hashlib
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "application/vnd.oai.openapi+json"
+
+
+def generate():
+    """The OpenAPI document as JSON bytes, as drf_spectacular's SpectacularAPIView builds it."""
+    from drf_spectacular.generators import SchemaGenerator
+    from drf_spectacular.renderers import OpenApiJsonRenderer
+    from drf_spectacular.settings import spectacular_settings
+    from rest_framework.settings import api_settings
+
+    generator = SchemaGenerator(api_version=api_settings.DEFAULT_VERSION)
+    document = generator.get_schema(request=None, public=spectacular_settings.SERVE_PUBLIC)
+    return OpenApiJsonRenderer().render(document, renderer_context={})
+
+
+# One OpenAPI document with every encoding precomputed.
+# The schema only changes with the code, so it is generated at build time
+# (manage.py openapi_schema) and stored gzipped; a process reads it once and
+# serves the bytes from memory. Each encoding gets its own strong ETag.
+class SchemaDocument:
+    __slots__ = ("body", "gzip", "brotli", "digest")
+
+    def __init__(self, body, compressed=None):
+        self.body = body
+        self.gzip = compressed or gzip.compress(body, compresslevel=9, mtime=0)
+        self.brotli = brotli.compress(body, quality=11) if brotli is not None else None
+        self.digest = hashlib.sha256(body).hexdigest()[:32]
+
+    def negotiate(self, accept_encoding):
+        """(content, Content-Encoding or None) for an Accept-Encoding header."""
+        accepted = set()
+        for part in accept_encoding.lower().split(","):
+            coding, _, params = part.partition(";")
+            params = params.replace(" ", "")
+            if params.startswith("q="):
+                try:
+                    if float(params[2:]) == 0:
+                        continue
+                except ValueError:
+                    continue
+            accepted.add(coding.strip())
+        if self.brotli is not None and "br" in accepted:
+            return self.brotli, "br"
+        if "gzip" in accepted:
+            return self.gzip, "gzip"
+        return self.body, None
+
+    def etag(self, encoding):
+        return f'"{self.digest}-{encoding}"' if encoding else f'"{self.digest}"'
+
+
+def write(path=None):
+    """Generate the schema and store it gzipped at ``path`` (default OPENAPI_SCHEMA["FILE"])."""
+    path = path or settings.OPENAPI_SCHEMA["FILE"]
+    document = SchemaDocument(generate())
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(document.gzip)
+    os.replace(tmp, path)
+    return document
+
+
+def read(path=None):
+    path = path or settings.OPENAPI_SCHEMA["FILE"]
+    with open(path, "rb") as fh:
+        compressed = fh.read()
+    return SchemaDocument(gzip.decompress(compressed), compressed)
+
+
+def is_stale(path=None):
+    """True when the stored schema is missing or no longer matches the code."""
+    try:
+        stored = read(path)
+    except (OSError, EOFError):
+        return True
+    return stored.body != generate()
+
+
+_document = None
+_lock = threading.Lock()
+
+
+def get_document():
+    """The schema this process serves, read on first use (generated when there is no file)."""
+    global _document
+    if _document is None:
+        with _lock:
+            if _document is None:
+                try:
+                    _document = read()
+                except (OSError, EOFError):
+                    logger.warning(
+                        "No OpenAPI schema at %s, generating it; run `manage.py openapi_schema` at build time",
+                        settings.OPENAPI_SCHEMA["FILE"],
+                    )
+                    _document = SchemaDocument(generate())
+    return _document
+
+
+@receiver(setting_changed)
+def _reset(setting, **kwargs):
+    global _document
+    if setting == "OPENAPI_SCHEMA":
+        _document = None
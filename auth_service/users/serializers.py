@@ -1,10 +1,17 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
 from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
+from django.contrib.auth.hashers import identify_hasher
 from django.contrib.auth import get_user_model
-from rest_framework_simplejwt.tokens import RefreshToken, TokenError
-from django.contrib.auth.hashers import check_password
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, TokenError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer as BaseTokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
 
-from .models import EmailOTP, PasswordResetToken
+from . import hashing, metrics, otp, queries, routers
+from .cache import user_cache
+from .models import PasswordResetToken
+from .tokens import RefreshToken
 
 # Get the User model
 User = get_user_model()
@@ -16,11 +23,8 @@ class RegisterSerializer(serializers.ModelSerializer):
     class Meta: 
         model = User
         fields = ["id","email", "first_name", "last_name", "role", "password"]       
-
-    def validate_email(self, value):
-        if User.objects.filter(email=value).exists():
-            raise serializers.ValidationError("A user with this email already exists.")
-        return value
+        # uniqueness is enforced by the INSERT itself, see create()
+        extra_kwargs = {"email": {"validators": []}}
 
     def validate_password(self, value):
         validate_password(value)
@@ -29,11 +33,15 @@ class RegisterSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         password = validated_data.pop("password")
 
-        user = User.objects.create_user(
-            password=password,
-            is_active=False,
-            **validated_data
-        )
+        try:
+            with transaction.atomic():
+                user = User.objects.create_user(
+                    password=password,
+                    is_active=False,
+                    **validated_data
+                )
+        except IntegrityError:
+            raise serializers.ValidationError({"email": "A user with this email already exists."})
         return user
     
 
@@ -46,39 +54,33 @@ class VerifyOTPSerializer(serializers.Serializer):
         email = data["email"]
         code = data["code"]
         
-        # check if user exists
+        # check if user exists (on the primary if it registered a moment ago)
+        routers.set_lookup(User, email)
         try:
             user = User.objects.get(email=email)
         except User.DoesNotExist:
             raise serializers.ValidationError({"email": "User with this email does not exist."})
+        routers.set_user(user.pk)
         
-        # get latest OTP
-        try:
-            otp = EmailOTP.objects.filter(
-                user=user, code=code, used=False
-            ).latest("created_at")
-        except EmailOTP.DoesNotExist:
-            raise serializers.ValidationError({"code": "Invalid OTP code."}) 
-
-        # Check OTP expiry
-        if otp.is_expired():
+        # verify and consume the OTP in one step
+        result = otp.verify(user, code)
+
+        if result == otp.EXPIRED:
             raise serializers.ValidationError({"code": "OTP code has expired."})
-        
+        if result == otp.LOCKED:
+            raise serializers.ValidationError({"code": "Too many failed attempts, request a new OTP code."})
+        if result != otp.VALID:
+            raise serializers.ValidationError({"code": "Invalid OTP code."})
+
         data["user"] = user
-        data["otp"] = otp
         return data
     
     def save(self, **kwargs):
         user = self.validated_data["user"]
-        otp = self.validated_data["otp"]
-
-        #mark otp used
-        otp.used = True
-        otp.save()
 
         # activate user
         user.is_active = True
-        user.save()
+        user.save(update_fields=["is_active", "updated_at"])
 
         return user
 
@@ -92,17 +94,27 @@ class LoginSerializer(serializers.Serializer):
         email = data.get("email")
         password = data.get("password")
 
+        # on the primary if the account was activated a moment ago
+        routers.set_lookup(User, email)
         try:
             user = User.objects.get(email=email)
         except User.DoesNotExist:
+            metrics.incr("login_total", result="unknown_user")
             raise serializers.ValidationError("Invalid email or password.")
 
-        if not user.check_password(password):
+        if not hashing.check_password(password, user.password):
+            metrics.incr("login_total", result="bad_password")
             raise serializers.ValidationError("Invalid email or password.")
 
         if not user.is_active:
+            metrics.incr("login_total", result="inactive")
             raise serializers.ValidationError("User account is not active.")
 
+        metrics.incr("login_total", result="success")
+
+        # upgrade outdated hashes off the request path
+        hashing.schedule_rehash(user, password)
+
         data['user'] = user
         return data
 
@@ -118,11 +130,57 @@ class LogoutSerializer(serializers.Serializer):
 
     def save(self, **kwargs):
         try:
-            RefreshToken(self.token).blacklist()
+            token = RefreshToken.decode(self.token)
+            if token.family is None:
+                # a token from before refresh-token families, blacklisted in the tables
+                queries.use_budget("legacy")
+                token.check_blacklist()
+            token.blacklist()
         except TokenError:
             raise serializers.ValidationError({"message": "Invalid or expired token."})
         
 
+# Token Refresh Serializer
+# Same as simplejwt's, but the blacklist check goes through the Bloom filter
+# and the user comes from the user cache, so a refresh costs no DB query.
+# Family tokens are rotated in Redis before anything else is looked at.
+class TokenRefreshSerializer(BaseTokenRefreshSerializer):
+    token_class = RefreshToken
+
+    def validate(self, attrs):
+        return self.token_data(attrs["refresh"])
+
+    @classmethod
+    def token_data(cls, raw_token):
+        """The response data for ``raw_token``, also run by AsyncTokenRefreshView."""
+        refresh = cls.token_class.decode(raw_token)
+        if refresh.family is None:
+            # a token from before refresh-token families, rotated in the tables
+            queries.use_budget("legacy")
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            # checks revocation and, for family tokens, reuse in the same step
+            refresh.rotate()
+        else:
+            refresh.check_blacklist()
+
+        user_id = refresh.payload.get(api_settings.USER_ID_CLAIM, None)
+        if user_id:
+            user = user_cache.get(user_id)
+            if user is None or not api_settings.USER_AUTHENTICATION_RULE(user):
+                raise AuthenticationFailed(
+                    cls.default_error_messages["no_active_account"],
+                    "no_active_account",
+                )
+            # pick up role changes since the refresh token was issued
+            refresh.set_user_claims(user)
+
+        data = {"access": str(refresh.access_token)}
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            data["refresh"] = str(refresh)
+
+        return data
+
+
 # Change Password Serializer
 class ChangePasswordSerializer(serializers.ModelSerializer):
     old_password = serializers.CharField(write_only=True, style={"input_type": "password"})
@@ -141,7 +199,7 @@ class ChangePasswordSerializer(serializers.ModelSerializer):
         confirm_new_password = attrs.get("confirm_new_password")    
 
         # Validate old password
-        if not user.check_password(old_password):
+        if not hashing.check_password(old_password, user.password):
             raise serializers.ValidationError({"old_password": "Old password is incorrect."})   
         
         # Validate new password and confirmation match
@@ -154,8 +212,8 @@ class ChangePasswordSerializer(serializers.ModelSerializer):
     
     def update(self, instance, validated_data):
         new_password = validated_data["new_password"]
-        instance.set_password(new_password)
-        instance.save()
+        hashing.set_password(instance, new_password)
+        instance.save(update_fields=["password", "updated_at"])
         return instance
     
 
@@ -163,10 +221,14 @@ class ChangePasswordSerializer(serializers.ModelSerializer):
 class ForgotPasswordSerializer(serializers.Serializer):
     email = serializers.EmailField()
 
-    def validate_email(self, value):
-        if not User.objects.filter(email=value).exists():
-            raise serializers.ValidationError("No User Associated with this Email.")
-        return value
+    def validate(self, attrs):
+        # fetched once here and handed to the view
+        routers.set_lookup(User, attrs["email"])
+        user = User.objects.filter(email=attrs["email"]).first()
+        if user is None:
+            raise serializers.ValidationError({"email": "No User Associated with this Email."})
+        attrs["user"] = user
+        return attrs
 
 
 # Reset Password
@@ -187,14 +249,8 @@ class ResetPasswordSerializer(serializers.Serializer):
         # validate password strength
         validate_password(password)
 
-        # validate the math token in db
-        tokens = PasswordResetToken.objects.filter(used=False)
-        matched = None
-
-        for obj in tokens:
-            if check_password(token, obj.token_hash):
-                matched = obj
-                break
+        # validate the token in db (one indexed lookup by selector)
+        matched = PasswordResetToken.lookup(token)
 
         if matched is None:
             raise serializers.ValidationError({"token": "Invalid or expired token."})
@@ -207,4 +263,50 @@ class ResetPasswordSerializer(serializers.Serializer):
         attrs["token_obj"] = matched
         
         return attrs
-    
\ No newline at end of file
+
+
+# Token Introspection
+class IntrospectSerializer(serializers.Serializer):
+    tokens = serializers.ListField(
+        child=serializers.CharField(),
+        allow_empty=False,
+        max_length=settings.INTROSPECTION["MAX_TOKENS"],
+    )
+
+
+# Bulk user import - one input row
+class BulkUserRowSerializer(serializers.Serializer):
+    email = serializers.EmailField(max_length=255)
+    first_name = serializers.CharField(max_length=50, required=False, allow_blank=True, default="")
+    last_name = serializers.CharField(max_length=50, required=False, allow_blank=True, default="")
+    role = serializers.ChoiceField(choices=User.ROLES, required=False, allow_blank=True, default="Customer")
+    password = serializers.CharField(required=False, allow_blank=True, trim_whitespace=False)
+    password_hash = serializers.CharField(required=False, allow_blank=True)
+
+    def validate_email(self, value):
+        return User.objects.normalize_email(value)
+
+    def validate_password(self, value):
+        if value:
+            validate_password(value)
+        return value
+
+    def validate_password_hash(self, value):
+        if value:
+            try:
+                identify_hasher(value)
+            except ValueError:
+                raise serializers.ValidationError("Unknown password hash format.")
+        return value
+
+    def validate(self, attrs):
+        attrs["role"] = attrs.get("role") or "Customer"
+        return attrs
+
+
+# Bulk user import - upload
+class BulkImportSerializer(serializers.Serializer):
+    file = serializers.FileField()
+    format = serializers.ChoiceField(choices=["csv", "jsonl"], required=False)
+    activate = serializers.BooleanField(default=False)
+
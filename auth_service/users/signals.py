@@ -0,0 +1,53 @@
+import time
+
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import metrics
+from .cache import user_cache
+
+
+User = get_user_model()
+
+
+# Drop cached copies of a user whenever the row changes.
+# Runs after commit so a concurrent reader cannot re-cache the old row
+# between our write and the commit.
+@receiver(post_save, sender=User, dispatch_uid="users.invalidate_user_cache_on_save")
+@receiver(post_delete, sender=User, dispatch_uid="users.invalidate_user_cache_on_delete")
+def invalidate_user_cache(sender, instance, **kwargs):
+    user_id = instance.pk
+    transaction.on_commit(lambda: user_cache.invalidate(user_id))
+
+
+# Celery task timing.
+# The publisher stamps each message so the worker can measure how long it
+# sat in the broker; run time is measured around the task body. Eager tasks
+# are never published and only report run time.
+_task_started = {}
+
+
+@before_task_publish.connect(dispatch_uid="users.stamp_task_published_at")
+def stamp_published_at(headers=None, **kwargs):
+    if headers is not None:
+        headers["published_at"] = time.time()
+
+
+@task_prerun.connect(dispatch_uid="users.task_prerun_metrics")
+def task_started(task_id=None, task=None, **kwargs):
+    # custom headers land on the request, or under .headers on older protocols
+    published_at = getattr(task.request, "published_at", None) or (task.request.headers or {}).get("published_at")
+    if published_at is not None:
+        metrics.observe("celery_task_queue_wait_seconds", max(time.time() - published_at, 0.0), task=task.name)
+    _task_started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect(dispatch_uid="users.task_postrun_metrics")
+def task_finished(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        metrics.observe("celery_task_duration_seconds", time.perf_counter() - started, task=task.name)
+    metrics.incr("celery_tasks_total", task=task.name, state=state or "UNKNOWN")
@@ -0,0 +1,168 @@
+import gc
+import json
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+
+
+ROLES = ("all", "api", "worker")
+
+
+def load(role=None):
+    """Import everything a process of ``role`` (default SERVICE_ROLE) needs before it serves anything."""
+    import django
+    from django.conf import settings
+
+    django.setup()
+    role = role or settings.SERVICE_ROLE
+    if role == "worker":
+        from auth_service.celery import app
+        app.loader.import_default_modules()
+        return
+
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.urls import get_resolver
+
+    # builds the middleware chain and imports the URLconf and every view,
+    # which would otherwise happen in each worker on its first request
+    WSGIHandler()
+    get_resolver().url_patterns
+    if settings.API_DOCS:
+        from users import schema
+        schema.get_document()
+
+
+def preload(role=None):
+    """
+    load(), then move every object into the permanent generation (gc.freeze)
+    so workers forked afterwards keep sharing those pages with the master
+    instead of copying them when the collector touches their headers.
+    """
+    load(role)
+    gc.collect()
+    gc.freeze()
+
+
+def start_background():
+    """
+    Start the background threads of a serving process: the blacklist filter
+    rebuilds. Called once per worker after it is forked (gunicorn's post_fork,
+    asgi.py), never on the request path or in the master.
+    """
+    from users.blacklist import token_blacklist
+
+    token_blacklist.start()
+
+
+# Startup profile (manage.py startup_profile)
+# A fresh interpreter boots one role under -X importtime and reports total
+# time, RSS, self import time per package and, on Linux, how much memory a
+# forked worker copies on its first full collection with and without
+# gc.freeze(); a second one repeats the boot under tracemalloc for memory
+# allocated per package.
+_IMPORTTIME = re.compile(r"^import time:\s+(\d+) \|\s+\d+ \|\s*(\S+)")
+
+
+def package_of(module):
+    """Grouping key: the top-level package, or the app for django.contrib.* modules."""
+    parts = module.split(".")
+    if parts[:2] == ["django", "contrib"] and len(parts) > 2:
+        return ".".join(parts[:3])
+    return parts[0]
+
+
+def parse_importtime(lines):
+    """Self import time in microseconds per package, from -X importtime output."""
+    totals = defaultdict(int)
+    for line in lines:
+        match = _IMPORTTIME.match(line)
+        if match:
+            totals[package_of(match.group(2))] += int(match.group(1))
+    return dict(totals)
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    # peak rather than current, and kilobytes on Linux but bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def _private_dirty_bytes():
+    try:
+        with open("/proc/self/smaps_rollup") as fh:
+            for line in fh:
+                if line.startswith("Private_Dirty:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _copied_by_collection(freeze):
+    """Bytes a forked child stops sharing with its parent when it runs a full collection."""
+    if freeze:
+        gc.collect()
+        gc.freeze()
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        before = _private_dirty_bytes()
+        gc.collect()
+        after = _private_dirty_bytes()
+        os.write(write, str(after - before).encode())
+        os._exit(0)
+    os.close(write)
+    with os.fdopen(read) as fh:
+        copied = int(fh.read())
+    os.waitpid(pid, 0)
+    if freeze:
+        gc.unfreeze()
+    return copied
+
+
+def _modules_by_file():
+    files = {}
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None)
+        if path:
+            files[os.path.abspath(path)] = name
+    return files
+
+
+def profile_child(role, memory):
+    """Run by startup_profile in a fresh interpreter, prints one JSON object."""
+    if memory:
+        import tracemalloc
+        tracemalloc.start()
+
+    started = time.perf_counter()
+    load(role)
+    result = {"role": role, "boot_ms": (time.perf_counter() - started) * 1000, "rss_bytes": _rss_bytes()}
+
+    if memory:
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        files = _modules_by_file()
+        allocated = defaultdict(int)
+        for stat in snapshot.statistics("filename"):
+            module = files.get(os.path.abspath(stat.traceback[0].filename))
+            allocated[package_of(module) if module else "(other)"] += stat.size
+        result["allocated_bytes"] = dict(allocated)
+    else:
+        result["modules"] = len(sys.modules)
+        if hasattr(os, "fork") and _private_dirty_bytes() is not None:
+            result["copied_bytes"] = _copied_by_collection(freeze=False)
+            result["copied_frozen_bytes"] = _copied_by_collection(freeze=True)
+
+    print(json.dumps(result))
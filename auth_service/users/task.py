@@ -1,51 +1,53 @@
-import random
-from django.core.mail import send_mail
-from django.conf import settings
 from celery import shared_task
-from django.contrib.auth import get_user_model
 
-from .models import EmailOTP, PasswordResetToken
-
-
-User = get_user_model()
+from . import mail, outbox, purge, writebehind
 
 
 # For Verify-OTP
-def generate_otp():
-    return f"{random.randint(100000, 999999)}"
-
+# The code is issued when the mail is sent (users/emails.py)
 @shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=5, retry_kwargs={"max_retries": 3})
+@outbox.idempotent
 def send_otp_via_email(self, user_id):
-    user = User.objects.get(id=user_id)
+    if mail.enqueue("otp", user_id):
+        flush_mail_queue.delay()
 
-    # Remove old Unused OTPs
-    EmailOTP.objects.filter(user=user, used=False).delete()
 
-    code = generate_otp()
-    EmailOTP.objects.create(user=user, code=code)
+# For Forgot Password Link
+# The reset token is generated when the mail is sent (users/emails.py)
+@shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=5, retry_kwargs={"max_retries": 3})
+@outbox.idempotent
+def send_password_reset_email(self, user_id):
+    if mail.enqueue("password_reset", user_id):
+        flush_mail_queue.delay()
+
 
-    subject = "Your Email Verification OTP"
-    message = f"Your OTP for email verification is: {code}\n\nit will expire in 10 minutes."
-    from_email = getattr(settings, 'DEFAULT_FROM_EMAIL', None)
-    recipient_list = [user.email]
+# Drains the outgoing mail queue in batches over one SMTP connection.
+# Runs every MAIL_BATCH["FLUSH_INTERVAL"] seconds from beat and whenever a
+# full batch is waiting.
+@shared_task(ignore_result=True)
+def flush_mail_queue():
+    return mail.flush()
 
-    send_mail(subject, message, from_email, recipient_list)
 
 
-# For Forgot Password Link
-@shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=5, retry_kwargs={"max_retries": 3})
-def send_password_reset_email(self, user_id):
-    user = User.objects.get(id=user_id)
-    
-    raw_token, token_obj = PasswordResetToken.generate(user) 
+# Deletes expired OTPs, reset tokens and outstanding JWTs in bounded chunks,
+# see users/purge.py. Returns rows deleted and seconds spent per table.
+@shared_task
+def purge_expired_rows():
+    return purge.purge_expired()
 
-    reset_url = f"{settings.FRONTEND_URL}/reset-password/{raw_token}"
 
-    subject = "Reset Your Password"
-    message = f"Click The link below to rest password:\n\n{reset_url}"
-    from_email = getattr(settings, 'DEFAULT_FROM_EMAIL', None)
-    recipient_list = [user.email]
+# Writes buffered last_login values with bulk UPDATEs, see users/writebehind.py.
+# Runs every WRITE_BEHIND["FLUSH_INTERVAL"] seconds from beat and whenever a
+# full batch is waiting.
+@shared_task(ignore_result=True)
+def flush_write_behind():
+    return writebehind.flush()
 
-    send_mail(subject, message, from_email, recipient_list)
 
-    return raw_token 
+# Publishes outbox messages left behind by processes that died before their
+# post-commit dispatch, see users/outbox.py. Runs every OUTBOX["INTERVAL"]
+# seconds from beat.
+@shared_task(ignore_result=True)
+def dispatch_outbox():
+    return outbox.dispatch()
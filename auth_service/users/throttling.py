@@ -0,0 +1,185 @@
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle
+
+from . import metrics
+from .cache import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_rate(rate):
+    """"10/min" -> (capacity, tokens refilled per second)."""
+    count, _, period = rate.partition("/")
+    count = int(count)
+    return count, count / PERIODS[period[0]]
+
+
+# Token buckets in Redis.
+# One script call refills and checks every bucket for the request (IP, email,
+# IP+email) and only takes a token from all of them when all have one, so a
+# rejected request costs a single round trip and changes nothing. Returns the
+# seconds until a token is available, or 0 when the request may proceed.
+# Refills use the Redis server's clock, so app servers whose clocks drift
+# apart still agree on every bucket.
+class RedisBucketStore:
+    SCRIPT = """
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local wait = 0
+    local levels = {}
+    for i, key in ipairs(KEYS) do
+        local capacity = tonumber(ARGV[i * 2 - 1])
+        local rate = tonumber(ARGV[i * 2])
+        local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+        local tokens = tonumber(bucket[1]) or capacity
+        local ts = tonumber(bucket[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+        if tokens < 1 then
+            wait = math.max(wait, (1 - tokens) / rate)
+        end
+        levels[i] = tokens
+    end
+    if wait > 0 then
+        return tostring(wait)
+    end
+    for i, key in ipairs(KEYS) do
+        local capacity = tonumber(ARGV[i * 2 - 1])
+        local rate = tonumber(ARGV[i * 2])
+        redis.call('HSET', key, 'tokens', tostring(levels[i] - 1), 'ts', tostring(now))
+        redis.call('PEXPIRE', key, math.ceil((capacity - levels[i] + 1) / rate * 1000))
+    end
+    return '0'
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._script = connection.register_script(self.SCRIPT)
+
+    def consume(self, buckets):
+        args = []
+        for _, capacity, rate in buckets:
+            args += [capacity, repr(rate)]
+        return float(self._script(keys=[key for key, _, _ in buckets], args=args))
+
+
+# Same algorithm in process memory, used when CACHES["default"] is not Redis.
+# `now` defaults to this process's clock, tests pass it explicitly.
+class LocalBucketStore:
+    def __init__(self, maxsize=10000):
+        self.buckets = LRUCache(maxsize=maxsize, ttl=86400)
+        self.lock = threading.Lock()
+
+    def consume(self, buckets, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            levels = []
+            wait = 0.0
+            for key, capacity, rate in buckets:
+                tokens, ts = self.buckets.get(key, (capacity, now))
+                tokens = min(capacity, tokens + max(0.0, now - ts) * rate)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+                levels.append(tokens)
+            if wait:
+                return wait
+            for (key, capacity, rate), tokens in zip(buckets, levels):
+                self.buckets.set(key, (tokens - 1, now), ttl=(capacity - tokens + 1) / rate)
+            return 0.0
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                try:
+                    from django_redis import get_redis_connection
+                    _store = RedisBucketStore(get_redis_connection("default"))
+                except (ImportError, NotImplementedError):
+                    _store = LocalBucketStore()
+    return _store
+
+
+# DRF throttle for the unauthenticated endpoints.
+# Limits come from THROTTLING["RATES"][scope] and may set an "ip", "email"
+# and "ip_email" rate. Throttles run before the view parses the serializer,
+# so a rejected request never touches the database or the password hasher.
+class TokenBucketThrottle(BaseThrottle):
+    scope = None
+
+    def get_email(self, request):
+        try:
+            email = request.data.get("email")
+        except Exception:
+            return None
+        if not isinstance(email, str) or not email.strip():
+            return None
+        return hashlib.sha1(email.strip().lower().encode()).hexdigest()[:16]
+
+    def get_buckets(self, request):
+        rates = settings.THROTTLING["RATES"].get(self.scope) or {}
+        ip = self.get_ident(request)
+        email = self.get_email(request) if ("email" in rates or "ip_email" in rates) else None
+        idents = {"ip": ip, "email": email, "ip_email": f"{ip}:{email}" if email else None}
+
+        buckets = []
+        for kind, rate in rates.items():
+            ident = idents.get(kind)
+            if rate and ident:
+                capacity, refill = parse_rate(rate)
+                buckets.append((f"auth:throttle:{self.scope}:{kind}:{ident}", capacity, refill))
+        return buckets
+
+    def allow_request(self, request, view):
+        self._wait = None
+        buckets = self.get_buckets(request)
+        if not buckets:
+            return True
+
+        try:
+            with metrics.timer("cache_operation_seconds", cache="throttle"):
+                wait = get_store().consume(buckets)
+        except Exception:
+            if not settings.THROTTLING["FAIL_OPEN"]:
+                raise
+            logger.exception("Throttle store unavailable, allowing request")
+            metrics.incr("throttle_errors_total")
+            return True
+
+        if wait:
+            self._wait = wait
+            metrics.incr("throttle_rejected_total", scope=self.scope)
+            return False
+        return True
+
+    def wait(self):
+        return self._wait
+
+
+class LoginThrottle(TokenBucketThrottle):
+    scope = "login"
+
+
+class ForgotPasswordThrottle(TokenBucketThrottle):
+    scope = "forgot_password"
+
+
+class ResetPasswordThrottle(TokenBucketThrottle):
+    scope = "reset_password"
+
+
+class VerifyEmailThrottle(TokenBucketThrottle):
+    scope = "verify_email"
@@ -0,0 +1,157 @@
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import AccessToken as BaseAccessToken
+from rest_framework_simplejwt.tokens import RefreshToken as BaseRefreshToken
+from rest_framework_simplejwt.tokens import Token
+from rest_framework_simplejwt.utils import datetime_from_epoch
+
+from . import families
+from .blacklist import token_blacklist
+from .cache import user_cache
+from .keys import token_backend
+
+
+# Set while decode() decodes a token so revocation is checked afterwards
+_defer_blacklist_check = ContextVar("defer_blacklist_check", default=False)
+
+
+# Access token signed through the key ring backend (users/keys.py)
+class AccessToken(BaseAccessToken):
+    _token_backend = token_backend
+
+
+# Refresh token backed by users.blacklist.token_blacklist.
+# The blacklist check runs against the Bloom filter / cache, the
+# token_blacklist tables are still written on blacklist() for audit.
+# With REFRESH_TOKEN_FAMILIES enabled new tokens belong to a family
+# (users/families.py) instead: revocation, rotation and reuse detection are
+# one Redis call each and the tables are only written at login.
+class RefreshToken(BaseRefreshToken):
+    _token_backend = token_backend
+    access_token_class = AccessToken
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        token.set_user_claims(user)
+        token.start_family(user)
+        return token
+
+    @classmethod
+    async def afor_user(cls, user):
+        """for_user() for async views, the outstanding row is written with the async ORM."""
+        token = Token.for_user.__func__(cls, user)
+        token.set_user_claims(user)
+        # a Redis write, off the event loop
+        await sync_to_async(token.start_family, thread_sensitive=False)(user)
+        await OutstandingToken.objects.acreate(
+            user=user,
+            jti=token[api_settings.JTI_CLAIM],
+            token=str(token),
+            created_at=token.current_time,
+            expires_at=datetime_from_epoch(token["exp"]),
+        )
+        return token
+
+    @classmethod
+    def decode(cls, raw_token):
+        """cls(raw_token) without the revocation check, for callers that rotate() or blacklist() next."""
+        reset = _defer_blacklist_check.set(True)
+        try:
+            return cls(raw_token)
+        finally:
+            _defer_blacklist_check.reset(reset)
+
+    @property
+    def family(self):
+        return self.payload.get("fam")
+
+    def start_family(self, user):
+        if not families.enabled():
+            return
+        self["fam"] = families.new_family()
+        self["gen"] = 0
+        families.get_store().create(self["fam"], self[api_settings.JTI_CLAIM], user.pk, self["exp"])
+
+    def set_user_claims(self, user):
+        # Copied into every access token minted from this refresh token,
+        # StatelessJWTAuthentication builds request.user from them
+        self["role"] = user.role
+        self["is_active"] = user.is_active
+        self["ver"] = user.token_version
+
+    def check_blacklist(self):
+        if _defer_blacklist_check.get():
+            return
+        if self.family is not None:
+            # an older generation presented here revokes the family
+            status = families.get_store().check(self.family, self.payload["gen"], self.payload[api_settings.JTI_CLAIM])
+            if families.record(status) != families.CURRENT:
+                if status == families.REUSED:
+                    families.changed(self.family)
+                raise TokenError(_("Token is blacklisted"))
+        elif token_blacklist.is_blacklisted(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError(_("Token is blacklisted"))
+
+    def rotate(self):
+        """
+        Give this token a new jti, exp and iat and revoke the old one. For a
+        family token this is a single compare-and-swap in Redis that also
+        checks revocation and reuse; nothing is written to the database.
+        Raises TokenError when the token was revoked or already rotated.
+        """
+        if self.family is None:
+            self.check_blacklist()
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                self.blacklist()
+            self.set_jti()
+            self.set_exp()
+            self.set_iat()
+            self.outstand()
+            return
+
+        old_jti, generation = self.payload[api_settings.JTI_CLAIM], self.payload["gen"]
+        self.set_jti()
+        self.set_exp()
+        self.set_iat()
+        status = families.get_store().rotate(
+            self.family, generation, old_jti, self.payload[api_settings.JTI_CLAIM], self.payload["exp"]
+        )
+        if status != families.REVOKED:
+            families.changed(self.family)
+        if families.record(status) != families.ROTATED:
+            raise TokenError(_("Token is blacklisted"))
+        self["gen"] = generation + 1
+
+    def outstand(self):
+        # Only called by rotate() right after set_jti(), so there is no row
+        # to look for, and the user comes from the user cache
+        return OutstandingToken.objects.create(
+            user=user_cache.get(self.payload[api_settings.USER_ID_CLAIM]),
+            jti=self.payload[api_settings.JTI_CLAIM],
+            token=str(self),
+            created_at=self.current_time,
+            expires_at=datetime_from_epoch(self.payload["exp"]),
+        )
+
+    def blacklist(self):
+        if self.family is not None:
+            # revokes every generation of the family at once
+            families.get_store().revoke(self.family)
+            families.changed(self.family)
+            return None
+
+        # The outstanding row normally exists since for_user(); only fall back
+        # to simplejwt (which also SELECTs the user) when it does not
+        token = OutstandingToken.objects.filter(jti=self.payload[api_settings.JTI_CLAIM]).first()
+        if token is None:
+            result = super().blacklist()
+        else:
+            result = BlacklistedToken.objects.get_or_create(token=token)
+        token_blacklist.add(self.payload[api_settings.JTI_CLAIM], datetime_from_epoch(self.payload["exp"]))
+        return result
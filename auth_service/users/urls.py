@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from .views import (
     RegisterView,
@@ -8,10 +9,46 @@ from .views import (
     ChangePasswordView,
     ForgotPasswordView,
     ResetPasswordView,
+    IntrospectView,
+    BulkUserImportView,
 )
 
 app_name = "auth"
 
+# Native async versions of the hot unauthenticated views (ASGI deployments)
+if settings.ASYNC_VIEWS:
+    from .async_views import (
+        AsyncForgotPasswordView as ForgotPasswordView,
+        AsyncTokenRefreshView as TokenRefreshView,
+        AsyncUserLoginView as UserLoginView,
+        AsyncVerifyEmailView as VerifyEmailView,
+    )
+
+# Maximum SQL queries per request for each URL name, checked by
+# users.queries.QueryBudgetMiddleware on every request of a test run (and
+# logged elsewhere) and by QueryBudgetTests. Eager Celery tasks and the
+# inline outbox dispatch are left out, deployments run them outside the
+# request. None means the count grows with the input (bulk import).
+QUERY_BUDGETS = {
+    "register": 2,
+    "verify-email": 2,
+    "login": 3,
+    "logout": 1,
+    "token-refresh": 1,
+    "change-password": 2,
+    "forgot-password": 1,
+    "reset-password": 3,
+    "introspect": 2,
+    "users-import": None,
+    # Refresh tokens without a "fam" claim, from before refresh-token families
+    # (chosen by the serializers): the token_blacklist rows, plus one
+    # blacklist lookup while the Bloom filter is not ready yet
+    "token-refresh:legacy": 6,
+    "logout:legacy": 5,
+    # users.otp.DatabaseOTPBackend: the code's SELECT and UPDATE
+    "verify-email:database-otp": 4,
+}
+
 # API v1 URL patterns 
 urlpatterns = [
     path("auth/register/", RegisterView.as_view(), name="register"),
@@ -22,4 +59,6 @@ urlpatterns = [
     path("auth/change-password/", ChangePasswordView.as_view(), name="change-password"),
     path("auth/forgot-password/", ForgotPasswordView.as_view(), name="forgot-password"),
     path("auth/reset-password/", ResetPasswordView.as_view(), name="reset-password"),
+    path("auth/introspect/", IntrospectView.as_view(), name="introspect"),
+    path("auth/users/import/", BulkUserImportView.as_view(), name="users-import"),
     ]
\ No newline at end of file
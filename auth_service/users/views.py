@@ -1,13 +1,30 @@
+import hmac
+import json
+
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework import generics, status
 from rest_framework.permissions import IsAuthenticated, AllowAny
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from rest_framework_simplejwt.tokens import RefreshToken
-from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from rest_framework.parsers import MultiPartParser
+from rest_framework_simplejwt.exceptions import TokenError
 from django.utils import timezone
 from django.db import transaction
 
-from users.task import send_otp_via_email, send_password_reset_email 
+from users import hashing, metrics, otp, outbox, queries, schema, writebehind
+from users.authentication import StatelessJWTAuthentication
+from users.introspection import introspect
+from users.importer import READERS, UserImporter, detect_format, text_stream
+from users.permission import HasIntrospectionKey, HasPermissions
+from users.keys import keyring
+from users.models import PasswordResetToken
+from users.throttling import ForgotPasswordThrottle, LoginThrottle, ResetPasswordThrottle, VerifyEmailThrottle
+from users.tokens import RefreshToken
+from users.task import flush_write_behind, send_otp_via_email, send_password_reset_email 
 from users.serializers import(
     RegisterSerializer,
     VerifyOTPSerializer,
@@ -16,9 +33,20 @@ from users.serializers import(
     ChangePasswordSerializer,
     ForgotPasswordSerializer,
     ResetPasswordSerializer,
+    TokenRefreshSerializer,
+    IntrospectSerializer,
+    BulkImportSerializer,
 )
 
 
+# drf_spectacular is only installed, and only imported, with API_DOCS
+if settings.API_DOCS:
+    from drf_spectacular.utils import extend_schema
+else:
+    def extend_schema(**kwargs):
+        return lambda view: view
+
+
 # Get the User model
 User = get_user_model()
 
@@ -34,7 +62,8 @@ class RegisterView(generics.CreateAPIView):
 
         user = serializer.save()
 
-        send_otp_via_email.delay(user.id)
+        # published after commit, the request does not wait for the broker
+        outbox.enqueue(send_otp_via_email, user.id)
 
         return Response(
             {
@@ -46,11 +75,19 @@ class RegisterView(generics.CreateAPIView):
     
 
 # API view for email verification
+def use_otp_budget():
+    # codes kept in the database cost a SELECT and an UPDATE on top of the budget
+    if isinstance(otp.get_otp_backend(), otp.DatabaseOTPBackend):
+        queries.use_budget("database-otp")
+
+
 class VerifyEmailView(generics.GenericAPIView):
     permission_classes = [AllowAny]
     serializer_class = VerifyOTPSerializer
+    throttle_classes = [VerifyEmailThrottle]
 
     def get(self, request, *args, **kwargs):
+        use_otp_budget()
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         serializer.save()
@@ -65,6 +102,7 @@ class VerifyEmailView(generics.GenericAPIView):
 class UserLoginView(generics.GenericAPIView):
     permission_classes = [AllowAny]
     serializer_class = LoginSerializer
+    throttle_classes = [LoginThrottle]
     
     def post(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -74,8 +112,8 @@ class UserLoginView(generics.GenericAPIView):
 
         refresh = RefreshToken.for_user(user)
 
-        user.last_login = timezone.now()
-        user.save(update_fields=["last_login"])
+        if writebehind.record(user, "last_login", timezone.now()):
+            flush_write_behind.delay()
 
         return Response(
             {
@@ -145,16 +183,14 @@ class ChangePasswordView(generics.GenericAPIView):
 class ForgotPasswordView(generics.GenericAPIView):
     serializer_class = ForgotPasswordSerializer
     permission_classes = []
+    throttle_classes = [ForgotPasswordThrottle]
 
     def post(self, request, *args,**kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
-        email=serializer.validated_data["email"]
-        user = User.objects.filter(email=email).first()
-
-        if user:
-            send_password_reset_email.delay(user.id)
+        user = serializer.validated_data["user"]
+        send_password_reset_email.delay(user.id)
 
         return Response(
             {"message": "Password reset link sent to your email."},
@@ -164,6 +200,7 @@ class ForgotPasswordView(generics.GenericAPIView):
 # Reset Password
 class ResetPasswordView(generics.GenericAPIView):
     serializer_class = ResetPasswordSerializer
+    throttle_classes = [ResetPasswordThrottle]
 
     def post(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -173,11 +210,119 @@ class ResetPasswordView(generics.GenericAPIView):
         new_password = serializer.validated_data["password"]
                 
         user = token_obj.user
-        user.set_password(new_password)
-        user.save()
+        hashing.set_password(user, new_password)
 
-        token_obj.used = True
-        token_obj.save()
+        with transaction.atomic():
+            # consume the token first, a concurrent request with the same token loses here
+            if not PasswordResetToken.objects.filter(pk=token_obj.pk, used=False).update(used=True):
+                return Response({"token": ["Invalid or expired token."]}, status=status.HTTP_400_BAD_REQUEST)
+            user.save(update_fields=["password", "updated_at"])
                 
         return Response({"message": "Password reset successful."}, status=status.HTTP_200_OK)
 
+
+# Batch token introspection for the API gateway
+class IntrospectView(generics.GenericAPIView):
+    serializer_class = IntrospectSerializer
+    permission_classes = [HasIntrospectionKey]
+    authentication_classes = []
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        return Response(
+            {"results": introspect(serializer.validated_data["tokens"])},
+            status=status.HTTP_200_OK
+        )
+
+
+# Bulk user import (admin only), streams a JSONL report back
+class BulkUserImportView(generics.GenericAPIView):
+    serializer_class = BulkImportSerializer
+    authentication_classes = [StatelessJWTAuthentication]
+    permission_classes = [HasPermissions]
+    required_permissions = ["users.import"]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        upload = serializer.validated_data["file"]
+        fmt = serializer.validated_data.get("format") or detect_format(upload.name)
+        rows = READERS[fmt](text_stream(upload.file))
+        importer = UserImporter(
+            batch_size=settings.BULK_IMPORT["BATCH_SIZE"],
+            workers=settings.BULK_IMPORT["HASH_WORKERS"],
+            activate=serializer.validated_data["activate"],
+        )
+
+        report = (json.dumps(entry) + "\n" for entry in importer.run(rows))
+        return StreamingHttpResponse(report, content_type="application/x-ndjson", status=status.HTTP_200_OK)
+
+
+# JSON Web Key Set, lets other services verify tokens locally
+class JWKSView(APIView):
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+    @extend_schema(exclude=True)
+    def get(self, request, *args, **kwargs):
+        if keyring is None:
+            body, etag = b'{"keys": []}', '"empty"'
+        else:
+            keyring.reload_if_stale()
+            body, etag = keyring.jwks_json, keyring.jwks_etag
+
+        if request.headers.get("If-None-Match") == etag:
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = HttpResponse(body, content_type="application/json")
+
+        response["ETag"] = etag
+        response["Cache-Control"] = f"public, max-age={settings.JWKS_CACHE_SECONDS}"
+        return response
+
+
+# OpenAPI schema, precomputed and held in memory (see users/schema.py)
+class OpenAPISchemaView(APIView):
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+    @extend_schema(exclude=True)
+    def get(self, request, *args, **kwargs):
+        document = schema.get_document()
+        body, encoding = document.negotiate(request.headers.get("Accept-Encoding", ""))
+        etag = document.etag(encoding)
+
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = HttpResponse(body, content_type=schema.CONTENT_TYPE)
+            if encoding:
+                response["Content-Encoding"] = encoding
+
+        response["ETag"] = etag
+        patch_vary_headers(response, ["Accept-Encoding"])
+        response["Cache-Control"] = f"public, max-age={settings.OPENAPI_SCHEMA['MAX_AGE']}"
+        return response
+
+
+# Prometheus metrics for every process on this host (see users/metrics.py)
+class MetricsView(APIView):
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+    @extend_schema(exclude=True)
+    def get(self, request, *args, **kwargs):
+        token = settings.METRICS["TOKEN"]
+        if token:
+            if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+                return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+        elif not settings.DEBUG:
+            # without a token the metrics are only open in development
+            return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+
+        from prometheus_client import CONTENT_TYPE_LATEST
+        return HttpResponse(metrics.render(), content_type=CONTENT_TYPE_LATEST)
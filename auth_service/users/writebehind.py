@@ -0,0 +1,225 @@
+import atexit
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+from redis.exceptions import RedisError
+
+from . import metrics
+from .cache import user_cache
+
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "auth:writebehind:"
+
+
+# Write-behind buffer for non-critical timestamps.
+# record() keeps the latest value per row and field; flush() takes the whole
+# buffer of each field in WRITE_BEHIND["FIELDS"] and writes it with one bulk
+# UPDATE per BATCH_SIZE rows. Redis-backed when CACHES["default"] is
+# django-redis (one hash per field, survives restarts, any process can
+# flush), otherwise a process-local dict (tests, eager Celery). A full
+# buffer asks for one flush: request_flush() is true for the first caller
+# only, until take() or its timeout.
+class RedisWriteBuffer:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def put(self, field, pk, value):
+        self.connection.hset(KEY_PREFIX + field, pk, value)
+
+    def request_flush(self, field, timeout):
+        return bool(self.connection.set(f"{KEY_PREFIX}{field}:requested", 1, nx=True, ex=max(int(timeout), 1)))
+
+    def take(self, field):
+        from redis.exceptions import ResponseError
+
+        self.connection.delete(f"{KEY_PREFIX}{field}:requested")
+        # RENAME hands the hash to this flush alone, new writes start a fresh one
+        flushing = f"{KEY_PREFIX}{field}:flushing:{uuid.uuid4().hex}"
+        try:
+            self.connection.rename(KEY_PREFIX + field, flushing)
+        except ResponseError:
+            # no such key, nothing buffered
+            return {}
+        items = self.connection.hgetall(flushing)
+        self.connection.delete(flushing)
+        return {pk.decode(): value.decode() for pk, value in items.items()}
+
+    def restore(self, field, items):
+        # values recorded since take() are newer, keep them
+        pipe = self.connection.pipeline()
+        for pk, value in items.items():
+            pipe.hsetnx(KEY_PREFIX + field, pk, value)
+        pipe.execute()
+
+    def size(self, field):
+        return self.connection.hlen(KEY_PREFIX + field)
+
+
+class LocalWriteBuffer:
+    def __init__(self):
+        self.items = defaultdict(dict)
+        self.requested = {}
+        self.lock = threading.Lock()
+
+    def put(self, field, pk, value):
+        with self.lock:
+            self.items[field][pk] = value
+
+    def request_flush(self, field, timeout):
+        now = time.monotonic()
+        with self.lock:
+            if self.requested.get(field, 0) > now:
+                return False
+            self.requested[field] = now + timeout
+            return True
+
+    def take(self, field):
+        with self.lock:
+            self.requested.pop(field, None)
+            return self.items.pop(field, {})
+
+    def restore(self, field, items):
+        with self.lock:
+            current = self.items[field]
+            for pk, value in items.items():
+                current.setdefault(pk, value)
+
+    def size(self, field):
+        return len(self.items.get(field, ()))
+
+
+_local_buffer = LocalWriteBuffer()
+# Whether this process buffered anything, the exit flush is skipped otherwise
+_recorded = False
+
+
+def get_buffer():
+    try:
+        from django_redis import get_redis_connection
+        return RedisWriteBuffer(get_redis_connection("default"))
+    except (ImportError, NotImplementedError):
+        return _local_buffer
+
+
+def _split(field):
+    # "users.CustomUser.last_login" -> (CustomUser, "last_login")
+    model_label, _, name = field.rpartition(".")
+    return apps.get_model(model_label), name
+
+
+def _invalidate(model, pks):
+    # update() and bulk_update() send no post_save
+    if model is get_user_model():
+        pks = list(pks)
+        transaction.on_commit(lambda: user_cache.invalidate_many(pks))
+
+
+def _write_through(instance, name, value):
+    if type(instance)._base_manager.filter(pk=instance.pk).update(**{name: value}):
+        _invalidate(type(instance), [instance.pk])
+
+
+def _buffer(instance, name, value):
+    """
+    Buffer the value: True when this call should queue a flush, False when
+    not, None when Redis is unreachable and the caller has to write through.
+    """
+    config = settings.WRITE_BEHIND
+    field = f"{instance._meta.label}.{name}"
+    global _recorded
+    _recorded = True
+    buffer = get_buffer()
+    try:
+        buffer.put(field, str(instance.pk), value.isoformat())
+        metrics.incr("write_behind_recorded_total", field=field)
+        return buffer.size(field) >= config["BATCH_SIZE"] and buffer.request_flush(field, config["FLUSH_INTERVAL"])
+    except RedisError:
+        logger.warning("Write-behind buffer unavailable, writing %s through", field, exc_info=True)
+        metrics.incr("write_behind_errors_total", field=field)
+        return None
+
+
+def _check(instance, name):
+    field = f"{instance._meta.label}.{name}"
+    if field not in settings.WRITE_BEHIND["FIELDS"]:
+        raise ValueError(f"{field} is not in WRITE_BEHIND['FIELDS']")
+
+
+def record(instance, name, value):
+    """
+    Set ``instance.<name>`` now and write it to the database later.
+    Returns True when the buffer holds a full batch and no flush was asked
+    for yet; the caller queues one. Without Redis the value is written now.
+    """
+    _check(instance, name)
+    setattr(instance, name, value)
+    if not settings.WRITE_BEHIND["ENABLED"]:
+        _write_through(instance, name, value)
+        return False
+
+    due = _buffer(instance, name, value)
+    if due is None:
+        _write_through(instance, name, value)
+    return bool(due)
+
+
+async def arecord(instance, name, value):
+    """record() for async views, in a thread: buffering is a Redis write and a write-through a query."""
+    return await sync_to_async(record)(instance, name, value)
+
+
+def flush():
+    """Write every buffered value, one bulk UPDATE per BATCH_SIZE rows. Returns rows written."""
+    config = settings.WRITE_BEHIND
+    buffer = get_buffer()
+    written = 0
+
+    for field in config["FIELDS"]:
+        items = buffer.take(field)
+        if not items:
+            continue
+
+        model, name = _split(field)
+        values = {pk: parse_datetime(value) for pk, value in items.items()}
+        objs = [model(pk=pk, **{name: value}) for pk, value in values.items()]
+        try:
+            with metrics.timer("write_behind_flush_seconds", field=field):
+                # bulk_update() sends a single UPDATE ... SET = CASE pk WHEN ... per batch
+                model._base_manager.bulk_update(objs, [name], batch_size=config["BATCH_SIZE"])
+        except Exception:
+            logger.exception("Flushing %d buffered %s values failed, keeping them", len(objs), field)
+            metrics.incr("write_behind_errors_total", field=field)
+            buffer.restore(field, items)
+            continue
+
+        _invalidate(model, values)
+        written += len(objs)
+        metrics.incr("write_behind_flushed_total", len(objs), field=field)
+        # how far behind the oldest value was, bounded by the flush interval
+        oldest = min(values.values())
+        metrics.observe("write_behind_lag_seconds", max(time.time() - oldest.timestamp(), 0.0), field=field)
+
+    return written
+
+
+def _flush_at_exit():
+    if not _recorded:
+        return
+    try:
+        flush()
+    except Exception:
+        logger.exception("Write-behind flush at exit failed")
+
+
+atexit.register(_flush_at_exit)